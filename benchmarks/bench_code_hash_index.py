@@ -0,0 +1,103 @@
+"""
+Measures the cold start time of a fully cached 500-stage graph in a fresh process,
+with and without the persistent code hash index.
+
+Usage: python benchmarks/bench_code_hash_index.py [--stages 500] [--runs 5]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+import textwrap
+from pathlib import Path
+
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def generate_graph_module(num_stages: int) -> str:
+    # A binary tree of stages, stage_0 is the root
+    lines = ["from pycrastinate import stage, Result", ""]
+    for stage_idx in reversed(range(num_stages)):
+        children = [
+            child_idx for child_idx in (2 * stage_idx + 1, 2 * stage_idx + 2)
+            if child_idx < num_stages
+        ]
+        params = ", ".join(
+            f"input_{child_idx}=Result(stage_{child_idx})" for child_idx in children
+        )
+        if len(children) == 0:
+            params = f"value={stage_idx}"
+            body = "return value * 2"
+        else:
+            body = "return " + " + ".join(f"input_{child_idx}" for child_idx in children)
+        lines += [
+            "@stage",
+            f"def stage_{stage_idx}({params}):",
+            f"    # Stage number {stage_idx}",
+            f"    {body}",
+            "",
+        ]
+    return "\n".join(lines)
+
+
+RUNNER = textwrap.dedent("""
+    import sys, time
+    sys.path[:0] = [{repo_root!r}, {module_dir!r}]
+    import logging
+    logging.disable(logging.INFO)
+    from pycrastinate import set_cache_dir
+    from pycrastinate.config import set_code_hash_index_enabled
+    set_cache_dir({cache_dir!r})
+    set_code_hash_index_enabled({use_index!r})
+    import bench_graph
+    start = time.perf_counter()
+    bench_graph.stage_0()
+    print(time.perf_counter() - start)
+""")
+
+
+def run_cold(module_dir: Path, cache_dir: Path, use_index: bool) -> float:
+    script = RUNNER.format(
+        repo_root=str(REPO_ROOT),
+        module_dir=str(module_dir),
+        cache_dir=str(cache_dir),
+        use_index=use_index,
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script], check=True, capture_output=True, text=True
+    )
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", type=int, default=500)
+    parser.add_argument("--runs", type=int, default=5)
+    cli_args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        module_dir = Path(tmp_dir)
+        cache_dir = module_dir / "cache"
+        (module_dir / "bench_graph.py").write_text(
+            generate_graph_module(cli_args.stages)
+        )
+        # Populate the result cache and the code hash index
+        run_cold(module_dir, cache_dir, use_index=True)
+
+        for use_index in (False, True):
+            timings = [
+                run_cold(module_dir, cache_dir, use_index)
+                for _ in range(cli_args.runs)
+            ]
+            print(
+                f"{cli_args.stages} stages, code hash index "
+                f"{'enabled ' if use_index else 'disabled'}: "
+                f"median {statistics.median(timings) * 1000:.1f} ms, "
+                f"min {min(timings) * 1000:.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Compares the compressed size, save time and load latency of the compression codecs
+on representative stage results.
+
+Usage: python benchmarks/bench_compression.py [--scale 1] [--runs 5]
+"""
+import argparse
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pycrastinate import config  # noqa: E402
+from pycrastinate.utils.persistence import save_object, load_object  # noqa: E402
+
+
+CODECS = ["none", "zlib:1", "zlib:6", "zlib:9", "lzma", "bz2"]
+
+
+def make_payloads(scale: int):
+    rng = random.Random(0)
+    num_rows = 100_000 * scale
+    return {
+        # Rows of a table with repetitive string columns
+        "records": [
+            {"id": idx, "city": rng.choice(["Berlin", "Lima", "Osaka"]), "x": idx / 7}
+            for idx in range(num_rows)
+        ],
+        # Measurements, which hardly compress
+        "floats": [rng.random() for _ in range(num_rows * 4)],
+        # Text, e.g. parsed documents
+        "text": " ".join(
+            rng.choice(["coffee", "beans", "grinder", "roast", "crema", "milk"])
+            for _ in range(num_rows * 4)
+        ),
+        # Small results are stored uncompressed below the size threshold
+        "small": {"num_people": 3},
+    }
+
+
+def measure(results_file: Path, payload, compression: str, runs: int):
+    config.set_compression(compression)
+    save_times, load_times = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        save_object(results_file, payload)
+        save_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        load_object(results_file)
+        load_times.append(time.perf_counter() - start)
+    return (
+        results_file.stat().st_size,
+        statistics.median(save_times),
+        statistics.median(load_times),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=5)
+    cli_args = parser.parse_args()
+
+    print(f"{'payload':>8} | {'codec':>6} | {'size':>10} | {'save':>9} | {'load':>9}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results_file = Path(tmp_dir) / "result"
+        for payload_name, payload in make_payloads(cli_args.scale).items():
+            for compression in CODECS:
+                size, save_time, load_time = measure(
+                    results_file, payload, compression, cli_args.runs
+                )
+                print(
+                    f"{payload_name:>8} | {compression:>6} | {size / 1024:>7.0f} KB | "
+                    f"{save_time * 1000:>6.1f} ms | {load_time * 1000:>6.1f} ms"
+                )
+
+
+if __name__ == "__main__":
+    main()
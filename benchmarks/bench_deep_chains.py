@@ -0,0 +1,64 @@
+"""
+Measures resolving a fully cached chain of 10,000 stages with the iterative
+resolution engine, keyed by value and by reference. The recursive engine exceeds
+the recursion limit for chains this deep.
+
+Usage: python benchmarks/bench_deep_chains.py [--stages 10000] [--runs 5]
+"""
+import argparse
+import logging
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pycrastinate import stage, Result, set_cache_dir, config  # noqa: E402
+from pycrastinate.stages import Stage  # noqa: E402
+
+
+def build_chain(num_stages: int) -> Stage[int]:
+    @stage
+    def source(value: int = 0):
+        return value
+
+    last_stage = source
+    for _ in range(num_stages - 1):
+        def step(upstream=Result(last_stage)):
+            return upstream + 1
+        last_stage = stage(step)
+    return last_stage
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", type=int, default=10000)
+    parser.add_argument("--runs", type=int, default=5)
+    cli_args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    config.set_iterative_resolution_enabled(True)
+    chain = build_chain(cli_args.stages)
+    for keying_mode in (config.KEYING_BY_VALUE, config.KEYING_BY_REFERENCE):
+        config.set_keying_mode(keying_mode)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            set_cache_dir(cache_dir)
+            # Populate the cache
+            assert chain() == cli_args.stages - 1
+
+            timings = []
+            for _ in range(cli_args.runs):
+                start = time.perf_counter()
+                chain()
+                timings.append(time.perf_counter() - start)
+            print(
+                f"{cli_args.stages} cached stages, keyed by {keying_mode}: "
+                f"median {statistics.median(timings) * 1000:.1f} ms, "
+                f"min {min(timings) * 1000:.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
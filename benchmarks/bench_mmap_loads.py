@@ -0,0 +1,82 @@
+"""
+Measures the latency and peak memory of loading a large array result in a fresh
+process, comparing in-band storage with memory-mapped out-of-band buffers.
+
+Usage: python benchmarks/bench_mmap_loads.py [--size-mb 1024]
+"""
+import argparse
+import subprocess
+import sys
+import tempfile
+import textwrap
+from pathlib import Path
+
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+RUNNER = textwrap.dedent("""
+    import pickle, resource, sys, time
+    from pathlib import Path
+    sys.path.insert(0, {repo_root!r})
+    from pycrastinate import config
+    from pycrastinate.utils.persistence import save_object, load_object
+
+    class Samples:
+        # Stands in for a numpy array, which pickles its data the same way
+        def __init__(self, data):
+            self.data = memoryview(data)
+
+        def __reduce_ex__(self, protocol):
+            return Samples, (pickle.PickleBuffer(self.data),)
+
+    config.set_compression("none")
+    config.set_out_of_band_min_size({out_of_band_min_size})
+    results_file = Path({results_file!r})
+    if {save!r}:
+        save_object(results_file, Samples(bytearray({size_mb} * 2**20)))
+    else:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        samples = load_object(results_file)
+        duration = time.perf_counter() - start
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print((rss_after - rss_before) / 1024, duration)
+""")
+
+
+def run(results_file: Path, size_mb: int, out_of_band: bool, save: bool) -> str:
+    script = RUNNER.format(
+        repo_root=str(REPO_ROOT),
+        results_file=str(results_file),
+        size_mb=size_mb,
+        out_of_band_min_size=2**20 if out_of_band else 2**62,
+        save=save,
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script], check=True, capture_output=True, text=True
+    )
+    return output.stdout
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=1024)
+    cli_args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for out_of_band in (False, True):
+            results_file = Path(tmp_dir) / f"result_{out_of_band}"
+            run(results_file, cli_args.size_mb, out_of_band, save=True)
+            peak_increase_mb, duration = run(
+                results_file, cli_args.size_mb, out_of_band, save=False
+            ).split()
+            print(
+                f"{cli_args.size_mb} MB array, "
+                f"{'out-of-band' if out_of_band else 'in-band    '}: "
+                f"load {float(duration) * 1000:>7.1f} ms, "
+                f"peak RSS increase {float(peak_increase_mb):>7.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Compares reading small stage results from loose files and from a pack, and measures
+how long packing takes.
+
+Usage: python benchmarks/bench_packs.py [--entries 10000 100000]
+"""
+import argparse
+import hashlib
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pycrastinate.storage import FileSystemStorage  # noqa: E402
+
+
+def make_key(idx: int) -> str:
+    encoded_hash = hashlib.sha256(idx.to_bytes(8, "little")).hexdigest()
+    return f"stage_results/{encoded_hash[:2]}/{encoded_hash[2:]}"
+
+
+def measure_reads(cache_dir: Path, keys) -> float:
+    # A new storage instance, as in a new process
+    storage = FileSystemStorage(cache_dir)
+    start = time.perf_counter()
+    for key in keys:
+        storage.load(key)
+    return len(keys) / (time.perf_counter() - start)
+
+
+def measure(num_entries: int, cache_dir: Path):
+    storage = FileSystemStorage(cache_dir)
+    keys = [make_key(idx) for idx in range(num_entries)]
+    for idx, key in enumerate(keys):
+        storage.save(key, {"id": idx, "label": f"entry {idx}"})
+    random.Random(0).shuffle(keys)
+
+    loose_reads = measure_reads(cache_dir, keys)
+    start = time.perf_counter()
+    storage.pack("stage_results/")
+    pack_duration = time.perf_counter() - start
+    packed_reads = measure_reads(cache_dir, keys)
+    return loose_reads, packed_reads, pack_duration
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, nargs="+", default=[10_000, 100_000])
+    cli_args = parser.parse_args()
+
+    print(
+        f"{'entries':>9} | {'loose reads/s':>13} | {'packed reads/s':>14} | "
+        f"{'pack time':>9}"
+    )
+    for num_entries in cli_args.entries:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            loose_reads, packed_reads, pack_duration = measure(
+                num_entries, Path(tmp_dir)
+            )
+        print(
+            f"{num_entries:>9} | {loose_reads:>13.0f} | {packed_reads:>14.0f} | "
+            f"{pack_duration:>8.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Compares the write and read throughput of the storage backends for growing numbers
+of small stage results.
+
+Usage: python benchmarks/bench_storage_backends.py
+           [--entries 10000 100000 1000000] [--backends filesystem sqlite memory]
+"""
+import argparse
+import hashlib
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pycrastinate import config  # noqa: E402
+from pycrastinate.stages.result import PersistedInvocation, DataArg  # noqa: E402
+from pycrastinate.storage import get_storage, close_storages  # noqa: E402
+
+
+def make_result(idx: int) -> PersistedInvocation:
+    return PersistedInvocation(
+        result={"id": idx, "score": idx / 3, "label": f"entry {idx}"},
+        args={"idx": DataArg(idx)},
+        code_hash=bytes(32),
+        start_time=datetime.now(),
+        execution_duration=timedelta(milliseconds=5),
+        result_hash=bytes(32),
+    )
+
+
+def make_key(idx: int) -> str:
+    encoded_hash = hashlib.sha256(idx.to_bytes(8, "little")).hexdigest()
+    return f"stage_results/{encoded_hash[:2]}/{encoded_hash[2:]}"
+
+
+def measure(storage_backend: str, num_entries: int, cache_dir: Path):
+    config.set_storage_backend(storage_backend)
+    storage = get_storage(cache_dir)
+    keys = [make_key(idx) for idx in range(num_entries)]
+
+    start = time.perf_counter()
+    for idx, key in enumerate(keys):
+        storage.save(key, make_result(idx))
+    write_duration = time.perf_counter() - start
+
+    random.Random(0).shuffle(keys)
+    start = time.perf_counter()
+    for key in keys:
+        storage.load(key)
+    read_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for idx in range(num_entries):
+        storage.exists(make_key(num_entries + idx))
+    miss_duration = time.perf_counter() - start
+
+    close_storages()
+    return (
+        num_entries / write_duration,
+        num_entries / read_duration,
+        num_entries / miss_duration,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--entries", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=[
+            config.STORAGE_FILESYSTEM, config.STORAGE_SQLITE, config.STORAGE_MEMORY
+        ],
+    )
+    cli_args = parser.parse_args()
+
+    print(
+        f"{'entries':>9} | {'backend':>10} | {'writes/s':>9} | {'reads/s':>9} | "
+        f"{'misses/s':>9}"
+    )
+    for num_entries in cli_args.entries:
+        for storage_backend in cli_args.backends:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                writes, reads, misses = measure(
+                    storage_backend, num_entries, Path(tmp_dir)
+                )
+            print(
+                f"{num_entries:>9} | {storage_backend:>10} | {writes:>9.0f} | "
+                f"{reads:>9.0f} | {misses:>9.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Measures the peak memory used while hashing values of growing size, comparing
+hashing a complete serialization with the streaming value hasher.
+
+Usage: python benchmarks/bench_value_hash_memory.py [--sizes-mb 16 64 256]
+"""
+import argparse
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+RUNNER = textwrap.dedent("""
+    import hashlib, pickle, resource, sys, time
+    sys.path.insert(0, {repo_root!r})
+    from pycrastinate.utils.hashing import compute_value_hash
+
+    def hash_serialized(value):
+        return hashlib.sha256(pickle.dumps(value, protocol=4)).digest()
+
+    hashers = {{"serialized": hash_serialized, "streaming": compute_value_hash}}
+    # A container of 1 MiB chunks, similar to the blocks of a data frame
+    value = [bytes([idx % 256]) * 2**20 for idx in range({size_mb})]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    hashers[{hasher!r}](value)
+    duration = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print((rss_after - rss_before) / 1024, duration)
+""")
+
+
+def measure(hasher: str, size_mb: int):
+    script = RUNNER.format(repo_root=str(REPO_ROOT), hasher=hasher, size_mb=size_mb)
+    output = subprocess.run(
+        [sys.executable, "-c", script], check=True, capture_output=True, text=True
+    )
+    peak_increase_mb, duration = output.stdout.split()
+    return float(peak_increase_mb), float(duration)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes-mb", type=int, nargs="+", default=[16, 64, 256])
+    cli_args = parser.parse_args()
+
+    print(f"{'value size':>10} | {'hasher':>10} | {'peak RSS increase':>17} | time")
+    for size_mb in cli_args.sizes_mb:
+        for hasher in ("serialized", "streaming"):
+            peak_increase_mb, duration = measure(hasher, size_mb)
+            print(
+                f"{size_mb:>7} MB | {hasher:>10} | {peak_increase_mb:>14.1f} MB | "
+                f"{duration * 1000:.0f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
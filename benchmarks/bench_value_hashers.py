@@ -0,0 +1,75 @@
+"""
+Measures the hashing throughput of buffer values, comparing hashing a complete
+pickle serialization with the type-specialized value hashers.
+
+Usage: python benchmarks/bench_value_hashers.py [--size-mb 64] [--runs 5]
+"""
+import argparse
+import array
+import hashlib
+import pickle
+import statistics
+import sys
+import time
+from pathlib import Path
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pycrastinate.utils.hashing import compute_value_hash  # noqa: E402
+
+
+def hash_serialized(value):
+    return hashlib.sha256(pickle.dumps(value, protocol=4)).digest()
+
+
+def make_values(size_mb: int):
+    num_bytes = size_mb * 2**20
+    values = {
+        "bytearray": bytearray(num_bytes),
+        "array('d')": array.array("d", range(num_bytes // 8)),
+        # Exact bytes and bytearrays nested in other values are serialized
+        "list of arrays": [
+            array.array("d", range(2**20 // 8)) for _ in range(size_mb)
+        ],
+    }
+    try:
+        import numpy
+        values["numpy float64"] = numpy.arange(num_bytes // 8, dtype=numpy.float64)
+        values["numpy strided"] = numpy.arange(
+            num_bytes // 4, dtype=numpy.float64
+        )[::2]
+    except ImportError:
+        pass
+    return values
+
+
+def measure(hasher, value, runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        hasher(value)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=64)
+    parser.add_argument("--runs", type=int, default=5)
+    cli_args = parser.parse_args()
+
+    print(f"{'value':>18} | {'serialized':>12} | {'specialized':>12}")
+    for value_name, value in make_values(cli_args.size_mb).items():
+        throughputs = [
+            cli_args.size_mb / measure(hasher, value, cli_args.runs)
+            for hasher in (hash_serialized, compute_value_hash)
+        ]
+        print(
+            f"{value_name:>18} | {throughputs[0]:>7.0f} MB/s | "
+            f"{throughputs[1]:>7.0f} MB/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,3 +8,5 @@ from .dependencies import (
 from .dependencies import subscription_conditions
 from .args import Args
 from .config import set_cache_dir
+from .utils.hashing import register_value_hasher
+from .garbage_collection import collect_garbage, RetentionPolicy
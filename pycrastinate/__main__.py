@@ -0,0 +1,162 @@
+"""
+Maintains the cache dir from the command line.
+
+Usage: python -m pycrastinate gc [--cache-dir DIR] [--max-size 10G] [--max-age 30d]
+    [--max-idle 7d] [--keep-code-hashes 2] [--lru] [--dry-run] [--verbose]
+"""
+from datetime import timedelta
+from pathlib import Path
+from typing import (
+    Callable,
+    List,
+    Optional,
+    TypeVar,
+)
+import argparse
+import re
+
+from .config import (
+    STORAGE_FILESYSTEM,
+    STORAGE_SQLITE,
+    get_cache_dir,
+    set_storage_backend,
+)
+from .garbage_collection import RetentionPolicy, collect_garbage
+
+
+T = TypeVar("T")
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+DURATION_UNITS = {
+    "s": timedelta(seconds=1),
+    "m": timedelta(minutes=1),
+    "h": timedelta(hours=1),
+    "d": timedelta(days=1),
+    "w": timedelta(weeks=1),
+}
+
+
+def parse_size(size: str) -> int:
+    """
+    Parses a number of bytes with an optional binary unit, e.g. "500M" or "10G".
+    """
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)B?", size.strip().upper())
+    if match is None:
+        raise ValueError(f"Invalid size '{size}'")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def parse_duration(duration: str) -> timedelta:
+    """
+    Parses a duration with a unit, e.g. "12h", "30d" or "2w".
+    """
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([smhdw])", duration.strip().lower())
+    if match is None:
+        raise ValueError(f"Invalid duration '{duration}'")
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def format_size(num_bytes: int) -> str:
+    if num_bytes < 1024:
+        return f"{num_bytes} B"
+    size = float(num_bytes)
+    for unit in ("K", "M", "G"):
+        size /= 1024
+        if size < 1024:
+            return f"{size:.1f} {unit}B"
+    return f"{size / 1024:.1f} TB"
+
+
+def _create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m pycrastinate")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    gc_parser = commands.add_parser(
+        "gc", help="evict stage results according to retention policies"
+    )
+    gc_parser.add_argument(
+        "--cache-dir", type=Path, default=None,
+        help=f"the cache dir, '{get_cache_dir()}' by default",
+    )
+    gc_parser.add_argument(
+        "--storage", choices=[STORAGE_FILESYSTEM, STORAGE_SQLITE],
+        default=STORAGE_FILESYSTEM, help="the storage backend of the cache dir",
+    )
+    gc_parser.add_argument(
+        "--max-size", type=_argument_type(parse_size),
+        help="evict results until they fit, e.g. 10G",
+    )
+    gc_parser.add_argument(
+        "--max-age", type=_argument_type(parse_duration),
+        help="evict results computed longer ago, e.g. 30d",
+    )
+    gc_parser.add_argument(
+        "--max-idle", type=_argument_type(parse_duration),
+        help="evict results that weren't used for longer, e.g. 7d",
+    )
+    gc_parser.add_argument(
+        "--keep-code-hashes", type=int,
+        help="keep only the results of the latest code hashes of each stage",
+    )
+    gc_parser.add_argument(
+        "--lru", action="store_true",
+        help="evict the least recently used results to fit the size, instead of "
+        "those that are fast to recompute relative to their size",
+    )
+    gc_parser.add_argument(
+        "--dry-run", action="store_true", help="only report what would be evicted"
+    )
+    gc_parser.add_argument(
+        "--verbose", action="store_true", help="list the evicted results"
+    )
+    return parser
+
+
+def _argument_type(parse: Callable[[str], T]) -> Callable[[str], T]:
+    # argparse only reports ArgumentTypeErrors with their message
+    def parse_argument(value: str) -> T:
+        try:
+            return parse(value)
+        except ValueError as error:
+            raise argparse.ArgumentTypeError(str(error))
+    return parse_argument
+
+
+def _run_gc(cli_args: argparse.Namespace) -> None:
+    set_storage_backend(cli_args.storage)
+    policy = RetentionPolicy(
+        max_age=cli_args.max_age,
+        max_idle_time=cli_args.max_idle,
+        keep_code_hashes=cli_args.keep_code_hashes,
+        max_total_size=cli_args.max_size,
+        cost_aware=not cli_args.lru,
+    )
+    report = collect_garbage(policy, cli_args.cache_dir, dry_run=cli_args.dry_run)
+
+    if cli_args.verbose:
+        for evicted in report.evicted:
+            invocation = evicted.invocation
+            print(
+                f"{invocation.stage_hash.hex()[:12]} "
+                f"{invocation.stage_name or '<unknown stage>'}: "
+                f"{format_size(invocation.payload_size)}, by {evicted.reason}"
+            )
+    print(
+        f"{'Would evict' if report.dry_run else 'Evicted'} "
+        f"{len(report.evicted)} results, "
+        f"{format_size(report.freed_size)} of {format_size(report.total_size)}"
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = _create_parser()
+    cli_args = parser.parse_args(argv)
+    try:
+        if cli_args.command == "gc":
+            _run_gc(cli_args)
+    except ValueError as error:
+        parser.error(str(error))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,95 @@
-from typing import Union
+from typing import Literal, Union
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+import os
+
+from .utils.encoding import parse_compression
+
+
+# Stages are keyed by the hashes of the values of their data dependencies
+KEYING_BY_VALUE = "value"
+# Stages are keyed by the hashes used to look up their data dependencies, which
+# allows resolving cached stages without loading the results of their dependencies.
+# If the result of a stage is cached, its upstream stages aren't loaded or executed,
+# so the hooks subscribed to them don't run.
+KEYING_BY_REFERENCE = "reference"
+
+KeyingLiteral = Literal[
+    KEYING_BY_VALUE,
+    KEYING_BY_REFERENCE,
+]
+
+# Every object is stored in its own file
+STORAGE_FILESYSTEM = "filesystem"
+# All objects are stored in a single SQLite database
+STORAGE_SQLITE = "sqlite"
+# Objects are only kept in memory, for tests and ephemeral runs
+STORAGE_MEMORY = "memory"
+
+StorageLiteral = Literal[
+    STORAGE_FILESYSTEM,
+    STORAGE_SQLITE,
+    STORAGE_MEMORY,
+]
+
+# Independent dependencies are resolved concurrently in threads
+EXECUTOR_THREAD = "thread"
+# Additionally, stage functions are executed in worker processes, which requires
+# them to be defined at module level and their arguments and results to be
+# picklable
+EXECUTOR_PROCESS = "process"
+
+ExecutorLiteral = Literal[
+    EXECUTOR_THREAD,
+    EXECUTOR_PROCESS,
+]
 
 
 @dataclass
 class Config:
     cache_dir: Path = Path("./__pycrastinate__") 
+    keying_mode: KeyingLiteral = KEYING_BY_VALUE
+    storage_backend: StorageLiteral = STORAGE_FILESYSTEM
+    # Persist code hashes in the cache dir to avoid parsing unchanged source files
+    # again in every new process
+    code_hash_index: bool = True
+    # The codec persisted results are compressed with, optionally with a level,
+    # e.g. "zlib:6". Stages can override it.
+    compression: str = "zlib:6"
+    # Smaller payloads are stored uncompressed
+    compression_min_size: int = 1024
+    # Larger buffers (e.g. of numpy arrays) are stored uncompressed in separate blob
+    # files, which are memory-mapped when loading
+    out_of_band_min_size: int = 1024 * 1024
+    # The byte budget of the in-memory cache of loaded results, 0 disables it.
+    # Cached results are shared between lookups, so they must not be mutated.
+    result_cache_size: int = 0
+    # Index persisted results in a SQLite database in the cache dir, which allows
+    # existence checks without file system access and metadata queries
+    cache_index: bool = True
+    # Flush persisted files to disk before they replace existing files, which
+    # protects the cache against power loss at the cost of slower writes
+    fsync: bool = False
+    # Only one thread or process at a time executes a stage with the same hash,
+    # others wait for it and load its result
+    single_flight: bool = True
+    # Waiting for another thread or process longer than this (in seconds) executes
+    # the stage anyway
+    single_flight_timeout: float = 3600.0
+    # Lock files of other processes that weren't refreshed for this long (in
+    # seconds) are considered stale, e.g. because their process was killed
+    stale_lock_age: float = 60.0
+    # Dependencies are resolved once per top-level call, also if several stages
+    # depend on them. Their results are kept in memory until the call finishes.
+    run_memo: bool = True
+    executor: ExecutorLiteral = EXECUTOR_THREAD
+    # The maximum number of dependencies that are resolved concurrently, 1 resolves
+    # them one after another
+    max_parallelism: int = os.cpu_count() or 1
+    # Resolve dependencies with an explicit stack instead of recursion, which
+    # supports arbitrarily deep chains of stages, but resolves independent
+    # dependencies one after another
+    iterative_resolution: bool = False
 
 _config = Config()
 
@@ -15,3 +99,131 @@ def set_cache_dir(new_cache_dir: Union[str, Path]) -> None:
 
 def get_cache_dir() -> Path:
     return _config.cache_dir
+
+def set_code_hash_index_enabled(enabled: bool) -> None:
+    _config.code_hash_index = enabled
+
+def get_code_hash_index_enabled() -> bool:
+    return _config.code_hash_index
+
+def set_keying_mode(keying_mode: KeyingLiteral) -> None:
+    if keying_mode not in (KEYING_BY_VALUE, KEYING_BY_REFERENCE):
+        raise ValueError(f"Unsupported keying mode '{keying_mode}'")
+    _config.keying_mode = keying_mode
+
+def get_keying_mode() -> KeyingLiteral:
+    return _config.keying_mode
+
+def set_compression(compression: str) -> None:
+    # Fail early for unknown codecs instead of when the first result is saved
+    parse_compression(compression)
+    _config.compression = compression
+
+def get_compression() -> str:
+    return _config.compression
+
+def set_compression_min_size(min_size: int) -> None:
+    if min_size < 0:
+        raise ValueError("The minimum size for compression must not be negative")
+    _config.compression_min_size = min_size
+
+def get_compression_min_size() -> int:
+    return _config.compression_min_size
+
+def set_out_of_band_min_size(min_size: int) -> None:
+    if min_size < 0:
+        raise ValueError(
+            "The minimum size for out-of-band buffers must not be negative"
+        )
+    _config.out_of_band_min_size = min_size
+
+def get_out_of_band_min_size() -> int:
+    return _config.out_of_band_min_size
+
+def set_result_cache_size(num_bytes: int) -> None:
+    if num_bytes < 0:
+        raise ValueError("The result cache size must not be negative")
+    _config.result_cache_size = num_bytes
+
+def get_result_cache_size() -> int:
+    return _config.result_cache_size
+
+def set_cache_index_enabled(enabled: bool) -> None:
+    _config.cache_index = enabled
+
+def get_cache_index_enabled() -> bool:
+    return _config.cache_index
+
+def set_fsync_enabled(enabled: bool) -> None:
+    _config.fsync = enabled
+
+def get_fsync_enabled() -> bool:
+    return _config.fsync
+
+def set_single_flight_enabled(enabled: bool) -> None:
+    _config.single_flight = enabled
+
+def get_single_flight_enabled() -> bool:
+    return _config.single_flight
+
+def set_single_flight_timeout(seconds: float) -> None:
+    if seconds < 0:
+        raise ValueError("The single-flight timeout must not be negative")
+    _config.single_flight_timeout = seconds
+
+def get_single_flight_timeout() -> float:
+    return _config.single_flight_timeout
+
+def set_stale_lock_age(seconds: float) -> None:
+    if seconds <= 0:
+        raise ValueError("The stale lock age must be positive")
+    _config.stale_lock_age = seconds
+
+def get_stale_lock_age() -> float:
+    return _config.stale_lock_age
+
+def set_run_memo_enabled(enabled: bool) -> None:
+    _config.run_memo = enabled
+
+def get_run_memo_enabled() -> bool:
+    return _config.run_memo
+
+def set_executor(executor: ExecutorLiteral) -> None:
+    if executor not in (EXECUTOR_THREAD, EXECUTOR_PROCESS):
+        raise ValueError(f"Unsupported executor '{executor}'")
+    _config.executor = executor
+
+def get_executor() -> ExecutorLiteral:
+    return _config.executor
+
+def set_max_parallelism(max_parallelism: int) -> None:
+    if max_parallelism < 1:
+        raise ValueError("The maximum parallelism must be at least 1")
+    _config.max_parallelism = max_parallelism
+
+def get_max_parallelism() -> int:
+    return _config.max_parallelism
+
+def set_iterative_resolution_enabled(enabled: bool) -> None:
+    _config.iterative_resolution = enabled
+
+def get_iterative_resolution_enabled() -> bool:
+    return _config.iterative_resolution
+
+def get_config() -> Config:
+    """
+    Returns a copy of the current configuration, e.g. for worker processes.
+    """
+    return replace(_config)
+
+def set_config(new_config: Config) -> None:
+    global _config
+    _config = replace(new_config)
+
+def set_storage_backend(storage_backend: StorageLiteral) -> None:
+    if storage_backend not in (STORAGE_FILESYSTEM, STORAGE_SQLITE, STORAGE_MEMORY):
+        raise ValueError(f"Unsupported storage backend '{storage_backend}'")
+    _config.storage_backend = storage_backend
+
+def get_storage_backend() -> StorageLiteral:
+    return _config.storage_backend
@@ -1,15 +1,42 @@
+from dataclasses import dataclass
 from typing import (
     Any,
     Callable,
     Generic,
+    List,
     Optional,
+    Set,
+    Tuple,
 )
+from types import CodeType
 
-from ..utils.hashing import compute_code_hash, compute_value_hash
-from ..utils.arg_aggregation import aggregate_args
+from ..utils.hashing import (
+    compute_code_hash,
+    compute_value_hash,
+    get_source_code_object,
+)
+from ..utils.arg_aggregation import ArgumentPlan
 from ..stages import R
 
 
+@dataclass
+class _ClosureMemo:
+    # The functions and code objects in the transitive closure, compared by
+    # identity. They change when a function in the closure is replaced.
+    identities: List[Tuple[Callable, Optional[CodeType]]]
+    has_no_data_dependencies: bool
+    recursive_hash: Optional[bytes] = None
+
+    def matches(
+        self, identities: List[Tuple[Callable, Optional[CodeType]]]
+    ) -> bool:
+        return len(self.identities) == len(identities) and all(
+            func is memo_func and code is memo_code
+            for (func, code), (memo_func, memo_code)
+            in zip(identities, self.identities)
+        )
+
+
 class FunctionDependency(Generic[R]):
     def __init__(
         self,
@@ -17,9 +44,8 @@ class FunctionDependency(Generic[R]):
     ) -> None:
         self.func = func
 
-        # TODO: caching is disabled right now to 
-        self._has_no_data_dependencies: Optional[bool] = None
-        self._recursive_code_hash: Optional[bytes] = None
+        self._argument_plan: Optional[Tuple[Callable, ArgumentPlan]] = None
+        self._closure_memo: Optional[_ClosureMemo] = None
 
     def __call__(self, *args: Any, **kwargs: Any) -> R:
         # TODO: pass results dir
@@ -32,38 +58,65 @@ class FunctionDependency(Generic[R]):
         Stages with function dependencies that don't have (recursive) data
         dependencies can use caching.
         """
-        # if self._has_no_data_dependencies is not None:
-            # # Already resolved
-            # return self._has_no_data_dependencies
-
-        dependency_args = aggregate_args(self.func)
-        if len(dependency_args.data_dependencies) > 0:
-            self._has_no_data_dependencies = False
-        else:
-            self._has_no_data_dependencies = all(
-                func_dependency.has_no_data_dependencies()
-                for func_dependency in dependency_args.func_dependencies.values()
-            )
-        return self._has_no_data_dependencies
+        return self._get_closure_memo().has_no_data_dependencies
 
     def get_recursive_hash(self) -> bytes:
         # assert self.has_no_data_dependencies()
 
-        # if self._recursive_code_hash is not None:
-            # return self._recursive_code_hash
+        closure_memo = self._get_closure_memo()
+        if closure_memo.recursive_hash is not None:
+            return closure_memo.recursive_hash
 
-        from ..stages import Stage
-        func = self.func.stage_func if isinstance(self.func, Stage) else self.func
-
-        code_hash = compute_code_hash(func)
-        dependency_args = aggregate_args(func)
+        func = self._get_func()
         dependency_hashes = {
             arg_name: func_dependency.get_recursive_hash()
-            for arg_name, func_dependency in dependency_args.func_dependencies.items()
+            for arg_name, func_dependency
+            in self._get_argument_plan(func).func_dependencies.items()
         }
+        code_hash = compute_code_hash(func)
+        closure_memo.recursive_hash = compute_value_hash(
+            (code_hash, dependency_hashes)
+        )
+        return closure_memo.recursive_hash
+
+    def _get_closure_memo(self) -> _ClosureMemo:
+        """
+        Walks the transitive closure without hashing anything, the argument plans
+        are cached. The walk is still necessary to notice replaced functions.
+        Dependencies shared by several functions are visited once.
+        """
+        identities = []
+        has_no_data_dependencies = True
+        visited_ids: Set[int] = set()
+        stack: List[FunctionDependency] = [self]
+        while len(stack) > 0:
+            dependency = stack.pop()
+            if id(dependency) in visited_ids:
+                continue
+            visited_ids.add(id(dependency))
+            func = dependency._get_func()
+            identities.append((func, get_source_code_object(func)))
+            argument_plan = dependency._get_argument_plan(func)
+            if len(argument_plan.data_dependencies) > 0:
+                has_no_data_dependencies = False
+            stack.extend(reversed(list(argument_plan.func_dependencies.values())))
+
+        closure_memo = self._closure_memo
+        if closure_memo is None or not closure_memo.matches(identities):
+            closure_memo = _ClosureMemo(identities, has_no_data_dependencies)
+            self._closure_memo = closure_memo
+        return closure_memo
+
+    def _get_func(self) -> Callable[..., R]:
+        from ..stages import Stage
+        return self.func.stage_func if isinstance(self.func, Stage) else self.func
 
-        self._recursive_code_hash = compute_value_hash((code_hash, dependency_hashes))
-        return self._recursive_code_hash
+    def _get_argument_plan(self, func: Callable) -> ArgumentPlan:
+        argument_plan = self._argument_plan
+        if argument_plan is None or argument_plan[0] is not func:
+            argument_plan = (func, ArgumentPlan(func))
+            self._argument_plan = argument_plan
+        return argument_plan[1]
 
 
 def Use(func: Callable[..., R]) -> FunctionDependency[R]:
@@ -33,9 +33,8 @@ class ResultDependency(StageDependency, Generic[R]):
         )
 
     def _check_cachable(self) -> None:
-        from ..utils.arg_aggregation import aggregate_args
-        aggregated_args = aggregate_args(self.stage.stage_func)
-        for arg_name, func_dependency in aggregated_args.func_dependencies.items():
+        argument_plan = self.stage.argument_plan
+        for arg_name, func_dependency in argument_plan.func_dependencies.items():
             if not func_dependency.has_no_data_dependencies():
                 raise ValueError(
                     f"Function dependency {arg_name} has (recursive) data "
@@ -57,6 +56,12 @@ class ResultDependency(StageDependency, Generic[R]):
         """
         return self.stage.compute_or_load_result(args)
 
+    async def aresolve(
+        self,
+        args: Args,
+    ) -> Tuple[bytes, Invocation[R]]:
+        return await self.stage.acompute_or_load_result(args)
+
 
 def Result(
     stage_func: "Stage",
@@ -1,5 +1,6 @@
 from typing import (
     Any,
+    Optional,
     TYPE_CHECKING,
 )
 
@@ -24,7 +25,10 @@ class SubscriptionDependency(StageDependency):
         self.when = when
         self.optional = optional
 
-    def load(self, result_reference: bytes) -> Invocation:
+    def load(self, result_reference: bytes) -> Optional[Invocation]:
+        # The result may have been removed from the cache in the meantime
+        if not self.stage.has_result(result_reference):
+            return None
         return self.stage.load_result(result_reference, with_metadata=True)
 
 
@@ -0,0 +1,197 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from .config import get_cache_dir, get_cache_index_enabled
+from .hooks.persistence import forget_result_references
+from .stages.index import IndexedInvocation, get_cache_index
+from .stages.persistence import delete_stage_results
+
+
+# Reasons for evicting a result
+EVICTED_BY_AGE = "age"
+EVICTED_BY_IDLE_TIME = "idle time"
+EVICTED_BY_CODE_HASH = "code hash"
+EVICTED_BY_SIZE = "size"
+
+
+@dataclass
+class RetentionPolicy:
+    # Results that were computed longer ago are evicted
+    max_age: Optional[timedelta] = None
+    # Results that weren't loaded or computed for longer are evicted
+    max_idle_time: Optional[timedelta] = None
+    # Only the results of the latest code hashes of each stage are kept, the code
+    # hashes are ordered by their latest result
+    keep_code_hashes: Optional[int] = None
+    # When the results take more bytes than this, results are evicted until they
+    # fit
+    max_total_size: Optional[int] = None
+    # Evicting results to fit the total size prefers results that are fast to
+    # recompute relative to their size, instead of the least recently used ones
+    cost_aware: bool = True
+
+    def __post_init__(self) -> None:
+        if self.keep_code_hashes is not None and self.keep_code_hashes < 1:
+            raise ValueError("At least one code hash per stage must be kept")
+        if self.max_total_size is not None and self.max_total_size < 0:
+            raise ValueError("The maximum total size must not be negative")
+
+
+@dataclass
+class EvictedResult:
+    invocation: IndexedInvocation
+    reason: str
+
+
+@dataclass
+class CollectionReport:
+    evicted: List[EvictedResult] = field(default_factory=list)
+    # Sizes in bytes of the results before the collection
+    total_size: int = 0
+    freed_size: int = 0
+    dry_run: bool = False
+
+    @property
+    def remaining_size(self) -> int:
+        return self.total_size - self.freed_size
+
+
+def collect_garbage(
+    policy: RetentionPolicy,
+    cache_dir: Optional[Path] = None,
+    dry_run: bool = False,
+) -> CollectionReport:
+    """
+    Evicts the stage results of the cache dir that the policy doesn't retain, based
+    on their metadata in the cache index. The rules for age, idle time and code
+    hashes are applied first, then results are evicted to fit the total size.
+    References of hook states to evicted results are removed. Results that other
+    processes are about to load are recomputed by them.
+    """
+    if not get_cache_index_enabled():
+        raise ValueError("Garbage collection requires the cache index")
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    index = get_cache_index(cache_dir)
+    index.index_stored_results()
+    invocations = index.list_invocations()
+
+    report = CollectionReport(
+        total_size=sum(invocation.payload_size for invocation in invocations),
+        dry_run=dry_run,
+    )
+    evicted_hashes: Set[bytes] = set()
+
+    def evict(invocation: IndexedInvocation, reason: str) -> None:
+        evicted_hashes.add(invocation.stage_hash)
+        report.evicted.append(EvictedResult(invocation, reason))
+        report.freed_size += invocation.payload_size
+
+    now = datetime.now()
+    outdated_hashes = (
+        _find_outdated_code_hashes(invocations, policy.keep_code_hashes)
+        if policy.keep_code_hashes is not None else set()
+    )
+    for invocation in invocations:
+        # Results persisted before the index existed don't have any times
+        last_use_time = _get_last_use_time(invocation)
+        if (
+            policy.max_age is not None
+            and invocation.start_time is not None
+            and now - invocation.start_time > policy.max_age
+        ):
+            evict(invocation, EVICTED_BY_AGE)
+        elif (
+            policy.max_idle_time is not None
+            and last_use_time is not None
+            and now - last_use_time > policy.max_idle_time
+        ):
+            evict(invocation, EVICTED_BY_IDLE_TIME)
+        elif (invocation.stage_name, invocation.code_hash) in outdated_hashes:
+            evict(invocation, EVICTED_BY_CODE_HASH)
+
+    if policy.max_total_size is not None:
+        remaining_invocations = [
+            invocation for invocation in invocations
+            if invocation.stage_hash not in evicted_hashes
+        ]
+        if policy.cost_aware:
+            remaining_invocations.sort(key=_get_eviction_score)
+        else:
+            remaining_invocations.sort(key=_get_lru_score)
+        for invocation in remaining_invocations:
+            if report.remaining_size <= policy.max_total_size:
+                break
+            evict(invocation, EVICTED_BY_SIZE)
+
+    if not dry_run and len(evicted_hashes) > 0:
+        delete_stage_results(cache_dir, evicted_hashes)
+        forget_result_references(cache_dir, evicted_hashes)
+    return report
+
+
+def _find_outdated_code_hashes(
+    invocations: List[IndexedInvocation], keep_code_hashes: int
+) -> Set[Tuple[str, bytes]]:
+    """
+    Returns the stage names and code hashes of the results to evict. Stages with
+    the same code have the same code hash.
+    """
+    # The latest start time of the results of each code hash, by stage
+    latest_start_times: Dict[str, Dict[bytes, datetime]] = {}
+    for invocation in invocations:
+        if (
+            invocation.stage_name is None
+            or invocation.code_hash is None
+            or invocation.start_time is None
+        ):
+            # Results persisted before the index existed are kept
+            continue
+        stage_start_times = latest_start_times.setdefault(invocation.stage_name, {})
+        stage_start_times[invocation.code_hash] = max(
+            stage_start_times.get(invocation.code_hash, invocation.start_time),
+            invocation.start_time,
+        )
+
+    outdated_hashes = set()
+    for stage_name, stage_start_times in latest_start_times.items():
+        code_hashes = sorted(
+            stage_start_times.keys(),
+            key=stage_start_times.__getitem__,
+            reverse=True,
+        )
+        outdated_hashes.update(
+            (stage_name, code_hash) for code_hash in code_hashes[keep_code_hashes:]
+        )
+    return outdated_hashes
+
+
+def _get_last_use_time(invocation: IndexedInvocation) -> Optional[datetime]:
+    if invocation.last_access_time is not None:
+        return invocation.last_access_time
+    return invocation.start_time
+
+
+def _get_lru_score(invocation: IndexedInvocation) -> float:
+    last_use_time = _get_last_use_time(invocation)
+    return last_use_time.timestamp() if last_use_time is not None else 0.0
+
+
+def _get_eviction_score(invocation: IndexedInvocation) -> Tuple[float, float]:
+    # The seconds it takes to recompute a byte, results without a known duration
+    # are evicted first. Equally cheap results are evicted least recently used
+    # first.
+    recompute_cost = (
+        invocation.execution_duration.total_seconds()
+        / max(invocation.payload_size, 1)
+        if invocation.execution_duration is not None else 0.0
+    )
+    return recompute_cost, _get_lru_score(invocation)
@@ -1,7 +1,10 @@
+import asyncio
 import inspect
 import functools
+import threading
 from pathlib import Path
 from typing import (
+    Any,
     Callable,
     Dict,
     Generic,
@@ -14,6 +17,7 @@ from ..dependencies import SubscriptionDependency, FunctionDependency
 from ..dependencies import subscription_conditions
 from ..utils.hashing import compute_function_dependency_hashes
 from ..stages import Invocation, R
+from ..stages.concurrency import call_function, is_coroutine_function
 from ..config import get_cache_dir
 from ..logging import log_hook_exec
 from . import persistence
@@ -69,6 +73,8 @@ class Hook(Generic[T]):
 
         self._subscription_dependencies: Dict[str, SubscriptionDependency] = {}
         self._function_dependency_hashes: Dict[str, bytes] = {}
+        # Subscribed stages may be resolved concurrently
+        self._state_lock = threading.Lock()
 
         self._parse_dependencies()
         # Execute the hook in case its code or that of a dependency changed
@@ -114,8 +120,10 @@ class Hook(Generic[T]):
 
     def _register_with_trigger_funcs(self) -> None:
         for arg_name, subscription in self._subscription_dependencies.items():
-            execute_arg_hook = functools.partial(self._execute_hook, arg_name)
-            subscription.stage.register_hook(execute_arg_hook)
+            subscription.stage.register_hook(
+                functools.partial(self._execute_hook, arg_name),
+                functools.partial(self._aexecute_hook, arg_name),
+            )
 
     def _execute_hook(
         self,
@@ -123,26 +131,65 @@ class Hook(Generic[T]):
         triggering_result_hash: bytes,
         triggering_result: Invocation,
     ) -> Optional[T]:
-        hook_state = persistence.load_hook_state(self.cache_dir, self.hook_func)
-        hook_state.update_code_hash(
-            self.hook_func, self._function_dependency_hashes
+        call_data = self._prepare_call(
+            triggering_arg_name, triggering_result_hash, triggering_result
         )
-        subscription_results = self._get_missing_subscription_data(
-            hook_state,
+        if call_data is None:
+            return None
+        log_hook_exec(self.hook_func)
+        return call_function(self.hook_func, call_data)
+
+    async def _aexecute_hook(
+        self,
+        triggering_arg_name: str,
+        triggering_result_hash: bytes,
+        triggering_result: Invocation,
+    ) -> Optional[T]:
+        if not is_coroutine_function(self.hook_func):
+            return await asyncio.to_thread(
+                self._execute_hook,
+                triggering_arg_name,
+                triggering_result_hash,
+                triggering_result,
+            )
+
+        call_data = await asyncio.to_thread(
+            self._prepare_call,
             triggering_arg_name,
             triggering_result_hash,
             triggering_result,
         )
-
-        persistence.save_hook_state(self.cache_dir, self.hook_func, hook_state)
-        if subscription_results is None:
+        if call_data is None:
             return None
         log_hook_exec(self.hook_func)
+        return await self.hook_func(**call_data)
 
-        call_data = _convert_metadata(
-            self._subscription_dependencies, subscription_results
-        )
-        return self.hook_func(**call_data)
+    def _prepare_call(
+        self,
+        triggering_arg_name: str,
+        triggering_result_hash: bytes,
+        triggering_result: Invocation,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Records the trigger in the hook state and returns the arguments for
+        executing the hook if it's triggered.
+        """
+        with self._state_lock:
+            hook_state = persistence.load_hook_state(self.cache_dir, self.hook_func)
+            hook_state.update_code_hash(
+                self.hook_func, self._function_dependency_hashes
+            )
+            subscription_results = self._get_missing_subscription_data(
+                hook_state,
+                triggering_arg_name,
+                triggering_result_hash,
+                triggering_result,
+            )
+
+            persistence.save_hook_state(self.cache_dir, self.hook_func, hook_state)
+        if subscription_results is None:
+            return None
+        return _convert_metadata(self._subscription_dependencies, subscription_results)
 
     def _get_missing_subscription_data(
         self,
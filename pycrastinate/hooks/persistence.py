@@ -9,7 +9,7 @@ from typing import (
 
 from ..utils.hashing import compute_code_hash, compute_value_hash
 from ..utils.functions import get_full_func_name
-from ..utils.persistence import save_object, load_object
+from ..storage import get_storage
 
 
 @dataclass
@@ -61,17 +61,18 @@ HOOK_STATES_DIR_NAME = "hook_states"
 MAX_FUNC_NAME_LENGTH = 255 # Max file name length on most file systems
 
 
-def _get_hook_state_path(cache_dir: Path, hook_func: Callable) -> Path:
+def _get_hook_state_key(hook_func: Callable) -> str:
     qualified_hook_name = get_full_func_name(hook_func, MAX_FUNC_NAME_LENGTH)
-    return cache_dir / HOOK_STATES_DIR_NAME / qualified_hook_name
+    return f"{HOOK_STATES_DIR_NAME}/{qualified_hook_name}"
 
 
 def load_hook_state(cache_dir: Path, hook_func: Callable) -> HookState:
-    hook_state_file = _get_hook_state_path(cache_dir, hook_func)
-    hook_state: Optional[HookState] = load_object(hook_state_file)
+    loaded_state = get_storage(cache_dir).load(_get_hook_state_key(hook_func))
 
-    if hook_state is None:
+    if loaded_state is None:
         hook_state = HookState()
+    else:
+        hook_state = loaded_state[0]
 
     return hook_state
 
@@ -81,5 +82,28 @@ def save_hook_state(
     hook_func: Callable,
     hook_state: HookState,
 ) -> None:
-    hook_state_file = _get_hook_state_path(results_dir, hook_func)
-    save_object(hook_state_file, hook_state)
+    get_storage(results_dir).save(_get_hook_state_key(hook_func), hook_state)
+
+
+def forget_result_references(cache_dir: Path, result_references: Set[bytes]) -> int:
+    """
+    Removes the references to deleted results from the hook states, so that hooks
+    don't try to load them. Returns the number of updated hook states.
+    """
+    storage = get_storage(cache_dir)
+    num_updated = 0
+    for state_key, _ in list(storage.list_objects(HOOK_STATES_DIR_NAME + "/")):
+        loaded_state = storage.load(state_key)
+        if loaded_state is None:
+            continue
+        hook_state: HookState = loaded_state[0]
+        updated = False
+        for arg_state in hook_state.arg_states.values():
+            # The other references are only compared, never loaded
+            if arg_state.result_lookup_reference in result_references:
+                arg_state.result_lookup_reference = None
+                updated = True
+        if updated:
+            storage.save(state_key, hook_state)
+            num_updated += 1
+    return num_updated
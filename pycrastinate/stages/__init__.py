@@ -1,2 +1,11 @@
 from .stage import stage, Stage
-from .result import R, Invocation, PersistedInvocation, DataArg, ResultArg, FuncArg
+from .planning import ExecutionPlan, PlanNode
+from .result import (
+    R,
+    Invocation,
+    LazyArgs,
+    PersistedInvocation,
+    DataArg,
+    ResultArg,
+    FuncArg,
+)
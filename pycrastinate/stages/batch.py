@@ -0,0 +1,201 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import replace
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TYPE_CHECKING,
+)
+import functools
+
+from ..args import Args, merge_args
+from ..config import get_keying_mode, get_max_parallelism, KEYING_BY_REFERENCE
+from ..utils.hashing import compute_args_hash
+from .execution import (
+    ExecutionData,
+    PendingDependency,
+    compute_stage_hash,
+    get_dependency_values,
+    prepare_reference_execution,
+    to_execution_data,
+)
+from .concurrency import submit_in_context
+from .memo import copy_run_context
+from .persistence import find_stage_results
+from .result import Invocation, R
+
+if TYPE_CHECKING:
+    from ..utils.arg_aggregation import ArgsAggregationResult
+    from .stage import Stage
+
+
+def map_stage(
+    stage: "Stage[R]",
+    args_list: List[Args],
+    max_workers: Optional[int] = None,
+) -> Iterator[Tuple[int, Invocation[R]]]:
+    """
+    Computes or loads the results of the stage for all arguments, and yields them
+    with the index of their arguments as they become available. The stage hashes
+    are computed up front, so that dependencies shared by several arguments are
+    resolved once and the cache is probed once. Cached results are loaded and
+    missing ones executed in parallel by up to max_workers threads, the loads are
+    submitted first.
+    """
+    if max_workers is None:
+        max_workers = get_max_parallelism()
+    if max_workers < 1:
+        raise ValueError("The number of workers must be positive")
+
+    # The batch is a single run, but a generator can't hold the memoized run in
+    # its caller's context
+    run_context = copy_run_context()
+    pool = ThreadPoolExecutor(max_workers, thread_name_prefix="pycrastinate-map")
+    try:
+        indices, futures = run_context.run(_start_batch, pool, stage, args_list)
+        pending_futures: Set["Future[Tuple[bytes, Invocation[R]]]"] = set(futures)
+        while len(pending_futures) > 0:
+            done_futures, pending_futures = wait(
+                pending_futures, return_when=FIRST_COMPLETED
+            )
+            for future in done_futures:
+                _, result = future.result()
+                for index in indices[futures[future]]:
+                    yield index, result
+    finally:
+        # Also when the results aren't consumed completely
+        pool.shutdown(cancel_futures=True)
+
+
+def _start_batch(
+    pool: ThreadPoolExecutor,
+    stage: "Stage[R]",
+    args_list: List[Args],
+) -> Tuple[
+    Dict[bytes, List[int]],
+    Dict["Future[Tuple[bytes, Invocation[R]]]", bytes],
+]:
+    aggregated_args = [stage.argument_plan.aggregate(args) for args in args_list]
+    if get_keying_mode() == KEYING_BY_REFERENCE:
+        exec_data = [
+            prepare_reference_execution(aggregated) for aggregated in aggregated_args
+        ]
+    else:
+        exec_data = _prepare_executions(pool, aggregated_args)
+    stage_hashes = [compute_stage_hash(stage.stage_func, data) for data in exec_data]
+
+    # Arguments with the same stage hash share their result
+    indices: Dict[bytes, List[int]] = {}
+    for index, stage_hash in enumerate(stage_hashes):
+        indices.setdefault(stage_hash, []).append(index)
+    cached_hashes = find_stage_results(stage.cache_dir, set(indices.keys()))
+    # Cached results are loaded while the dependencies of the missing ones are
+    # resolved
+    futures = {
+        submit_in_context(
+            pool,
+            stage.exec_or_load_prepared,
+            exec_data[indices[stage_hash][0]],
+            stage_hash,
+        ): stage_hash
+        for stage_hash in cached_hashes
+    }
+    missing_exec_data = _resolve_shared_pending_dependencies(pool, {
+        stage_hash: exec_data[hash_indices[0]]
+        for stage_hash, hash_indices in indices.items()
+        if stage_hash not in cached_hashes
+    })
+
+    futures.update({
+        submit_in_context(
+            pool, stage.exec_or_load_prepared, missing_data, stage_hash
+        ): stage_hash
+        for stage_hash, missing_data in missing_exec_data.items()
+    })
+    return indices, futures
+
+
+def _prepare_executions(
+    pool: ThreadPoolExecutor,
+    aggregated_args: List["ArgsAggregationResult"],
+) -> List[ExecutionData]:
+    # Dependencies with the same stage and arguments are resolved once
+    dependency_keys: List[List[Hashable]] = []
+    dependency_tasks: Dict[Hashable, Callable[[], Any]] = {}
+    for aggregated in aggregated_args:
+        keys = []
+        for arg_name, dependency in aggregated.data_dependencies.items():
+            args = merge_args(
+                dependency.args, aggregated.data_dependency_args.get(arg_name, None)
+            )
+            key = (id(dependency.stage), compute_args_hash(args))
+            keys.append(key)
+            dependency_tasks.setdefault(
+                key, functools.partial(dependency.resolve, args=args)
+            )
+        dependency_keys.append(keys)
+
+    resolved_dependencies = dict(zip(
+        dependency_tasks.keys(), _run_all(pool, list(dependency_tasks.values()))
+    ))
+    return [
+        to_execution_data(
+            aggregated, [resolved_dependencies[key] for key in keys]
+        )
+        for aggregated, keys in zip(aggregated_args, dependency_keys)
+    ]
+
+
+def _resolve_shared_pending_dependencies(
+    pool: ThreadPoolExecutor,
+    exec_data: Dict[bytes, ExecutionData],
+) -> Dict[bytes, ExecutionData]:
+    # Dependencies of stages keyed by reference are only resolved for missing
+    # results, each of them once
+    pending_dependencies: Dict[bytes, PendingDependency] = {}
+    for data in exec_data.values():
+        for dependency in data.pending_dependencies.values():
+            pending_dependencies.setdefault(dependency.stage_hash, dependency)
+    if len(pending_dependencies) == 0:
+        return exec_data
+
+    resolved_dependencies = dict(zip(
+        pending_dependencies.keys(),
+        _run_all(pool, [
+            functools.partial(
+                dependency.stage.exec_or_load_prepared,
+                dependency.exec_data,
+                dependency.stage_hash,
+            )
+            for dependency in pending_dependencies.values()
+        ]),
+    ))
+    return {
+        stage_hash: replace(
+            data,
+            arg_values={
+                **data.arg_values,
+                **get_dependency_values(data, [
+                    resolved_dependencies[dependency.stage_hash]
+                    for dependency in data.pending_dependencies.values()
+                ]),
+            },
+            pending_dependencies={},
+        )
+        for stage_hash, data in exec_data.items()
+    }
+
+
+def _run_all(
+    pool: ThreadPoolExecutor, tasks: List[Callable[[], Any]]
+) -> List[Any]:
+    futures = [submit_in_context(pool, task) for task in tasks]
+    wait(futures)
+    # The error of the first failed task is raised, like by run_concurrently()
+    return [future.result() for future in futures]
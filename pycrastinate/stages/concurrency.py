@@ -0,0 +1,351 @@
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from datetime import datetime, timedelta
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+import asyncio
+import contextvars
+import importlib
+import inspect
+import mmap
+import multiprocessing
+import os
+import pickle
+import threading
+
+from ..config import (
+    EXECUTOR_THREAD,
+    Config,
+    get_config,
+    set_config,
+    get_max_parallelism,
+    get_out_of_band_min_size,
+)
+from ..utils.encoding import encode_with_buffers, decode
+
+
+T = TypeVar("T")
+
+# Where POSIX shared memory is backed by files, on Linux
+SHARED_MEMORY_DIR = Path("/dev/shm")
+
+# A thread pool and a semaphore counting its idle workers
+_ThreadPool = Tuple[ThreadPoolExecutor, threading.Semaphore]
+
+_pools_lock = threading.Lock()
+# Keyed by the pool size and the process id, pools can't be used after forking
+_thread_pools: Dict[Tuple[int, int], _ThreadPool] = {}
+_process_pools: Dict[Tuple[int, int], ProcessPoolExecutor] = {}
+
+
+def run_concurrently(tasks: List[Callable[[], T]]) -> List[T]:
+    """
+    Runs the tasks concurrently in the shared thread pool and returns their results
+    in the order of the tasks. Tasks are run in the calling thread if there are no
+    idle workers, so that tasks can run tasks themselves without exhausting the
+    pool. If tasks fail, the error of the first failed task is raised after all
+    tasks finished.
+    """
+    max_parallelism = get_max_parallelism()
+    if len(tasks) <= 1 or max_parallelism <= 1:
+        return [task() for task in tasks]
+
+    pool, idle_workers = _get_thread_pool(max_parallelism - 1)
+    futures: List[Optional["Future[T]"]] = []
+    for task in tasks[1:]:
+        if idle_workers.acquire(blocking=False):
+            futures.append(
+                submit_in_context(pool, _run_and_release, task, idle_workers)
+            )
+        else:
+            futures.append(None)
+
+    # Outcomes are pairs of whether the task failed and its result or error
+    inline_outcomes = [_run_inline(tasks[0])] + [
+        _run_inline(task) if future is None else None
+        for task, future in zip(tasks[1:], futures)
+    ]
+    wait([future for future in futures if future is not None])
+    outcomes = [inline_outcomes[0]] + [
+        _get_outcome(future) if future is not None else inline_outcome
+        for future, inline_outcome in zip(futures, inline_outcomes[1:])
+    ]
+
+    for failed, value in outcomes:
+        if failed:
+            raise value
+    return [value for _, value in outcomes]
+
+
+def submit_in_context(
+    pool: Executor, func: Callable[..., T], *args: Any
+) -> "Future[T]":
+    """
+    Submits the function to the pool to be called in a copy of the current context,
+    like tasks of asyncio, so that it shares the state of the run it's part of.
+    """
+    return pool.submit(contextvars.copy_context().run, func, *args)
+
+
+async def gather_concurrently(awaitables: List[Awaitable[T]]) -> List[T]:
+    """
+    Awaits the awaitables concurrently and returns their results in the order of
+    the awaitables. Like run_concurrently(), the error of the first failed
+    awaitable is raised after all of them finished.
+    """
+    if len(awaitables) == 1:
+        return [await awaitables[0]]
+    outcomes = await asyncio.gather(*awaitables, return_exceptions=True)
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            raise outcome
+    return outcomes
+
+
+def is_coroutine_function(func: Callable) -> bool:
+    # Decorators of coroutine functions usually return their coroutines as well
+    try:
+        return inspect.iscoroutinefunction(inspect.unwrap(func))
+    except ValueError:
+        return False
+
+
+def call_function(func: Callable[..., T], args: Dict[str, Any]) -> T:
+    """
+    Calls the function with the arguments. Coroutine functions are run to
+    completion in a new event loop, which is only possible if no event loop runs
+    in this thread.
+    """
+    result = func(**args)
+    if not inspect.iscoroutine(result):
+        return result
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(result)
+    result.close()
+    raise ValueError(
+        f"Coroutine function '{func.__qualname__}' can't be executed synchronously "
+        "in a running event loop, await 'acall()' of the stage instead"
+    )
+
+
+def exec_in_process(
+    func: Callable[..., T], args: Dict[str, Any]
+) -> Tuple[T, datetime, timedelta]:
+    """
+    Executes the function with the arguments in a worker process and returns its
+    result, and the start time and duration of the execution in the worker. The
+    function is looked up by its module and name in the worker, which imports the
+    module. Workers are reused across calls.
+    """
+    func_reference = get_func_reference(func)
+    # The worker resolves stages called by the function concurrently in threads,
+    # instead of starting worker processes of its own
+    worker_config = get_config()
+    worker_config.executor = EXECUTOR_THREAD
+    pool = _get_process_pool(get_max_parallelism())
+    encoded_result, shared_buffers, start_time, execution_duration = pool.submit(
+        _exec_in_worker, func_reference, args, worker_config
+    ).result()
+    return (
+        decode(encoded_result, _receive_buffers(shared_buffers)),
+        start_time,
+        execution_duration,
+    )
+
+
+def get_func_reference(func: Callable) -> Tuple[str, str]:
+    """
+    Returns the module and qualified name of a stage function, which must be
+    defined at module level, either decorated as stage or not.
+    """
+    from .stage import Stage
+
+    module_name = func.__module__
+    func_name = func.__qualname__
+    module = importlib.import_module(module_name)
+    found_func = getattr(module, func_name, None)
+    if isinstance(found_func, Stage):
+        found_func = found_func.stage_func
+    if found_func is not func:
+        raise ValueError(
+            f"Function '{module_name}.{func_name}' must be defined at module level "
+            "to be executed in a worker process"
+        )
+    return module_name, func_name
+
+
+def _exec_in_worker(
+    func_reference: Tuple[str, str],
+    args: Dict[str, Any],
+    worker_config: Config,
+) -> Tuple[bytes, List[Tuple[str, int]], datetime, timedelta]:
+    from .stage import Stage
+
+    set_config(worker_config)
+    module_name, func_name = func_reference
+    func = getattr(importlib.import_module(module_name), func_name)
+    if isinstance(func, Stage):
+        func = func.stage_func
+
+    start_time = datetime.now()
+    result = call_function(func, args)
+    execution_duration = datetime.now() - start_time
+
+    # Large buffers (e.g. of numpy arrays) are passed in shared memory instead of
+    # being sent through the pipe of the pool
+    encoded_result, buffers = encode_with_buffers(
+        result, get_out_of_band_min_size()
+    )
+    shared_buffers: List[Tuple[str, int]] = []
+    try:
+        for buffer in buffers:
+            shared_buffers.append(_share_buffer(buffer))
+    except BaseException:
+        _remove_shared_buffers(shared_buffers)
+        raise
+    return encoded_result, shared_buffers, start_time, execution_duration
+
+
+def _share_buffer(buffer: pickle.PickleBuffer) -> Tuple[str, int]:
+    raw_buffer = buffer.raw()
+    shared_memory = SharedMemory(create=True, size=max(raw_buffer.nbytes, 1))
+    try:
+        shared_memory.buf[:raw_buffer.nbytes] = raw_buffer
+    except BaseException:
+        shared_memory.close()
+        shared_memory.unlink()
+        raise
+    # The receiving process removes the shared memory, the worker must not remove it
+    # when it exits
+    _unregister_shared_memory(shared_memory)
+    shared_memory.close()
+    return shared_memory.name, raw_buffer.nbytes
+
+
+def _receive_buffers(shared_buffers: List[Tuple[str, int]]) -> List[memoryview]:
+    """
+    Maps the shared memory of the buffers instead of copying it where it's backed
+    by files, so the decoded result refers to it. The shared memory is removed right
+    away, and unmapped when the last view of it is released.
+    """
+    buffers = []
+    for buffer_idx, (name, size) in enumerate(shared_buffers):
+        try:
+            buffers.append(_receive_buffer(name, size))
+        except BaseException:
+            _remove_shared_buffers(shared_buffers[buffer_idx + 1:])
+            raise
+    return buffers
+
+
+def _receive_buffer(name: str, size: int) -> memoryview:
+    if SHARED_MEMORY_DIR.is_dir():
+        shared_memory_path = SHARED_MEMORY_DIR / name.lstrip("/")
+        try:
+            with open(shared_memory_path, "r+b") as file:
+                # The mapping is owned by the views of it, and stays valid after
+                # the file is removed
+                return memoryview(mmap.mmap(file.fileno(), 0))[:size]
+        finally:
+            shared_memory_path.unlink(missing_ok=True)
+    shared_memory = SharedMemory(name=name)
+    try:
+        return memoryview(bytearray(shared_memory.buf[:size]))
+    finally:
+        shared_memory.close()
+        shared_memory.unlink()
+
+
+def _remove_shared_buffers(shared_buffers: List[Tuple[str, int]]) -> None:
+    for name, _ in shared_buffers:
+        try:
+            shared_memory = SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+        shared_memory.close()
+        shared_memory.unlink()
+
+
+def _unregister_shared_memory(shared_memory: SharedMemory) -> None:
+    # Before Python 3.13, shared memory can't be created without being tracked
+    try:
+        from multiprocessing import resource_tracker
+
+        # The tracker registers POSIX shared memory by its name with a leading "/"
+        name = "/" + shared_memory.name if os.name == "posix" else shared_memory.name
+        resource_tracker.unregister(name, "shared_memory")
+    except (ImportError, AttributeError):
+        pass
+
+
+def _run_inline(task: Callable[[], T]) -> Tuple[bool, Any]:
+    try:
+        return False, task()
+    except Exception as error:
+        return True, error
+
+
+def _get_outcome(future: "Future[T]") -> Tuple[bool, Any]:
+    error = future.exception()
+    if error is not None:
+        return True, error
+    return False, future.result()
+
+
+def _run_and_release(
+    task: Callable[[], T], idle_workers: threading.Semaphore
+) -> T:
+    try:
+        return task()
+    finally:
+        idle_workers.release()
+
+
+def _get_thread_pool(num_workers: int) -> _ThreadPool:
+    pool_key = (num_workers, os.getpid())
+    thread_pool = _thread_pools.get(pool_key, None)
+    if thread_pool is None:
+        with _pools_lock:
+            thread_pool = _thread_pools.get(pool_key, None)
+            if thread_pool is None:
+                thread_pool = (
+                    ThreadPoolExecutor(
+                        num_workers, thread_name_prefix="pycrastinate-worker"
+                    ),
+                    threading.Semaphore(num_workers),
+                )
+                _thread_pools[pool_key] = thread_pool
+    return thread_pool
+
+
+def _get_process_pool(num_workers: int) -> ProcessPoolExecutor:
+    pool_key = (num_workers, os.getpid())
+    process_pool = _process_pools.get(pool_key, None)
+    if process_pool is None:
+        with _pools_lock:
+            process_pool = _process_pools.get(pool_key, None)
+            if process_pool is None:
+                # Forking a process with running threads isn't safe
+                process_pool = ProcessPoolExecutor(
+                    num_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+                _process_pools[pool_key] = process_pool
+    return process_pool
@@ -1,28 +1,64 @@
 from datetime import datetime
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import (
     Any,
     Callable,
     Dict,
+    Hashable,
+    List,
+    Optional,
     Tuple,
     Union,
     TYPE_CHECKING,
 )
+import asyncio
+import functools
+import inspect
 
 from ..args import merge_args
+from ..config import (
+    EXECUTOR_PROCESS,
+    ExecutorLiteral,
+    get_executor,
+    get_single_flight_enabled,
+)
 from ..utils.hashing import (
     compute_value_hash,
     compute_code_hash,
     compute_function_dependency_hashes,
 )
-from ..utils.functions import get_arg_default_values
 from ..logging import log_stage_exec
-from .persistence import load_stage_result, save_stage_result
-from .result import Invocation, PersistedInvocation, R, DataArg, ResultArg, FuncArg
+from ..utils.functions import get_full_func_name
+from .index import (
+    ARG_KIND_DATA,
+    ARG_KIND_FUNCTION,
+    ARG_KIND_RESULT,
+    IndexedArg,
+)
+from .persistence import load_stage_result, save_stage_result, add_result_hash
+from .memo import HASH_MEMO_KEY, get_memo_key, get_run_memo
+from .single_flight import single_flight, async_single_flight
+from .concurrency import (
+    call_function,
+    exec_in_process,
+    gather_concurrently,
+    is_coroutine_function,
+    run_concurrently,
+)
+from .result import (
+    Invocation,
+    LazyArgs,
+    PersistedInvocation,
+    R,
+    DataArg,
+    ResultArg,
+    FuncArg,
+)
 
 if TYPE_CHECKING:
-    from ..utils.arg_aggregation import ArgsAggregationResult
+    from ..utils.arg_aggregation import ArgsAggregationResult, ArgumentPlan
+    from .stage import Stage
 
 
 @dataclass
@@ -32,26 +68,77 @@ class ExecutionData:
     data_dependency_hashes: Dict[str, bytes]
     function_dependency_hashes: Dict[str, bytes]
     result_reference_hashes: Dict[str, bytes]
+    # Data dependencies that are only resolved if the stage needs to be executed.
+    # This is the case when stages are keyed by reference.
+    pending_dependencies: Dict[str, "PendingDependency"] = field(
+        default_factory=dict
+    )
+
+
+@dataclass
+class PendingDependency:
+    stage: "Stage"
+    with_metadata: bool
+    stage_hash: bytes
+    exec_data: ExecutionData
 
 
 def prepare_execution(
     aggregated_args: "ArgsAggregationResult",
+) -> ExecutionData:
+    # Independent dependencies are resolved concurrently, the results are processed
+    # in the order of the arguments
+    resolved_dependencies = run_concurrently([
+        functools.partial(
+            dependency.resolve,
+            args=merge_args(
+                dependency.args,
+                aggregated_args.data_dependency_args.get(arg_name, None),
+            ),
+        )
+        for arg_name, dependency in aggregated_args.data_dependencies.items()
+    ])
+    return to_execution_data(aggregated_args, resolved_dependencies)
+
+
+async def aprepare_execution(
+    aggregated_args: "ArgsAggregationResult",
+) -> ExecutionData:
+    resolved_dependencies = await gather_concurrently([
+        dependency.aresolve(
+            args=merge_args(
+                dependency.args,
+                aggregated_args.data_dependency_args.get(arg_name, None),
+            ),
+        )
+        for arg_name, dependency in aggregated_args.data_dependencies.items()
+    ])
+    # Hashing the arguments may take a while
+    return await asyncio.to_thread(
+        to_execution_data, aggregated_args, resolved_dependencies
+    )
+
+
+def to_execution_data(
+    aggregated_args: "ArgsAggregationResult",
+    resolved_dependencies: List[Tuple[bytes, Invocation]],
 ) -> ExecutionData:
     data_dependency_results = {}
     data_dependency_hashes  = {}
     result_reference_hashes = {}
-    for arg_name, dependency in aggregated_args.data_dependencies.items():
-        passed_args = aggregated_args.data_dependency_args.get(arg_name, None)
-        merged_args = merge_args(dependency.args, passed_args)
-        dependency_hash, dependency_result = dependency.resolve(args=merged_args)
-
+    for (arg_name, dependency), (dependency_hash, dependency_result) in zip(
+        aggregated_args.data_dependencies.items(), resolved_dependencies
+    ):
         if dependency.with_metadata:
             data_dependency_results[arg_name] = dependency_result
         else:
             data_dependency_results[arg_name] = dependency_result.result
 
-        data_dependency_hashes[arg_name] = compute_value_hash(
-            dependency_result.result
+        # Use the digest stored with the result to avoid hashing the value again
+        data_dependency_hashes[arg_name] = (
+            dependency_result.result_hash
+            if dependency_result.result_hash is not None
+            else compute_value_hash(dependency_result.result)
         )
         result_reference_hashes[arg_name] = dependency_hash
 
@@ -61,11 +148,7 @@ def prepare_execution(
         **data_dependency_results,
     }
 
-    non_dependency_hashes = {
-        arg_name: compute_value_hash(arg_value)
-        for arg_name, arg_value
-        in aggregated_args.non_dependency_args.items()
-    }
+    non_dependency_hashes = aggregated_args.compute_non_dependency_hashes()
     function_dependency_hashes = compute_function_dependency_hashes(
         aggregated_args.func_dependencies
     )
@@ -75,99 +158,424 @@ def prepare_execution(
         non_dependency_hashes=non_dependency_hashes,
         data_dependency_hashes=data_dependency_hashes,
         function_dependency_hashes=function_dependency_hashes,
-        result_reference_hashes=data_dependency_hashes,
+        result_reference_hashes=result_reference_hashes,
     )
 
 
-def exec_or_load(
-    func: Callable[..., R],
-    exec_data: ExecutionData,
-    results_dir: Path,
-) -> Tuple[bytes, Invocation[R]]:
+def prepare_reference_execution(
+    aggregated_args: "ArgsAggregationResult",
+    prepared_dependencies: Optional[
+        Dict[Hashable, Tuple[bytes, ExecutionData]]
+    ] = None,
+) -> ExecutionData:
+    """
+    Prepares the execution of a stage that is keyed by the reference hashes of its
+    data dependencies. These hashes only depend on the code and arguments of the
+    dependencies, so they can be computed without loading or executing anything.
+    Dependencies that several stages depend on are prepared once.
+    """
+    if prepared_dependencies is None:
+        prepared_dependencies = {}
+    pending_dependencies = {}
+    for arg_name, dependency in aggregated_args.data_dependencies.items():
+        passed_args = aggregated_args.data_dependency_args.get(arg_name, None)
+        merged_args = merge_args(dependency.args, passed_args)
+        dependency_stage = dependency.stage
+        dependency_args = dependency_stage.argument_plan.aggregate(merged_args)
+        memo_key = get_memo_key(dependency_stage, dependency_args)
+        prepared_dependency = prepared_dependencies.get(memo_key, None)
+        if prepared_dependency is None:
+            dependency_exec_data = prepare_reference_execution(
+                dependency_args, prepared_dependencies
+            )
+            dependency_hash = compute_stage_hash(
+                dependency_stage.stage_func, dependency_exec_data
+            )
+            prepared_dependency = (dependency_hash, dependency_exec_data)
+            prepared_dependencies[memo_key] = prepared_dependency
+
+        pending_dependencies[arg_name] = PendingDependency(
+            stage=dependency_stage,
+            with_metadata=dependency.with_metadata,
+            stage_hash=prepared_dependency[0],
+            exec_data=prepared_dependency[1],
+        )
+    return to_reference_execution_data(aggregated_args, pending_dependencies)
+
+
+def to_reference_execution_data(
+    aggregated_args: "ArgsAggregationResult",
+    pending_dependencies: Dict[str, PendingDependency],
+) -> ExecutionData:
+    result_reference_hashes = {
+        arg_name: dependency.stage_hash
+        for arg_name, dependency in pending_dependencies.items()
+    }
+    return ExecutionData(
+        arg_values={
+            **aggregated_args.non_dependency_args,
+            **aggregated_args.func_dependencies,
+        },
+        non_dependency_hashes=aggregated_args.compute_non_dependency_hashes(),
+        data_dependency_hashes=result_reference_hashes,
+        function_dependency_hashes=compute_function_dependency_hashes(
+            aggregated_args.func_dependencies
+        ),
+        result_reference_hashes=result_reference_hashes,
+        pending_dependencies=pending_dependencies,
+    )
+
+
+def compute_stage_hash(func: Callable, exec_data: ExecutionData) -> bytes:
     arg_hashes = {
         **exec_data.non_dependency_hashes,
         **exec_data.data_dependency_hashes,
         **exec_data.function_dependency_hashes,
     }
     code_hash = compute_code_hash(func)
-    stage_hash = compute_value_hash((code_hash, arg_hashes))
+    return compute_value_hash((code_hash, arg_hashes))
+
+
+def exec_or_load(
+    func: Callable[..., R],
+    exec_data: ExecutionData,
+    results_dir: Path,
+    stage_hash: Optional[bytes] = None,
+    compression: Optional[str] = None,
+    executor: Optional[ExecutorLiteral] = None,
+) -> Tuple[bytes, Invocation[R]]:
+    if stage_hash is None:
+        stage_hash = compute_stage_hash(func, exec_data)
 
+    result = _load_invocation(func, exec_data, results_dir, stage_hash, compression)
+    if result is None and get_single_flight_enabled():
+        with single_flight(results_dir, stage_hash):
+            # Another thread or process may have executed the stage in the meantime
+            result = _load_invocation(
+                func, exec_data, results_dir, stage_hash, compression
+            )
+            if result is None:
+                result = _exec_and_save(
+                    func, exec_data, results_dir, stage_hash, compression, executor
+                )
+    elif result is None:
+        result = _exec_and_save(
+            func, exec_data, results_dir, stage_hash, compression, executor
+        )
+    return stage_hash, result
+
+
+async def aexec_or_load(
+    func: Callable[..., R],
+    exec_data: ExecutionData,
+    results_dir: Path,
+    stage_hash: Optional[bytes] = None,
+    compression: Optional[str] = None,
+    executor: Optional[ExecutorLiteral] = None,
+) -> Tuple[bytes, Invocation[R]]:
+    """
+    Like exec_or_load(), but awaitable. Loading, hashing and persisting are done in
+    threads, and coroutine functions are executed on the running event loop.
+    """
+    if stage_hash is None:
+        stage_hash = await asyncio.to_thread(compute_stage_hash, func, exec_data)
+
+    load_invocation = functools.partial(
+        _load_invocation, func, exec_data, results_dir, stage_hash, compression
+    )
+    result = await asyncio.to_thread(load_invocation)
+    if result is None and get_single_flight_enabled():
+        async with async_single_flight(results_dir, stage_hash):
+            result = await asyncio.to_thread(load_invocation)
+            if result is None:
+                result = await _aexec_and_save(
+                    func, exec_data, results_dir, stage_hash, compression, executor
+                )
+    elif result is None:
+        result = await _aexec_and_save(
+            func, exec_data, results_dir, stage_hash, compression, executor
+        )
+    return stage_hash, result
+
+
+def _load_invocation(
+    func: Callable[..., R],
+    exec_data: ExecutionData,
+    results_dir: Path,
+    stage_hash: bytes,
+    compression: Optional[str],
+) -> Optional[Invocation[R]]:
     cached_result = load_stage_result(results_dir, stage_hash)
-    arg_values = exec_data.arg_values
-    log_stage_exec(func, cached_result is None)
-
-    if cached_result is not None:
-        result = Invocation(
-            result=cached_result.result,
-            args=arg_values,
-            start_time=cached_result.start_time,
-            execution_duration=cached_result.execution_duration,
+    if cached_result is None:
+        return None
+    log_stage_exec(func, False)
+
+    if cached_result.result_hash is None:
+        # Results persisted by older versions don't store their hash yet
+        cached_result = add_result_hash(
+            results_dir,
+            stage_hash,
+            cached_result,
+            compression,
+            stage_name=get_full_func_name(func),
+            arg_hashes=_get_indexed_arg_hashes(exec_data),
         )
+    return Invocation(
+        result=cached_result.result,
+        args=_get_lazy_dependency_args(exec_data.arg_values, exec_data),
+        start_time=cached_result.start_time,
+        execution_duration=cached_result.execution_duration,
+        result_hash=cached_result.result_hash,
+    )
+
+
+def _exec_and_save(
+    func: Callable[..., R],
+    exec_data: ExecutionData,
+    results_dir: Path,
+    stage_hash: bytes,
+    compression: Optional[str],
+    executor: Optional[ExecutorLiteral],
+) -> Invocation[R]:
+    log_stage_exec(func, True)
+    arg_values = {
+        **exec_data.arg_values, **_resolve_pending_dependencies(exec_data)
+    }
+    result = exec_to_result(func, arg_values, executor)
+    _save_invocation(
+        func, exec_data, arg_values, result, results_dir, stage_hash, compression
+    )
+    return result
+
+
+async def _aexec_and_save(
+    func: Callable[..., R],
+    exec_data: ExecutionData,
+    results_dir: Path,
+    stage_hash: bytes,
+    compression: Optional[str],
+    executor: Optional[ExecutorLiteral],
+) -> Invocation[R]:
+    log_stage_exec(func, True)
+    arg_values = {
+        **exec_data.arg_values, **await _aresolve_pending_dependencies(exec_data)
+    }
+    if executor is None:
+        executor = get_executor()
+    if executor != EXECUTOR_PROCESS and is_coroutine_function(func):
+        result = await aexec_to_result(func, arg_values)
     else:
-        result = exec_to_result(func, arg_values)
-        data_args = {
-            arg_name: DataArg(arg_values[arg_name])
-            for arg_name in exec_data.non_dependency_hashes.keys()
-        }
-        result_args = {
-            arg_name: ResultArg(result_reference_hash)
-            for arg_name, result_reference_hash
-            in exec_data.result_reference_hashes.items()
-        }
-        function_args = {
-            arg_name: FuncArg(func_hash)
-            for arg_name, func_hash in exec_data.function_dependency_hashes.items()
-        }
-        persisted_args = {
-            **data_args,
-            **result_args,
-            **function_args,
-        }
-        if stage_hash is not None:
-            persisted_result = PersistedInvocation(
-                result.result,
-                args=persisted_args,
-                code_hash=code_hash,
-                start_time=result.start_time,
-                execution_duration=result.execution_duration,
+        result = await asyncio.to_thread(exec_to_result, func, arg_values, executor)
+    await asyncio.to_thread(
+        _save_invocation,
+        func,
+        exec_data,
+        arg_values,
+        result,
+        results_dir,
+        stage_hash,
+        compression,
+    )
+    return result
+
+
+def _save_invocation(
+    func: Callable[..., R],
+    exec_data: ExecutionData,
+    arg_values: Dict[str, Any],
+    result: Invocation[R],
+    results_dir: Path,
+    stage_hash: bytes,
+    compression: Optional[str],
+) -> None:
+    result.result_hash = compute_value_hash(result.result)
+    data_args = {
+        arg_name: DataArg(arg_values[arg_name])
+        for arg_name in exec_data.non_dependency_hashes.keys()
+    }
+    result_args = {
+        arg_name: ResultArg(result_reference_hash)
+        for arg_name, result_reference_hash
+        in exec_data.result_reference_hashes.items()
+    }
+    function_args = {
+        arg_name: FuncArg(func_hash)
+        for arg_name, func_hash in exec_data.function_dependency_hashes.items()
+    }
+    persisted_args = {
+        **data_args,
+        **result_args,
+        **function_args,
+    }
+    persisted_result = PersistedInvocation(
+        result.result,
+        args=persisted_args,
+        code_hash=compute_code_hash(func),
+        start_time=result.start_time,
+        execution_duration=result.execution_duration,
+        result_hash=result.result_hash,
+    )
+    save_stage_result(
+        results_dir,
+        stage_hash,
+        persisted_result,
+        compression,
+        stage_name=get_full_func_name(func),
+        arg_hashes=_get_indexed_arg_hashes(exec_data),
+    )
+
+
+def _get_indexed_arg_hashes(exec_data: ExecutionData) -> Dict[str, IndexedArg]:
+    return {
+        **{
+            arg_name: IndexedArg(ARG_KIND_DATA, arg_hash)
+            for arg_name, arg_hash in exec_data.non_dependency_hashes.items()
+        },
+        **{
+            arg_name: IndexedArg(ARG_KIND_RESULT, arg_hash)
+            for arg_name, arg_hash in exec_data.result_reference_hashes.items()
+        },
+        **{
+            arg_name: IndexedArg(ARG_KIND_FUNCTION, arg_hash)
+            for arg_name, arg_hash in exec_data.function_dependency_hashes.items()
+        },
+    }
+
+
+def _resolve_pending_dependencies(exec_data: ExecutionData) -> Dict[str, Any]:
+    memo = get_run_memo()
+    tasks = []
+    for dependency in exec_data.pending_dependencies.values():
+        task = functools.partial(
+            dependency.stage.exec_or_load_prepared,
+            dependency.exec_data,
+            dependency.stage_hash,
+        )
+        if memo is not None:
+            task = functools.partial(
+                memo.resolve, _get_memo_key(dependency), task
             )
-            save_stage_result(results_dir, stage_hash, persisted_result)
+        tasks.append(task)
+    resolved_dependencies = run_concurrently(tasks)
+    return get_dependency_values(exec_data, resolved_dependencies)
 
-    return stage_hash, result
+
+async def _aresolve_pending_dependencies(
+    exec_data: ExecutionData,
+) -> Dict[str, Any]:
+    memo = get_run_memo()
+    awaitables = []
+    for dependency in exec_data.pending_dependencies.values():
+        resolve = functools.partial(
+            dependency.stage.aexec_or_load_prepared,
+            dependency.exec_data,
+            dependency.stage_hash,
+        )
+        awaitables.append(
+            resolve() if memo is None
+            else memo.aresolve(_get_memo_key(dependency), resolve)
+        )
+    resolved_dependencies = await gather_concurrently(awaitables)
+    return get_dependency_values(exec_data, resolved_dependencies)
+
+
+def _get_memo_key(dependency: PendingDependency) -> Hashable:
+    return (id(dependency.stage), HASH_MEMO_KEY, dependency.stage_hash)
+
+
+def get_dependency_values(
+    exec_data: ExecutionData,
+    resolved_dependencies: List[Tuple[bytes, Invocation]],
+) -> Dict[str, Any]:
+    dependency_values = {}
+    for (arg_name, dependency), (_, dependency_result) in zip(
+        exec_data.pending_dependencies.items(), resolved_dependencies
+    ):
+        dependency_values[arg_name] = (
+            dependency_result if dependency.with_metadata
+            else dependency_result.result
+        )
+    return dependency_values
+
+
+def _get_lazy_dependency_args(
+    arg_values: Dict[str, Any],
+    exec_data: ExecutionData,
+) -> Union[Dict[str, Any], LazyArgs]:
+    if len(exec_data.pending_dependencies) == 0:
+        return arg_values
+    return LazyArgs(arg_values, {
+        arg_name: functools.partial(
+            dependency.stage.load_result,
+            dependency.stage_hash,
+            with_metadata=dependency.with_metadata,
+        )
+        for arg_name, dependency in exec_data.pending_dependencies.items()
+    })
 
 
 def exec_to_result(
     func: Callable[..., R],
     args: Dict[str, bytes],
+    executor: Optional[ExecutorLiteral] = None,
+) -> Invocation[R]:
+    if executor is None:
+        executor = get_executor()
+    if executor == EXECUTOR_PROCESS:
+        # Timed in the worker, without the time for sending the arguments and result
+        result_data, start_time, execution_duration = exec_in_process(func, args)
+    else:
+        start_time = datetime.now()
+        result_data = call_function(func, args)
+        execution_duration = datetime.now() - start_time
+
+    return Invocation(
+        result=result_data,
+        args=args,
+        start_time=start_time,
+        execution_duration=execution_duration,
+    )
+
+
+async def aexec_to_result(
+    func: Callable[..., R],
+    args: Dict[str, bytes],
 ) -> Invocation[R]:
     start_time = datetime.now()
-    # TODO: submit to a task queue/dict by hash and skip execution if someone
-    # else is already doing it
     result_data = func(**args)
-    end_time = datetime.now()
+    if inspect.isawaitable(result_data):
+        result_data = await result_data
+    execution_duration = datetime.now() - start_time
 
     return Invocation(
         result=result_data,
         args=args,
         start_time=start_time,
-        execution_duration=(end_time - start_time)
+        execution_duration=execution_duration,
     )
 
 
 def load_from_reference(
-    stage_func: Callable[..., R],
+    argument_plan: "ArgumentPlan",
     reference_hash: bytes,
     results_dir: Path,
     with_metadata: bool,
 ) -> Union[R, Invocation[R]]:
     cached_result = load_stage_result(results_dir, reference_hash)
+    if cached_result is None:
+        # E.g. removed by the garbage collection
+        raise ValueError(
+            f"The result '{reference_hash.hex()}' isn't in the cache anymore"
+        )
     if not with_metadata:
         return cached_result.result
 
     from ..dependencies import ResultDependency, FunctionDependency
 
-    default_values = get_arg_default_values(stage_func)
+    default_values = argument_plan.default_values
     arg_values = {}
+    # The results of data dependencies are only loaded when they are accessed
+    arg_loaders = {}
     for arg_name, persisted_arg in cached_result.args.items():
         if isinstance(persisted_arg, DataArg):
             arg_values[arg_name] = persisted_arg.data
@@ -179,10 +587,11 @@ def load_from_reference(
                     "dependency (UseRes()), but this is required to load the cached "
                     "result for this stage."
                 )
-            arg_value = arg_dependency.stage.load_result(
-                persisted_arg.reference_hash, with_metadata=False
+            arg_loaders[arg_name] = functools.partial(
+                arg_dependency.stage.load_result,
+                persisted_arg.reference_hash,
+                with_metadata=False,
             )
-            arg_values[arg_name] = arg_value
         elif isinstance(persisted_arg, FuncArg):
             arg_dependency = default_values[arg_name]
             if not isinstance(arg_dependency, FunctionDependency):
@@ -202,7 +611,8 @@ def load_from_reference(
     # used to load the data (the reference hash)?
     return Invocation(
         result=cached_result.result,
-        args=arg_values,
+        args=LazyArgs(arg_values, arg_loaders) if arg_loaders else arg_values,
         start_time=cached_result.start_time,
         execution_duration=cached_result.execution_duration,
+        result_hash=cached_result.result_hash,
     )
@@ -0,0 +1,411 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from ..config import StorageLiteral, get_storage_backend
+from ..storage import StorageBackend, MemoryStorage, get_storage
+from .result import PersistedInvocation
+
+
+# The cache index is a SQLite database next to the stage results. It stores the
+# metadata of all persisted invocations, so that tools can query it without
+# loading the results. An in-memory snapshot of the indexed stage hashes answers
+# existence checks without touching the file system. Results saved while the index
+# is disabled leave a marker in the storage, and are indexed when the index is
+# opened the next time. Processes that opened the index before don't see them.
+
+INDEX_FILE_NAME = "index.sqlite3"
+UNINDEXED_RESULTS_KEY = "unindexed_results"
+INDEX_SCHEMA_VERSION = 1
+
+ARG_KIND_DATA = "data"
+ARG_KIND_RESULT = "result"
+ARG_KIND_FUNCTION = "function"
+
+# Access times are written in batches
+MAX_PENDING_ACCESSES = 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS invocations (
+    -- Ids are never reused, which allows reading only new rows into the snapshot
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stage_hash BLOB NOT NULL UNIQUE,
+    stage_name TEXT,
+    code_hash BLOB,
+    start_time REAL,
+    execution_duration REAL,
+    payload_size INTEGER,
+    last_access_time REAL
+);
+CREATE INDEX IF NOT EXISTS invocations_by_stage_name ON invocations (stage_name);
+CREATE TABLE IF NOT EXISTS invocation_args (
+    stage_hash BLOB,
+    arg_name TEXT,
+    arg_kind TEXT,
+    arg_hash BLOB,
+    PRIMARY KEY (stage_hash, arg_name)
+) WITHOUT ROWID;
+"""
+_INVOCATION_COLUMNS = (
+    "stage_hash, stage_name, code_hash, start_time, execution_duration, "
+    "payload_size, last_access_time"
+)
+
+
+@dataclass
+class IndexedArg:
+    kind: str
+    hash: bytes
+
+
+@dataclass
+class IndexedInvocation:
+    stage_hash: bytes
+    # Results that were persisted before the index existed only have a stage hash
+    # and a payload size
+    stage_name: Optional[str]
+    code_hash: Optional[bytes]
+    args: Dict[str, IndexedArg]
+    start_time: Optional[datetime]
+    execution_duration: Optional[timedelta]
+    payload_size: int
+    last_access_time: Optional[datetime]
+
+
+class CacheIndex:
+    def __init__(
+        self,
+        results_dir: Path,
+        storage: Optional[StorageBackend] = None,
+    ) -> None:
+        self.results_dir = results_dir
+        self._lock = threading.Lock()
+        self._storage = storage if storage is not None else get_storage(results_dir)
+        self._connection = _connect(results_dir, self._storage)
+        self._stage_hashes: Set[bytes] = set()
+        self._max_id = 0
+        self._data_version: Optional[int] = None
+        self._pending_accesses: Dict[bytes, float] = {}
+        if self._storage.exists(UNINDEXED_RESULTS_KEY):
+            # Removed first, so that results saved meanwhile mark the index again
+            self._storage.delete(UNINDEXED_RESULTS_KEY)
+            self.index_stored_results()
+
+    def contains(self, stage_hash: bytes) -> bool:
+        """
+        Returns whether a result with the stage hash was indexed. Results indexed
+        by other processes are picked up when their transaction was committed.
+        """
+        # Positives don't need a fresh snapshot, results are rarely removed
+        if stage_hash in self._stage_hashes:
+            return True
+        with self._lock:
+            self._refresh_snapshot()
+            return stage_hash in self._stage_hashes
+
+    def filter_contained(self, stage_hashes: Set[bytes]) -> Set[bytes]:
+        """
+        Returns the stage hashes of which results were indexed, refreshing the
+        snapshot at most once.
+        """
+        contained_hashes = stage_hashes & self._stage_hashes
+        if len(contained_hashes) == len(stage_hashes):
+            return contained_hashes
+        with self._lock:
+            self._refresh_snapshot()
+            return stage_hashes & self._stage_hashes
+
+    def record_invocation(
+        self,
+        stage_hash: bytes,
+        stage_name: Optional[str],
+        result: PersistedInvocation,
+        arg_hashes: Dict[str, IndexedArg],
+        payload_size: int,
+    ) -> None:
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO invocations ({_INVOCATION_COLUMNS}) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    stage_hash,
+                    stage_name,
+                    result.code_hash,
+                    result.start_time.timestamp(),
+                    result.execution_duration.total_seconds(),
+                    payload_size,
+                    now,
+                ),
+            )
+            self._connection.execute(
+                "DELETE FROM invocation_args WHERE stage_hash = ?", (stage_hash,)
+            )
+            self._connection.executemany(
+                "INSERT INTO invocation_args VALUES (?, ?, ?, ?)",
+                [
+                    (stage_hash, arg_name, arg.kind, arg.hash)
+                    for arg_name, arg in arg_hashes.items()
+                ],
+            )
+            self._stage_hashes.add(stage_hash)
+            self._pending_accesses.pop(stage_hash, None)
+
+    def remove_invocations(self, stage_hashes: Set[bytes]) -> None:
+        """
+        Removes the invocations of deleted results. Other processes keep the stage
+        hashes in their snapshots, but fail to load the results.
+        """
+        with self._lock, self._connection:
+            parameters = [(stage_hash,) for stage_hash in stage_hashes]
+            self._connection.executemany(
+                "DELETE FROM invocations WHERE stage_hash = ?", parameters
+            )
+            self._connection.executemany(
+                "DELETE FROM invocation_args WHERE stage_hash = ?", parameters
+            )
+            self._stage_hashes.difference_update(stage_hashes)
+            for stage_hash in stage_hashes:
+                self._pending_accesses.pop(stage_hash, None)
+
+    def index_stored_results(self) -> None:
+        """
+        Indexes stored results that weren't indexed yet, e.g. because they were
+        saved while the index was disabled. Only their stage hash and payload size
+        are known.
+        """
+        with self._lock:
+            with self._connection:
+                _index_existing_results(self._connection, self._storage)
+            # The data version doesn't change for commits of the own connection
+            self._data_version = None
+            self._refresh_snapshot()
+
+    def record_access(self, stage_hash: bytes) -> None:
+        with self._lock:
+            self._pending_accesses[stage_hash] = time.time()
+            if len(self._pending_accesses) >= MAX_PENDING_ACCESSES:
+                self._flush_accesses()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_accesses()
+
+    def list_invocations(
+        self,
+        stage_name: Optional[str] = None,
+        code_hash: Optional[bytes] = None,
+    ) -> List[IndexedInvocation]:
+        """
+        Lists the indexed invocations, optionally only those of the stage with the
+        given qualified name or code hash. The results are not loaded.
+        """
+        conditions = []
+        parameters: List[object] = []
+        if stage_name is not None:
+            conditions.append("stage_name = ?")
+            parameters.append(stage_name)
+        if code_hash is not None:
+            conditions.append("code_hash = ?")
+            parameters.append(code_hash)
+        where_clause = (
+            "WHERE " + " AND ".join(conditions) if len(conditions) > 0 else ""
+        )
+
+        with self._lock:
+            self._flush_accesses()
+            rows = self._connection.execute(
+                f"SELECT {_INVOCATION_COLUMNS} FROM invocations {where_clause} "
+                "ORDER BY start_time",
+                parameters,
+            ).fetchall()
+            arg_rows = self._connection.execute(
+                "SELECT * FROM invocation_args WHERE stage_hash IN "
+                f"(SELECT stage_hash FROM invocations {where_clause})",
+                parameters,
+            ).fetchall()
+
+        invocation_args: Dict[bytes, Dict[str, IndexedArg]] = {}
+        for stage_hash, arg_name, arg_kind, arg_hash in arg_rows:
+            invocation_args.setdefault(stage_hash, {})[arg_name] = IndexedArg(
+                arg_kind, arg_hash
+            )
+        return [
+            IndexedInvocation(
+                stage_hash=stage_hash,
+                stage_name=stage_name,
+                code_hash=code_hash,
+                args=invocation_args.get(stage_hash, {}),
+                start_time=_to_datetime(start_time),
+                execution_duration=(
+                    timedelta(seconds=execution_duration)
+                    if execution_duration is not None else None
+                ),
+                payload_size=payload_size,
+                last_access_time=_to_datetime(last_access_time),
+            )
+            for (
+                stage_hash,
+                stage_name,
+                code_hash,
+                start_time,
+                execution_duration,
+                payload_size,
+                last_access_time,
+            ) in rows
+        ]
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_accesses()
+            self._connection.close()
+
+    def _refresh_snapshot(self) -> None:
+        # The data version changes whenever another connection commits a change
+        (data_version,) = self._connection.execute("PRAGMA data_version").fetchone()
+        if data_version == self._data_version:
+            return
+        # Replaced results get a new id, so only new rows have to be read
+        new_rows = self._connection.execute(
+            "SELECT id, stage_hash FROM invocations WHERE id > ?",
+            (self._max_id,),
+        ).fetchall()
+        for row_id, stage_hash in new_rows:
+            self._stage_hashes.add(stage_hash)
+            self._max_id = max(self._max_id, row_id)
+        self._data_version = data_version
+
+    def _flush_accesses(self) -> None:
+        if len(self._pending_accesses) == 0:
+            return
+        with self._connection:
+            self._connection.executemany(
+                "UPDATE invocations SET last_access_time = ? WHERE stage_hash = ?",
+                [
+                    (access_time, stage_hash)
+                    for stage_hash, access_time in self._pending_accesses.items()
+                ],
+            )
+        self._pending_accesses.clear()
+
+
+# Indexes are opened per process, connections can't be shared with forked processes
+_indexes: Dict[Tuple[StorageLiteral, Path, int], CacheIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_cache_index(results_dir: Path) -> CacheIndex:
+    index_key = (get_storage_backend(), results_dir, os.getpid())
+    index = _indexes.get(index_key, None)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(index_key, None)
+            if index is None:
+                index = CacheIndex(results_dir)
+                _indexes[index_key] = index
+    return index
+
+
+def mark_unindexed_results(results_dir: Path) -> None:
+    """
+    Records that a result was saved without indexing it. Must be called after the
+    result was saved.
+    """
+    storage = get_storage(results_dir)
+    if not storage.exists(UNINDEXED_RESULTS_KEY):
+        storage.save(UNINDEXED_RESULTS_KEY, True)
+
+
+def close_cache_indexes() -> None:
+    """
+    Writes pending access times and closes all indexes opened by this process.
+    """
+    with _indexes_lock:
+        for (_, _, pid), index in list(_indexes.items()):
+            if pid == os.getpid():
+                index.close()
+        _indexes.clear()
+
+
+def _connect(results_dir: Path, storage: StorageBackend) -> sqlite3.Connection:
+    if isinstance(storage, MemoryStorage):
+        # The index of ephemeral results is ephemeral as well
+        database = ":memory:"
+    else:
+        results_dir.mkdir(parents=True, exist_ok=True)
+        database = str(results_dir / INDEX_FILE_NAME)
+    connection = sqlite3.connect(
+        database,
+        timeout=60,
+        # Connections are guarded by the lock of their index
+        check_same_thread=False,
+        isolation_level=None,
+    )
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+
+    (schema_version,) = connection.execute("PRAGMA user_version").fetchone()
+    if schema_version != INDEX_SCHEMA_VERSION:
+        # Serializes the creation if several processes open the index at once
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            (schema_version,) = connection.execute("PRAGMA user_version").fetchone()
+            if schema_version != INDEX_SCHEMA_VERSION:
+                # executescript() would commit the transaction
+                for statement in _SCHEMA.split(";"):
+                    connection.execute(statement)
+                _index_existing_results(connection, storage)
+                connection.execute(f"PRAGMA user_version = {INDEX_SCHEMA_VERSION}")
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+    # Use implicit transactions from here on
+    connection.isolation_level = "DEFERRED"
+    return connection
+
+
+def _index_existing_results(
+    connection: sqlite3.Connection, storage: StorageBackend
+) -> None:
+    from .persistence import STAGE_RESULTS_DIR_NAME, get_hash_from_key
+
+    # Only the stage hash and the payload size are known without loading the results
+    existing_results = []
+    for result_key, payload_size in storage.list_objects(STAGE_RESULTS_DIR_NAME + "/"):
+        try:
+            stage_hash = get_hash_from_key(result_key)
+        except ValueError:
+            continue
+        existing_results.append((stage_hash, payload_size))
+    connection.executemany(
+        "INSERT OR IGNORE INTO invocations (stage_hash, payload_size) VALUES (?, ?)",
+        existing_results,
+    )
+
+
+def _to_datetime(timestamp: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(timestamp) if timestamp is not None else None
+
+
+def _close_at_exit() -> None:
+    try:
+        close_cache_indexes()
+    except sqlite3.Error as error:
+        logging.warning(f"Could not update the cache index: {error}")
+
+
+atexit.register(_close_at_exit)
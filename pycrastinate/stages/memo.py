@@ -0,0 +1,173 @@
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import Context, ContextVar, copy_context
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterator,
+    Optional,
+    Tuple,
+    TypeVar,
+    TYPE_CHECKING,
+)
+import asyncio
+import threading
+
+from ..args import merge_args
+from ..config import get_run_memo_enabled
+from ..utils.hashing import compute_args_hash, compute_value_hash
+
+if TYPE_CHECKING:
+    from ..utils.arg_aggregation import ArgsAggregationResult
+    from .stage import Stage
+
+
+T = TypeVar("T")
+
+_INTERRUPTED = object()
+
+# Dependencies are memoized by their stage and either their merged arguments or
+# their stage hash
+ARGS_MEMO_KEY = "args"
+HASH_MEMO_KEY = "hash"
+
+
+class RunMemo:
+    """
+    The dependencies resolved during a top-level call, so that stages depended on
+    by several others are only resolved and loaded once. Concurrent resolutions
+    of the same dependency wait for the first one.
+    """
+
+    def __init__(self) -> None:
+        # The futures of the resolutions and their owning thread ids or tasks
+        self._resolutions: Dict[Hashable, Tuple["Future", Hashable]] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, key: Hashable, resolve: Callable[[], T]) -> T:
+        owner = threading.get_ident()
+        future, resolution_owner, is_owner = self._join(key, owner)
+        if is_owner:
+            try:
+                result = resolve()
+            except BaseException as error:
+                self._fail(key, future, error)
+                raise
+            future.set_result(result)
+            return result
+        if resolution_owner == owner and not future.done():
+            # A stage that depends on itself with the same arguments
+            return resolve()
+        result = future.result()
+        if result is _INTERRUPTED:
+            return self.resolve(key, resolve)
+        return result
+
+    async def aresolve(
+        self, key: Hashable, resolve: Callable[[], Awaitable[T]]
+    ) -> T:
+        owner = asyncio.current_task()
+        future, resolution_owner, is_owner = self._join(key, owner)
+        if is_owner:
+            try:
+                result = await resolve()
+            except BaseException as error:
+                self._fail(key, future, error)
+                raise
+            future.set_result(result)
+            return result
+        if resolution_owner is owner and not future.done():
+            return await resolve()
+        # Shielded, cancelling the waiting coroutine mustn't cancel the resolution
+        result = await asyncio.shield(asyncio.wrap_future(future))
+        if result is _INTERRUPTED:
+            return await self.aresolve(key, resolve)
+        return result
+
+    def _join(
+        self, key: Hashable, owner: Hashable
+    ) -> Tuple["Future", Hashable, bool]:
+        with self._lock:
+            resolution = self._resolutions.get(key, None)
+            if resolution is not None:
+                return resolution[0], resolution[1], False
+            future: "Future" = Future()
+            self._resolutions[key] = (future, owner)
+            return future, owner, True
+
+    def _fail(self, key: Hashable, future: "Future", error: BaseException) -> None:
+        if isinstance(error, Exception):
+            # Other paths to the dependency get the same error
+            future.set_exception(error)
+            return
+        # Interruptions, e.g. cancelled tasks, aren't shared, others resolve the
+        # dependency themselves
+        with self._lock:
+            del self._resolutions[key]
+        future.set_result(_INTERRUPTED)
+
+
+_run_memo: ContextVar[Optional[RunMemo]] = ContextVar(
+    "pycrastinate_run_memo", default=None
+)
+
+
+@contextmanager
+def memoized_run() -> Iterator[None]:
+    """
+    Memoizes the dependencies resolved in the block and in the threads and tasks
+    it starts, unless it's part of a memoized run already. The resolved results are
+    released at the end of the outermost block.
+    """
+    if _run_memo.get() is not None or not get_run_memo_enabled():
+        yield
+        return
+    token = _run_memo.set(RunMemo())
+    try:
+        yield
+    finally:
+        _run_memo.reset(token)
+
+
+def copy_run_context() -> Context:
+    """
+    Returns a copy of the current context that is part of a memoized run, for runs
+    that can't be a block, e.g. in generators. The resolved results are released
+    with the context.
+    """
+    context = copy_context()
+    if context.get(_run_memo) is None and get_run_memo_enabled():
+        context.run(_run_memo.set, RunMemo())
+    return context
+
+
+def get_run_memo() -> Optional[RunMemo]:
+    return _run_memo.get()
+
+
+def get_memo_key(
+    stage: "Stage", aggregated_args: "ArgsAggregationResult"
+) -> Hashable:
+    """
+    Returns the key of the stage with the arguments, which doesn't depend on
+    whether arguments were passed or defaulted, or passed by position or name.
+    """
+    non_dependency_hashes = aggregated_args.compute_non_dependency_hashes()
+    # Reused for the stage hash
+    aggregated_args.non_dependency_hashes.update(non_dependency_hashes)
+    dependency_args_hashes = {
+        arg_name: compute_args_hash(merge_args(
+            dependency.args, aggregated_args.data_dependency_args.get(arg_name, None)
+        ))
+        for arg_name, dependency in aggregated_args.data_dependencies.items()
+    }
+    return (
+        id(stage),
+        ARGS_MEMO_KEY,
+        compute_value_hash((
+            sorted(non_dependency_hashes.items()),
+            sorted(dependency_args_hashes.items()),
+        )),
+    )
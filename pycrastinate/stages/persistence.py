@@ -1,24 +1,188 @@
 from pathlib import Path
-from typing import Optional
+from typing import (
+    Dict,
+    Optional,
+    Set,
+    Tuple,
+)
 
+from .index import IndexedArg, get_cache_index, mark_unindexed_results
 from .result import PersistedInvocation
-from ..utils.persistence import save_object, load_object
+from ..config import get_cache_index_enabled, get_result_cache_size
+from ..utils.caching import CacheStats, SizedLRUCache
+from ..utils.hashing import compute_value_hash
+from ..storage import get_storage
+
+
+# Loaded results, keyed by the results dir and the stage hash
+_result_cache: SizedLRUCache[Tuple[Path, bytes], PersistedInvocation] = (
+    SizedLRUCache(get_result_cache_size)
+)
 
 
 def save_stage_result(
     results_dir: Path,
     hash: bytes,
     result: PersistedInvocation,
+    compression: Optional[str] = None,
+    stage_name: Optional[str] = None,
+    arg_hashes: Optional[Dict[str, IndexedArg]] = None,
 ) -> None:
-    results_file = _get_stage_result_path(results_dir, hash)
-    save_object(results_file, result)
+    object_sizes = get_storage(results_dir).save(
+        _get_stage_result_key(hash), result, compression
+    )
+    _result_cache.put((results_dir, hash), result, object_sizes.encoded_size)
+    if get_cache_index_enabled():
+        # The result is indexed after it was written, so that indexed results exist
+        get_cache_index(results_dir).record_invocation(
+            hash,
+            stage_name,
+            result,
+            arg_hashes if arg_hashes is not None else {},
+            object_sizes.stored_size,
+        )
+    else:
+        mark_unindexed_results(results_dir)
 
 
 def load_stage_result(
     results_dir: Path, hash: bytes
 ) -> Optional[PersistedInvocation]:
-    results_file = _get_stage_result_path(results_dir, hash)
-    return load_object(results_file)
+    index = get_cache_index(results_dir) if get_cache_index_enabled() else None
+    cached_result = _result_cache.get((results_dir, hash))
+    if cached_result is not None:
+        if index is not None:
+            index.record_access(hash)
+        return cached_result
+
+    if index is not None and not index.contains(hash):
+        return None
+    loaded_result = get_storage(results_dir).load(_get_stage_result_key(hash))
+    if loaded_result is None:
+        return None
+    if index is not None:
+        index.record_access(hash)
+    result, result_size = loaded_result
+    _result_cache.put((results_dir, hash), result, result_size)
+    return result
+
+
+def has_stage_result(results_dir: Path, hash: bytes) -> bool:
+    """
+    Checks whether a result exists without loading it. With the cache index
+    enabled, this doesn't access the storage.
+    """
+    if get_cache_index_enabled():
+        return get_cache_index(results_dir).contains(hash)
+    return get_storage(results_dir).exists(_get_stage_result_key(hash))
+
+
+def find_stage_results(results_dir: Path, hashes: Set[bytes]) -> Set[bytes]:
+    """
+    Returns the hashes of the given ones for which results exist, probing the cache
+    index once instead of per hash if it's enabled.
+    """
+    if get_cache_index_enabled():
+        return get_cache_index(results_dir).filter_contained(hashes)
+    storage = get_storage(results_dir)
+    return {
+        hash for hash in hashes if storage.exists(_get_stage_result_key(hash))
+    }
+
+
+def delete_stage_results(results_dir: Path, hashes: Set[bytes]) -> int:
+    """
+    Deletes the results and returns the number of results that existed. Packed
+    results are only marked as deleted, their space is freed by the next pack.
+    """
+    storage = get_storage(results_dir)
+    num_deleted = 0
+    for hash in hashes:
+        if storage.delete(_get_stage_result_key(hash)):
+            num_deleted += 1
+        _result_cache.discard((results_dir, hash))
+    if get_cache_index_enabled():
+        get_cache_index(results_dir).remove_invocations(hashes)
+    return num_deleted
+
+
+def pin_stage_result(results_dir: Path, hash: bytes) -> None:
+    """
+    Keeps the result in the in-memory result cache, even if the cache is disabled
+    or its budget is exceeded. The result is loaded if it isn't cached yet.
+    """
+    _result_cache.pin((results_dir, hash))
+    if (results_dir, hash) not in _result_cache:
+        # Loading puts the result into the cache, where the pinned key keeps it
+        load_stage_result(results_dir, hash)
+
+
+def unpin_stage_result(results_dir: Path, hash: bytes) -> None:
+    _result_cache.unpin((results_dir, hash))
+
+
+def get_result_cache_stats() -> CacheStats:
+    return _result_cache.stats.snapshot()
+
+
+def get_result_cache_size_in_bytes() -> int:
+    return _result_cache.size
+
+
+def clear_result_cache() -> None:
+    """
+    Removes all results from the in-memory result cache and resets its statistics.
+    Pinned results stay pinned and are cached again when they are loaded.
+    """
+    _result_cache.clear()
+    _result_cache.stats.reset()
+
+
+def add_result_hash(
+    results_dir: Path,
+    hash: bytes,
+    result: PersistedInvocation,
+    compression: Optional[str] = None,
+    stage_name: Optional[str] = None,
+    arg_hashes: Optional[Dict[str, IndexedArg]] = None,
+) -> PersistedInvocation:
+    """
+    Computes the hash of a result that was persisted without it and updates the
+    persisted result. The stage name and argument hashes are indexed again.
+    """
+    result.result_hash = compute_value_hash(result.result)
+    save_stage_result(results_dir, hash, result, compression, stage_name, arg_hashes)
+    return result
+
+
+def migrate_stage_results(results_dir: Path) -> int:
+    """
+    Adds result hashes to all results in the cache that were persisted without them.
+    Returns the number of migrated results.
+    """
+    num_migrated = 0
+    storage = get_storage(results_dir)
+    for result_key, _ in list(storage.list_objects(STAGE_RESULTS_DIR_NAME + "/")):
+        loaded_result = storage.load(result_key)
+        if loaded_result is None:
+            continue
+        result: PersistedInvocation = loaded_result[0]
+        if result.result_hash is None:
+            result.result_hash = compute_value_hash(result.result)
+            storage.save(result_key, result)
+            num_migrated += 1
+            # The cached result is an outdated copy
+            _result_cache.discard((results_dir, get_hash_from_key(result_key)))
+    return num_migrated
+
+
+def pack_stage_results(results_dir: Path) -> int:
+    """
+    Packs the loose result files of the cache into a single pack file, together
+    with the results of earlier packs. Results saved afterwards are saved as loose
+    files until the next pack. Returns the number of packed loose results.
+    """
+    return get_storage(results_dir).pack(STAGE_RESULTS_DIR_NAME + "/")
 
 
 STAGE_RESULTS_DIR_NAME = "stage_results"
@@ -26,15 +190,15 @@ SUBDIR_NAME_LENGTH = 2
 MAX_FUNC_NAME_LENGTH = 255 # Max file name length on most file systems
 
 
-def _get_stage_result_path(results_dir: Path, hash: bytes) -> Path:
+def _get_stage_result_key(hash: bytes) -> str:
     # Creating subdirectories named by a prefix of the hash is inspired by Git
     # See the structure of the .git/objects/ folder
     encoded_hash = hash.hex()
     subdir_name = encoded_hash[:SUBDIR_NAME_LENGTH]
-    file_dir = (
-        results_dir
-        / STAGE_RESULTS_DIR_NAME
-        / subdir_name
-    )
     file_name = encoded_hash[SUBDIR_NAME_LENGTH:]
-    return file_dir / file_name
+    return f"{STAGE_RESULTS_DIR_NAME}/{subdir_name}/{file_name}"
+
+
+def get_hash_from_key(result_key: str) -> bytes:
+    _, subdir_name, file_name = result_key.split("/")
+    return bytes.fromhex(subdir_name + file_name)
@@ -0,0 +1,325 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field, replace
+from datetime import timedelta
+from typing import (
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    TYPE_CHECKING,
+)
+
+from ..args import Args, merge_args
+from ..config import (
+    KEYING_BY_REFERENCE,
+    get_cache_index_enabled,
+    get_keying_mode,
+    get_max_parallelism,
+)
+from ..utils.functions import get_full_func_name
+from ..utils.hashing import compute_args_hash, compute_code_hash, compute_value_hash
+from .concurrency import submit_in_context
+from .execution import (
+    ExecutionData,
+    PendingDependency,
+    compute_stage_hash,
+    to_reference_execution_data,
+)
+from .index import get_cache_index
+from .memo import memoized_run
+from .persistence import has_stage_result, load_stage_result
+from .result import Invocation, R
+
+if TYPE_CHECKING:
+    from ..utils.arg_aggregation import ArgsAggregationResult
+    from .stage import Stage
+
+
+@dataclass
+class PlanNode:
+    stage: "Stage"
+    args: Args
+    # Identifies the node, it only depends on the code and arguments of the stage
+    # and its dependencies
+    reference_hash: bytes
+    # The hash the result is stored under. When keying by value, it's unknown if
+    # results of dependencies are missing.
+    stage_hash: Optional[bytes]
+    # Reference hashes of the nodes of the data dependencies
+    dependencies: List[bytes]
+    cached: bool
+    # The mean duration of previous executions of the stage, if it's missing
+    estimated_duration: Optional[timedelta]
+
+
+@dataclass
+class ExecutionPlan(Generic[R]):
+    """
+    The graph of stages needed for computing the result of a stage, and which of
+    their results are missing. Nodes are ordered topologically, dependencies
+    first. Planning doesn't execute anything.
+    """
+    root: bytes
+    nodes: Dict[bytes, PlanNode] = field(default_factory=dict)
+
+    @property
+    def cached_nodes(self) -> List[PlanNode]:
+        return [node for node in self.nodes.values() if node.cached]
+
+    @property
+    def missing_nodes(self) -> List[PlanNode]:
+        return [node for node in self.nodes.values() if not node.cached]
+
+    @property
+    def estimated_duration(self) -> timedelta:
+        """
+        The estimated duration of executing the missing nodes one after another,
+        without those that were never executed before.
+        """
+        return sum(
+            (
+                node.estimated_duration for node in self.missing_nodes
+                if node.estimated_duration is not None
+            ),
+            timedelta(),
+        )
+
+    def __str__(self) -> str:
+        lines = []
+        for node in self.nodes.values():
+            estimate = (
+                f", ~{node.estimated_duration.total_seconds():.3f} s"
+                if node.estimated_duration is not None else ""
+            )
+            status = "cached" if node.cached else "missing"
+            lines.append(
+                f"{node.reference_hash.hex()[:12]} "
+                f"{get_full_func_name(node.stage.stage_func)}: {status}{estimate}"
+            )
+        return "\n".join(lines)
+
+    def execute(self, max_parallelism: Optional[int] = None) -> Invocation[R]:
+        """
+        Executes the missing nodes in topological order, independent nodes in
+        parallel by up to max_parallelism threads, and returns the result of the
+        root node. The first error is raised after the running nodes finished.
+        """
+        if max_parallelism is None:
+            max_parallelism = get_max_parallelism()
+        if max_parallelism < 1:
+            raise ValueError("The maximum parallelism must be positive")
+
+        missing_hashes = {
+            reference_hash for reference_hash, node in self.nodes.items()
+            if not node.cached
+        }
+        # Nodes wait for their missing dependencies only
+        waiting_for = {
+            reference_hash: {
+                dependency for dependency in self.nodes[reference_hash].dependencies
+                if dependency in missing_hashes
+            }
+            for reference_hash in missing_hashes
+        }
+        dependents: Dict[bytes, List[bytes]] = {}
+        for reference_hash, dependencies in waiting_for.items():
+            for dependency in dependencies:
+                dependents.setdefault(dependency, []).append(reference_hash)
+
+        with memoized_run(), ThreadPoolExecutor(
+            max_parallelism, thread_name_prefix="pycrastinate-plan"
+        ) as pool:
+            futures: Dict["Future[Tuple[bytes, Invocation]]", bytes] = {}
+
+            def submit(reference_hash: bytes) -> None:
+                node = self.nodes[reference_hash]
+                future = submit_in_context(
+                    pool, node.stage.compute_or_load_result, node.args
+                )
+                futures[future] = reference_hash
+
+            for reference_hash, dependencies in waiting_for.items():
+                if len(dependencies) == 0:
+                    submit(reference_hash)
+            try:
+                while len(futures) > 0:
+                    done_futures, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done_futures:
+                        reference_hash = futures.pop(future)
+                        future.result()
+                        for dependent in dependents.get(reference_hash, []):
+                            waiting_for[dependent].discard(reference_hash)
+                            if len(waiting_for[dependent]) == 0:
+                                submit(dependent)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+            root_node = self.nodes[self.root]
+            _, result = root_node.stage.compute_or_load_result(root_node.args)
+        return result
+
+
+@dataclass
+class _PlanFrame:
+    stage: "Stage"
+    args: Args
+    key: Hashable
+    aggregated_args: Optional["ArgsAggregationResult"] = None
+    # The data dependencies by argument name, with their stages and arguments
+    dependencies: Dict[str, Tuple["Stage", Args, Hashable, bool]] = field(
+        default_factory=dict
+    )
+
+
+def plan_execution(stage: "Stage[R]", args: Args) -> ExecutionPlan[R]:
+    """
+    Builds the execution plan for computing the result of the stage with the
+    arguments. When keying by value, the results of cached dependencies are loaded
+    to compute the stage hashes of the nodes depending on them. The graph is
+    traversed with an explicit stack, so deep chains of stages don't exceed the
+    recursion limit.
+    """
+    by_reference = get_keying_mode() == KEYING_BY_REFERENCE
+    # Nodes by the key of their stage and arguments
+    planned_nodes: Dict[Hashable, PlanNode] = {}
+    reference_exec_data: Dict[bytes, ExecutionData] = {}
+    plan: ExecutionPlan[R] = ExecutionPlan(root=b"")
+    estimated_durations: Dict[int, Optional[timedelta]] = {}
+
+    root_key = (id(stage), compute_args_hash(args))
+    stack = [_PlanFrame(stage, args, root_key)]
+    while len(stack) > 0:
+        frame = stack[-1]
+        if frame.key in planned_nodes:
+            # Also depended on by another node that was planned first
+            stack.pop()
+            continue
+
+        if frame.aggregated_args is None:
+            # Plan the dependencies first, they are above the frame on the stack
+            frame.aggregated_args = frame.stage.argument_plan.aggregate(frame.args)
+            for arg_name, dependency in (
+                frame.aggregated_args.data_dependencies.items()
+            ):
+                dependency_args = merge_args(
+                    dependency.args,
+                    frame.aggregated_args.data_dependency_args.get(arg_name, None),
+                )
+                dependency_key = (
+                    id(dependency.stage), compute_args_hash(dependency_args)
+                )
+                frame.dependencies[arg_name] = (
+                    dependency.stage,
+                    dependency_args,
+                    dependency_key,
+                    dependency.with_metadata,
+                )
+                if dependency_key not in planned_nodes:
+                    stack.append(
+                        _PlanFrame(dependency.stage, dependency_args, dependency_key)
+                    )
+            continue
+
+        stack.pop()
+        dependency_nodes = {
+            arg_name: planned_nodes[dependency_key]
+            for arg_name, (_, _, dependency_key, _) in frame.dependencies.items()
+        }
+        exec_data = to_reference_execution_data(frame.aggregated_args, {
+            arg_name: PendingDependency(
+                stage=dependency_stage,
+                with_metadata=with_metadata,
+                stage_hash=dependency_nodes[arg_name].reference_hash,
+                exec_data=reference_exec_data[
+                    dependency_nodes[arg_name].reference_hash
+                ],
+            )
+            for arg_name, (dependency_stage, _, _, with_metadata)
+            in frame.dependencies.items()
+        })
+        reference_hash = compute_stage_hash(frame.stage.stage_func, exec_data)
+        if by_reference:
+            stage_hash: Optional[bytes] = reference_hash
+        else:
+            stage_hash = _compute_value_keyed_hash(
+                frame.stage, exec_data, dependency_nodes
+            )
+        cached = (
+            stage_hash is not None
+            and has_stage_result(frame.stage.cache_dir, stage_hash)
+        )
+
+        stage_id = id(frame.stage)
+        if not cached and stage_id not in estimated_durations:
+            estimated_durations[stage_id] = _estimate_duration(frame.stage)
+        node = PlanNode(
+            stage=frame.stage,
+            args=frame.args,
+            reference_hash=reference_hash,
+            stage_hash=stage_hash,
+            dependencies=list(dict.fromkeys(
+                dependency_node.reference_hash
+                for dependency_node in dependency_nodes.values()
+            )),
+            cached=cached,
+            estimated_duration=(
+                None if cached else estimated_durations[stage_id]
+            ),
+        )
+        planned_nodes[frame.key] = node
+        reference_exec_data[reference_hash] = exec_data
+        plan.nodes.setdefault(reference_hash, node)
+
+    plan.root = planned_nodes[root_key].reference_hash
+    return plan
+
+
+def _compute_value_keyed_hash(
+    stage: "Stage",
+    reference_exec_data: ExecutionData,
+    dependency_nodes: Dict[str, PlanNode],
+) -> Optional[bytes]:
+    data_dependency_hashes = {}
+    for arg_name, dependency_node in dependency_nodes.items():
+        if not dependency_node.cached:
+            return None
+        dependency_result = load_stage_result(
+            dependency_node.stage.cache_dir, dependency_node.stage_hash
+        )
+        if dependency_result is None:
+            # Removed in the meantime
+            return None
+        data_dependency_hashes[arg_name] = (
+            dependency_result.result_hash
+            if dependency_result.result_hash is not None
+            else compute_value_hash(dependency_result.result)
+        )
+    return compute_stage_hash(
+        stage.stage_func,
+        replace(reference_exec_data, data_dependency_hashes=data_dependency_hashes),
+    )
+
+
+def _estimate_duration(stage: "Stage") -> Optional[timedelta]:
+    if not get_cache_index_enabled():
+        return None
+    # Previous executions of the same code are preferred
+    index = get_cache_index(stage.cache_dir)
+    invocations = index.list_invocations(
+        code_hash=compute_code_hash(stage.stage_func)
+    )
+    if len(invocations) == 0:
+        invocations = index.list_invocations(
+            stage_name=get_full_func_name(stage.stage_func)
+        )
+    durations = [
+        invocation.execution_duration for invocation in invocations
+        if invocation.execution_duration is not None
+    ]
+    if len(durations) == 0:
+        return None
+    return sum(durations, timedelta()) / len(durations)
@@ -0,0 +1,207 @@
+from dataclasses import dataclass, field, replace
+from typing import (
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    TYPE_CHECKING,
+)
+import functools
+
+from ..args import Args, merge_args
+from ..config import KEYING_BY_REFERENCE, get_keying_mode
+from .execution import (
+    ExecutionData,
+    PendingDependency,
+    compute_stage_hash,
+    get_dependency_values,
+    to_execution_data,
+    to_reference_execution_data,
+)
+from .memo import HASH_MEMO_KEY, get_memo_key, get_run_memo, memoized_run
+from .persistence import has_stage_result
+from .result import Invocation, R
+
+if TYPE_CHECKING:
+    from ..utils.arg_aggregation import ArgsAggregationResult
+    from .stage import Stage
+
+
+@dataclass
+class _ResolutionFrame:
+    stage: "Stage"
+    aggregated_args: "ArgsAggregationResult"
+    key: Hashable
+    expanded: bool = False
+    # The keys of the data dependencies, in the order of the arguments
+    dependency_keys: List[Hashable] = field(default_factory=list)
+
+
+@dataclass
+class _ReferenceNode:
+    stage: "Stage"
+    exec_data: ExecutionData
+    stage_hash: bytes
+    dependency_keys: List[Hashable]
+
+
+def resolve_iteratively(
+    stage: "Stage[R]", args: Args
+) -> Tuple[bytes, Invocation[R]]:
+    """
+    Computes or loads the result of the stage like compute_or_load_result(), with
+    the same stage hashes, but traverses the dependencies with an explicit stack
+    instead of recursion. This supports arbitrarily deep chains of stages, but
+    resolves the dependencies one after another.
+    """
+    with memoized_run():
+        root = _create_frame(stage, args)
+        if get_keying_mode() == KEYING_BY_REFERENCE:
+            return _resolve_by_reference(root)
+        return _resolve_by_value(root)
+
+
+def _create_frame(stage: "Stage", args: Args) -> _ResolutionFrame:
+    aggregated_args = stage.argument_plan.aggregate(args)
+    return _ResolutionFrame(
+        stage, aggregated_args, get_memo_key(stage, aggregated_args)
+    )
+
+
+def _expand(
+    frame: _ResolutionFrame, visited: Dict[Hashable, object]
+) -> List[_ResolutionFrame]:
+    """
+    Returns the frames of the data dependencies that weren't visited yet.
+    """
+    frame.expanded = True
+    dependency_frames = []
+    aggregated_args = frame.aggregated_args
+    for arg_name, dependency in aggregated_args.data_dependencies.items():
+        dependency_frame = _create_frame(dependency.stage, merge_args(
+            dependency.args, aggregated_args.data_dependency_args.get(arg_name, None)
+        ))
+        frame.dependency_keys.append(dependency_frame.key)
+        if dependency_frame.key not in visited:
+            dependency_frames.append(dependency_frame)
+    return dependency_frames
+
+
+def _resolve_by_value(root: _ResolutionFrame) -> Tuple[bytes, Invocation]:
+    # The results of the data dependencies are needed for the stage hashes, so
+    # all nodes are resolved bottom-up
+    resolved: Dict[Hashable, Tuple[bytes, Invocation]] = {}
+    stack = [root]
+    while len(stack) > 0:
+        frame = stack[-1]
+        if frame.key in resolved:
+            # Also depended on by another node that was resolved first
+            stack.pop()
+            continue
+        if not frame.expanded:
+            stack.extend(_expand(frame, resolved))
+            continue
+
+        stack.pop()
+        exec_data = to_execution_data(
+            frame.aggregated_args,
+            [resolved[dependency_key] for dependency_key in frame.dependency_keys],
+        )
+        resolved[frame.key] = _exec_or_load(
+            frame.key, frame.stage, exec_data, None
+        )
+    return resolved[root.key]
+
+
+def _resolve_by_reference(root: _ResolutionFrame) -> Tuple[bytes, Invocation]:
+    # The stage hashes only depend on code and arguments, so they are computed
+    # bottom-up first
+    nodes: Dict[Hashable, _ReferenceNode] = {}
+    stack = [root]
+    while len(stack) > 0:
+        frame = stack[-1]
+        if frame.key in nodes:
+            stack.pop()
+            continue
+        if not frame.expanded:
+            stack.extend(_expand(frame, nodes))
+            continue
+
+        stack.pop()
+        exec_data = to_reference_execution_data(frame.aggregated_args, {
+            arg_name: PendingDependency(
+                stage=nodes[dependency_key].stage,
+                with_metadata=dependency.with_metadata,
+                stage_hash=nodes[dependency_key].stage_hash,
+                exec_data=nodes[dependency_key].exec_data,
+            )
+            for (arg_name, dependency), dependency_key in zip(
+                frame.aggregated_args.data_dependencies.items(),
+                frame.dependency_keys,
+            )
+        })
+        nodes[frame.key] = _ReferenceNode(
+            stage=frame.stage,
+            exec_data=exec_data,
+            stage_hash=compute_stage_hash(frame.stage.stage_func, exec_data),
+            dependency_keys=frame.dependency_keys,
+        )
+
+    # Cached results are loaded without their dependencies. The dependencies of
+    # missing results are resolved before executing them, so that executing a
+    # stage doesn't recurse into its dependencies.
+    resolved: Dict[Hashable, Tuple[bytes, Invocation]] = {}
+    execution_stack: List[Tuple[Hashable, bool]] = [(root.key, False)]
+    while len(execution_stack) > 0:
+        key, expanded = execution_stack.pop()
+        if key in resolved:
+            continue
+        node = nodes[key]
+        if expanded:
+            exec_data = replace(
+                node.exec_data,
+                arg_values={
+                    **node.exec_data.arg_values,
+                    **get_dependency_values(node.exec_data, [
+                        resolved[dependency_key]
+                        for dependency_key in node.dependency_keys
+                    ]),
+                },
+                pending_dependencies={},
+            )
+        elif (
+            len(node.dependency_keys) == 0
+            or has_stage_result(node.stage.cache_dir, node.stage_hash)
+        ):
+            exec_data = node.exec_data
+        else:
+            execution_stack.append((key, True))
+            execution_stack.extend(
+                (dependency_key, False) for dependency_key in node.dependency_keys
+                if dependency_key not in resolved
+            )
+            continue
+        resolved[key] = _exec_or_load(
+            (id(node.stage), HASH_MEMO_KEY, node.stage_hash),
+            node.stage,
+            exec_data,
+            node.stage_hash,
+        )
+    return resolved[root.key]
+
+
+def _exec_or_load(
+    key: Hashable,
+    stage: "Stage",
+    exec_data: ExecutionData,
+    stage_hash: Optional[bytes],
+) -> Tuple[bytes, Invocation]:
+    exec_or_load = functools.partial(
+        stage.exec_or_load_prepared, exec_data, stage_hash
+    )
+    # Shared with concurrent resolutions of the same run
+    memo = get_run_memo()
+    if memo is None:
+        return exec_or_load()
+    return memo.resolve(key, exec_or_load)
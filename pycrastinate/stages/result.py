@@ -2,15 +2,71 @@ from dataclasses import dataclass
 from datetime import timedelta, datetime
 from typing import (
     Any,
+    Callable,
     Dict,
     Generic,
+    Iterator,
+    Mapping,
+    Optional,
     TypeVar,
 )
+import threading
 
 
 R = TypeVar("R")
 
 
+class LazyArgs(Mapping[str, Any]):
+    """
+    The argument values of an invocation. Values that have a loader are only loaded
+    on first access, e.g. the results of data dependencies of a cached stage.
+    """
+
+    def __init__(
+        self,
+        values: Mapping[str, Any],
+        loaders: Mapping[str, Callable[[], Any]],
+    ) -> None:
+        self._arg_names = list(values.keys()) + [
+            arg_name for arg_name in loaders.keys() if arg_name not in values
+        ]
+        self._values = dict(values)
+        self._loaders = dict(loaders)
+        self._lock = threading.Lock()
+
+    def __getitem__(self, arg_name: str) -> Any:
+        if arg_name in self._loaders:
+            with self._lock:
+                loader = self._loaders.get(arg_name, None)
+                if loader is not None:
+                    self._values[arg_name] = loader()
+                    del self._loaders[arg_name]
+        return self._values[arg_name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._arg_names)
+
+    def __len__(self) -> int:
+        return len(self._arg_names)
+
+    def is_loaded(self, arg_name: str) -> bool:
+        return arg_name not in self._loaders
+
+    def materialize(self) -> Dict[str, Any]:
+        """
+        Loads all values that weren't loaded yet and returns them as a dict.
+        """
+        return {arg_name: self[arg_name] for arg_name in self._arg_names}
+
+    def __repr__(self) -> str:
+        arg_reprs = ", ".join(
+            f"{arg_name!r}: "
+            + (repr(self._values[arg_name]) if self.is_loaded(arg_name) else "...")
+            for arg_name in self._arg_names
+        )
+        return f"LazyArgs({{{arg_reprs}}})"
+
+
 @dataclass
 class BaseInvocation(Generic[R]):
     result: R
@@ -20,7 +76,18 @@ class BaseInvocation(Generic[R]):
 
 @dataclass
 class Invocation(BaseInvocation, Generic[R]):
-    args: Dict[str, Any]
+    args: Mapping[str, Any]
+    # The hash of the result value, if known
+    result_hash: Optional[bytes] = None
+
+    def materialize(self) -> "Invocation[R]":
+        """
+        Loads all arguments that are loaded lazily, e.g. before the invocation is
+        used without access to the cache.
+        """
+        if isinstance(self.args, LazyArgs):
+            self.args = self.args.materialize()
+        return self
 
     def __str__(self) -> str:
         return (
@@ -60,3 +127,6 @@ class FuncArg(PersistedArg):
 class PersistedInvocation(BaseInvocation):
     args: Dict[str, PersistedArg]
     code_hash: bytes
+    # The hash of the result value, computed when the result is persisted.
+    # Results persisted by older versions don't have it and default to None.
+    result_hash: Optional[bytes] = None
@@ -0,0 +1,180 @@
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import (
+    AsyncIterator,
+    ContextManager,
+    Dict,
+    Hashable,
+    Iterator,
+    Optional,
+    Tuple,
+)
+import asyncio
+import logging
+import threading
+
+from ..config import (
+    STORAGE_MEMORY,
+    get_storage_backend,
+    get_single_flight_timeout,
+    get_stale_lock_age,
+)
+from ..utils.locking import LOCK_FILE_SUFFIX, hold_lock_file
+
+
+LOCKS_DIR_NAME = "locks"
+
+
+@dataclass
+class _Flight:
+    future: "Future[None]"
+    # The id of the owning thread, or the owning task of coroutines
+    owner: Hashable
+
+
+# Executions in this process, keyed by the results dir and the stage hash
+_flights: Dict[Tuple[Path, bytes], _Flight] = {}
+_flights_lock = threading.Lock()
+
+
+@contextmanager
+def single_flight(results_dir: Path, hash: bytes) -> Iterator[None]:
+    """
+    Waits until no other thread or process executes the stage with the hash, and
+    keeps others waiting while the block executes it. The block has to check for
+    a persisted result first, since it's entered after others finished. If the
+    execution in another thread of this process fails, its error is raised.
+    """
+    flight_key = (results_dir, hash)
+    owner = threading.get_ident()
+    flight, is_owner = _join_flight(flight_key, owner)
+    if not is_owner:
+        if flight.owner != owner:
+            _wait_for_flight(flight, hash)
+        # A stage that calls itself with the same arguments executes again
+        yield
+        return
+
+    try:
+        lock_file = _get_lock_file(results_dir, hash)
+        if lock_file is None:
+            yield
+        else:
+            with hold_lock_file(
+                lock_file, get_single_flight_timeout(), get_stale_lock_age()
+            ):
+                yield
+    except BaseException as error:
+        _land_flight(flight_key, flight, error)
+        raise
+    _land_flight(flight_key, flight, None)
+
+
+@asynccontextmanager
+async def async_single_flight(results_dir: Path, hash: bytes) -> AsyncIterator[None]:
+    """
+    Like single_flight(), but waits without blocking the event loop. Coroutines
+    and threads executing the same stage wait for each other.
+    """
+    flight_key = (results_dir, hash)
+    owner = asyncio.current_task()
+    flight, is_owner = _join_flight(flight_key, owner)
+    if not is_owner:
+        if flight.owner is not owner:
+            await _async_wait_for_flight(flight, hash)
+        yield
+        return
+
+    try:
+        lock_file = _get_lock_file(results_dir, hash)
+        if lock_file is None:
+            yield
+        else:
+            lock = hold_lock_file(
+                lock_file, get_single_flight_timeout(), get_stale_lock_age()
+            )
+            await _enter_in_thread(lock)
+            try:
+                yield
+            finally:
+                await asyncio.to_thread(lock.__exit__, None, None, None)
+    except BaseException as error:
+        _land_flight(flight_key, flight, error)
+        raise
+    _land_flight(flight_key, flight, None)
+
+
+def _join_flight(
+    flight_key: Tuple[Path, bytes], owner: Hashable
+) -> Tuple[_Flight, bool]:
+    with _flights_lock:
+        flight = _flights.get(flight_key, None)
+        if flight is not None:
+            return flight, False
+        flight = _Flight(Future(), owner)
+        _flights[flight_key] = flight
+        return flight, True
+
+
+def _land_flight(
+    flight_key: Tuple[Path, bytes],
+    flight: _Flight,
+    error: Optional[BaseException],
+) -> None:
+    with _flights_lock:
+        del _flights[flight_key]
+    if isinstance(error, Exception):
+        flight.future.set_exception(error)
+    else:
+        # Also after interruptions, which are not shared with waiting threads.
+        # They execute the stage themselves if there's no result.
+        flight.future.set_result(None)
+
+
+def _get_lock_file(results_dir: Path, hash: bytes) -> Optional[Path]:
+    if get_storage_backend() == STORAGE_MEMORY:
+        # Other processes don't share the results
+        return None
+    return results_dir / LOCKS_DIR_NAME / (hash.hex() + LOCK_FILE_SUFFIX)
+
+
+async def _enter_in_thread(lock: ContextManager) -> None:
+    entering = asyncio.ensure_future(asyncio.to_thread(lock.__enter__))
+    try:
+        await asyncio.shield(entering)
+    except asyncio.CancelledError:
+        # The thread can't be interrupted, the lock is released once it's acquired
+        def exit_entered(_: "asyncio.Future[None]") -> None:
+            if not entering.cancelled() and entering.exception() is None:
+                lock.__exit__(None, None, None)
+
+        entering.add_done_callback(exit_entered)
+        raise
+
+
+def _wait_for_flight(flight: _Flight, hash: bytes) -> None:
+    timeout = get_single_flight_timeout()
+    try:
+        flight.future.result(timeout)
+    except FutureTimeoutError:
+        _warn_timeout(timeout, hash)
+
+
+async def _async_wait_for_flight(flight: _Flight, hash: bytes) -> None:
+    timeout = get_single_flight_timeout()
+    try:
+        # Shielded, cancelling the waiting coroutine mustn't cancel the flight
+        await asyncio.wait_for(
+            asyncio.shield(asyncio.wrap_future(flight.future)), timeout
+        )
+    except asyncio.TimeoutError:
+        _warn_timeout(timeout, hash)
+
+
+def _warn_timeout(timeout: float, hash: bytes) -> None:
+    logging.warning(
+        f"Timed out after {timeout} s waiting for another thread to execute "
+        f"the stage with hash {hash.hex()}, executing it again"
+    )
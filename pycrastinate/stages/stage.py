@@ -1,33 +1,69 @@
 from pathlib import Path
 from typing import (
     Any,
+    Awaitable,
     Callable,
     Generic,
+    Iterable,
+    Iterator,
     List,
+    Literal,
     Optional,
     Union,
     Tuple,
+    TYPE_CHECKING,
+    overload,
 )
+import asyncio
 import functools
 
 from ..args import Args
-from ..config import get_cache_dir
+from ..config import (
+    EXECUTOR_THREAD,
+    EXECUTOR_PROCESS,
+    ExecutorLiteral,
+    get_cache_dir,
+    get_iterative_resolution_enabled,
+    get_keying_mode,
+    KEYING_BY_REFERENCE,
+)
+from ..utils.encoding import parse_compression
 from .result import Invocation, R
 
+if TYPE_CHECKING:
+    from ..utils.arg_aggregation import ArgumentPlan
+    from .index import IndexedInvocation
+    from .execution import ExecutionData
+    from .planning import ExecutionPlan
+
 
 class Stage(Generic[R]):
     def __init__(
         self,
         stage_func: Callable[..., R],
         cache_dir: Optional[Path] = None,
+        compression: Optional[str] = None,
+        executor: Optional[ExecutorLiteral] = None,
     ) -> None:
         functools.update_wrapper(self, stage_func)
         self.stage_func: Callable[..., R] = stage_func
         self._cache_dir = cache_dir
+        if compression is not None:
+            parse_compression(compression)
+        # Overrides the globally configured compression for the results of this stage
+        self.compression = compression
+        if executor not in (None, EXECUTOR_THREAD, EXECUTOR_PROCESS):
+            raise ValueError(f"Unsupported executor '{executor}'")
+        # Overrides the globally configured executor for this stage
+        self.executor: Optional[ExecutorLiteral] = executor
+        self._argument_plan: Optional[Tuple[Callable[..., R], "ArgumentPlan"]] = None
 
-        self._hook_callbacks: List[
-            Callable[[bytes, Invocation[R]], None]
-        ] = []
+        # Pairs of a callback and an optional coroutine function used instead of
+        # it when the stage is awaited
+        self._hook_callbacks: List[Tuple[
+            Callable[[bytes, Invocation[R]], None],
+            Optional[Callable[[bytes, Invocation[R]], Awaitable[None]]],
+        ]] = []
 
     @property
     def cache_dir(self) -> Path:
@@ -37,6 +73,18 @@ class Stage(Generic[R]):
             else get_cache_dir()
         )
 
+    @property
+    def argument_plan(self) -> "ArgumentPlan":
+        # The stage function can be replaced, so the plan is tied to the function
+        # it was built for
+        argument_plan = self._argument_plan
+        if argument_plan is None or argument_plan[0] is not self.stage_func:
+            from ..utils.arg_aggregation import ArgumentPlan
+
+            argument_plan = (self.stage_func, ArgumentPlan(self.stage_func))
+            self._argument_plan = argument_plan
+        return argument_plan[1]
+
     def __call__(
         self,
         *args: Any,
@@ -45,29 +93,206 @@ class Stage(Generic[R]):
         _, result = self.compute_or_load_result(Args(*args, **kwargs))
         return result.result
 
+    async def acall(self, *args: Any, **kwargs: Any) -> R:
+        """
+        Computes or loads the result like calling the stage, without blocking the
+        event loop. Coroutine stage functions are executed on the running loop.
+        """
+        _, result = await self.acompute_or_load_result(Args(*args, **kwargs))
+        return result.result
+
+    @overload
+    def map(
+        self,
+        args_list: Iterable[Args],
+        max_workers: Optional[int] = None,
+        *,
+        as_completed: Literal[False] = False,
+    ) -> List[R]:
+        ...
+    @overload
+    def map(
+        self,
+        args_list: Iterable[Args],
+        max_workers: Optional[int] = None,
+        *,
+        as_completed: Literal[True],
+    ) -> Iterator[Tuple[int, R]]:
+        ...
+    def map(
+        self,
+        args_list: Iterable[Args],
+        max_workers: Optional[int] = None,
+        *,
+        as_completed: bool = False,
+    ) -> Union[List[R], Iterator[Tuple[int, R]]]:
+        """
+        Computes or loads the results for all arguments and returns them in the
+        order of the arguments. Missing results are executed in parallel by up to
+        max_workers threads, by default the configured maximum parallelism. With
+        as_completed, pairs of the index of the arguments and the result are
+        yielded as soon as the results are available instead.
+        """
+        from .batch import map_stage
+
+        args_list = list(args_list)
+        indexed_results = map_stage(self, args_list, max_workers)
+        if as_completed:
+            return (
+                (index, invocation.result) for index, invocation in indexed_results
+            )
+
+        results: List[Any] = [None] * len(args_list)
+        for index, invocation in indexed_results:
+            results[index] = invocation.result
+        return results
+
+    def plan(self, *args: Any, **kwargs: Any) -> "ExecutionPlan[R]":
+        """
+        Plans computing the result for the given arguments without executing
+        anything (dry run). The plan lists the stages it depends on, which of their
+        results are cached or missing, and estimates the duration of the missing
+        ones. Executing the plan only executes the missing stages.
+        """
+        from .planning import plan_execution
+
+        return plan_execution(self, Args(*args, **kwargs))
+
+    def pin(self, *args: Any, **kwargs: Any) -> R:
+        """
+        Computes or loads the result for the given arguments and keeps it in the
+        in-memory result cache until it's unpinned.
+        """
+        from .persistence import pin_stage_result
+
+        stage_hash, result = self.compute_or_load_result(Args(*args, **kwargs))
+        pin_stage_result(self.cache_dir, stage_hash)
+        return result.result
+
+    def unpin(self, *args: Any, **kwargs: Any) -> None:
+        """
+        Unpins the result for the given arguments without computing it. Nothing
+        happens if the result doesn't exist.
+        """
+        from .persistence import unpin_stage_result
+        from .planning import plan_execution
+
+        plan = plan_execution(self, Args(*args, **kwargs))
+        stage_hash = plan.nodes[plan.root].stage_hash
+        # When keying by value, the stage hash is unknown if dependencies are missing
+        if stage_hash is not None:
+            unpin_stage_result(self.cache_dir, stage_hash)
+
+    def list_invocations(self) -> List["IndexedInvocation"]:
+        """
+        Lists the persisted invocations of this stage from the cache index, without
+        loading their results.
+        """
+        from ..utils.functions import get_full_func_name
+        from .index import get_cache_index
+
+        return get_cache_index(self.cache_dir).list_invocations(
+            stage_name=get_full_func_name(self.stage_func)
+        )
+
     def register_hook(
         self,
-        result_callback: Callable[[bytes, Invocation[R]], None]
+        result_callback: Callable[[bytes, Invocation[R]], None],
+        async_result_callback: Optional[
+            Callable[[bytes, Invocation[R]], Awaitable[None]]
+        ] = None,
     ) -> None:
-        self._hook_callbacks.append(result_callback)
+        self._hook_callbacks.append((result_callback, async_result_callback))
 
     def compute_or_load_result(self, args: Args) -> Tuple[bytes, Invocation[R]]:
-        from ..utils.arg_aggregation import aggregate_args
-        from .execution import prepare_execution, exec_or_load
+        from .execution import prepare_execution, prepare_reference_execution
+        from .memo import get_memo_key, get_run_memo, memoized_run
 
-        # TODO: can we just compute the aggregated args once, and then merge
-        # them with `args` on execution?
-        aggregated_args = aggregate_args(self.stage_func, args)
-        execution_data = prepare_execution(aggregated_args)
+        if get_iterative_resolution_enabled():
+            from .resolution import resolve_iteratively
+
+            return resolve_iteratively(self, args)
+
+        def compute_or_load_aggregated() -> Tuple[bytes, Invocation[R]]:
+            if get_keying_mode() == KEYING_BY_REFERENCE:
+                execution_data = prepare_reference_execution(aggregated_args)
+            else:
+                execution_data = prepare_execution(aggregated_args)
+            return self.exec_or_load_prepared(execution_data)
+
+        with memoized_run():
+            aggregated_args = self.argument_plan.aggregate(args)
+            memo = get_run_memo()
+            if memo is None:
+                return compute_or_load_aggregated()
+            return memo.resolve(
+                get_memo_key(self, aggregated_args), compute_or_load_aggregated
+            )
+
+    async def acompute_or_load_result(
+        self, args: Args
+    ) -> Tuple[bytes, Invocation[R]]:
+        from .execution import aprepare_execution, prepare_reference_execution
+        from .memo import get_memo_key, get_run_memo, memoized_run
+
+        async def compute_or_load_aggregated() -> Tuple[bytes, Invocation[R]]:
+            if get_keying_mode() == KEYING_BY_REFERENCE:
+                execution_data = await asyncio.to_thread(
+                    prepare_reference_execution, aggregated_args
+                )
+            else:
+                execution_data = await aprepare_execution(aggregated_args)
+            return await self.aexec_or_load_prepared(execution_data)
+
+        with memoized_run():
+            aggregated_args = self.argument_plan.aggregate(args)
+            memo = get_run_memo()
+            if memo is None:
+                return await compute_or_load_aggregated()
+            # Hashing large arguments would block the event loop
+            memo_key = await asyncio.to_thread(get_memo_key, self, aggregated_args)
+            return await memo.aresolve(memo_key, compute_or_load_aggregated)
+
+    def exec_or_load_prepared(
+        self,
+        execution_data: "ExecutionData",
+        stage_hash: Optional[bytes] = None,
+    ) -> Tuple[bytes, Invocation[R]]:
+        from .execution import exec_or_load
 
         stage_hash, result = exec_or_load(
             self.stage_func,
             exec_data=execution_data,
             results_dir=self.cache_dir,
+            stage_hash=stage_hash,
+            compression=self.compression,
+            executor=self.executor,
         )
         self._run_hooks(stage_hash, result)
         return stage_hash, result
 
+    async def aexec_or_load_prepared(
+        self,
+        execution_data: "ExecutionData",
+        stage_hash: Optional[bytes] = None,
+    ) -> Tuple[bytes, Invocation[R]]:
+        from .execution import aexec_or_load
+
+        stage_hash, result = await aexec_or_load(
+            self.stage_func,
+            exec_data=execution_data,
+            results_dir=self.cache_dir,
+            stage_hash=stage_hash,
+            compression=self.compression,
+            executor=self.executor,
+        )
+        for result_callback, async_result_callback in self._hook_callbacks:
+            if async_result_callback is not None:
+                await async_result_callback(stage_hash, result)
+            else:
+                await asyncio.to_thread(result_callback, stage_hash, result)
+        return stage_hash, result
+
     def _run_hooks(
         self,
         result_reference: bytes,
@@ -83,7 +308,7 @@ class Stage(Generic[R]):
                 # data_dependency.stage._run_hooks()
 
         # TODO: push the results to task pool/queue instead
-        for result_callback in self._hook_callbacks:
+        for result_callback, _ in self._hook_callbacks:
             result_callback(result_reference, result)
 
     def load_result(
@@ -91,35 +316,47 @@ class Stage(Generic[R]):
     ) -> Union[R, Invocation[R]]:
         from .execution import load_from_reference
 
-        # TODO: handle missing and inconsistent data
+        # TODO: handle inconsistent data
         return load_from_reference(
-            self.stage_func, reference_hash, self.cache_dir, with_metadata
+            self.argument_plan, reference_hash, self.cache_dir, with_metadata
         )
 
+    def has_result(self, reference_hash: bytes) -> bool:
+        from .persistence import has_stage_result
+
+        return has_stage_result(self.cache_dir, reference_hash)
+
+@overload
+def stage(func: Callable[..., R]) -> Stage[R]:
+    ...
+@overload
 def stage(
-    func: Callable[..., R],
-) -> Stage[R]:
-    return Stage(func)
-
-# @overload
-# def stage(_func: Callable[..., T]) -> Stage[T]:
-    # ...
-# @overload
-# def stage() -> Callable[[Callable[..., T]], Stage[T]]:
-    # ...
-# def stage(
-    # _func = None,
-    # # *,
-    # # results_dir: Union[str, Path] = "./.results",
-# # ) -> Callable[..., T]:
-# ):
-    # def stage_decorator(func: Callable[..., T]) -> Callable[..., T]:
-        # return Stage(func, results_dir=Path(results_dir))
-    # # if _func is None:
-        # # return functools.partial(stage, results_dir=results_dir)
-# 
-    # # return Stage(_func, results_dir=results_dir)
-    # if _func is None:
-        # return stage_decorator
-    # else:
-        # return stage_decorator(_func)
+    *,
+    cache_dir: Optional[Union[str, Path]] = None,
+    compression: Optional[str] = None,
+    executor: Optional[ExecutorLiteral] = None,
+) -> Callable[[Callable[..., R]], Stage[R]]:
+    ...
+def stage(
+    func: Optional[Callable[..., R]] = None,
+    *,
+    cache_dir: Optional[Union[str, Path]] = None,
+    compression: Optional[str] = None,
+    executor: Optional[ExecutorLiteral] = None,
+) -> Union[Stage[R], Callable[[Callable[..., R]], Stage[R]]]:
+    """
+    Turns a function into a stage. Can be used as "@stage" or with options, e.g.
+    "@stage(compression="lzma")" or "@stage(executor="process")" for executing a
+    CPU-bound stage in a worker process.
+    """
+    def stage_decorator(func: Callable[..., R]) -> Stage[R]:
+        return Stage(
+            func,
+            cache_dir=Path(cache_dir) if cache_dir is not None else None,
+            compression=compression,
+            executor=executor,
+        )
+
+    if func is None:
+        return stage_decorator
+    return stage_decorator(func)
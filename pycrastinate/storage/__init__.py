@@ -0,0 +1,62 @@
+from pathlib import Path
+from typing import (
+    Dict,
+    Tuple,
+)
+import os
+import threading
+
+from ..config import (
+    STORAGE_FILESYSTEM,
+    STORAGE_SQLITE,
+    STORAGE_MEMORY,
+    StorageLiteral,
+    get_storage_backend,
+)
+from .backend import StorageBackend
+from .filesystem import FileSystemStorage
+from .sqlite import SQLiteStorage
+from .memory import MemoryStorage
+
+
+# Backends are opened per process, database connections can't be shared with
+# forked processes
+_storages: Dict[Tuple[StorageLiteral, Path, int], StorageBackend] = {}
+_storages_lock = threading.Lock()
+
+
+def get_storage(root: Path) -> StorageBackend:
+    """
+    Returns the configured storage backend for the cache dir.
+    """
+    storage_backend = get_storage_backend()
+    storage_key = (storage_backend, root, os.getpid())
+    storage = _storages.get(storage_key, None)
+    if storage is None:
+        with _storages_lock:
+            storage = _storages.get(storage_key, None)
+            if storage is None:
+                storage = _open_storage(storage_backend, root)
+                _storages[storage_key] = storage
+    return storage
+
+
+def close_storages() -> None:
+    """
+    Closes all storage backends. This discards the objects of in-memory storage.
+    """
+    with _storages_lock:
+        for (_, _, pid), storage in _storages.items():
+            if pid == os.getpid():
+                storage.close()
+        _storages.clear()
+
+
+def _open_storage(storage_backend: StorageLiteral, root: Path) -> StorageBackend:
+    if storage_backend == STORAGE_FILESYSTEM:
+        return FileSystemStorage(root)
+    elif storage_backend == STORAGE_SQLITE:
+        return SQLiteStorage(root)
+    elif storage_backend == STORAGE_MEMORY:
+        return MemoryStorage()
+    raise ValueError(f"Unsupported storage backend '{storage_backend}'")
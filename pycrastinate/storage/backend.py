@@ -0,0 +1,63 @@
+from abc import ABC, abstractmethod
+from typing import (
+    Any,
+    Iterator,
+    Optional,
+    Tuple,
+)
+
+from ..utils.persistence import ObjectSizes
+
+
+class StorageBackend(ABC):
+    """
+    Stores objects by key. Keys are relative paths with "/" as separator, e.g.
+    "stage_results/3f/a8...". Objects are encoded and compressed by the backend.
+    """
+
+    @abstractmethod
+    def save(
+        self,
+        key: str,
+        data: Any,
+        compression: Optional[str] = None,
+    ) -> ObjectSizes:
+        """
+        Saves the object compressed with the given codec, or the globally
+        configured codec if no codec is given.
+        """
+
+    @abstractmethod
+    def load(self, key: str) -> Optional[Tuple[Any, int]]:
+        """
+        Returns the object and the size of its encoding, or None if there is no
+        object with the key.
+        """
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> bool:
+        """
+        Deletes the object and returns whether it existed.
+        """
+
+    @abstractmethod
+    def list_objects(self, prefix: str) -> Iterator[Tuple[str, int]]:
+        """
+        Lists the keys starting with the prefix and the stored sizes of their
+        objects.
+        """
+
+    def pack(self, prefix: str) -> int:
+        """
+        Consolidates the objects with keys starting with the prefix into fewer
+        files, and returns the number of packed objects. Backends that don't store
+        objects in separate files have nothing to pack.
+        """
+        return 0
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,220 @@
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+import os
+import threading
+
+from ..utils.locking import LOCK_FILE_SUFFIX
+from ..utils.persistence import (
+    BLOB_FILE_SUFFIX,
+    TMP_FILE_SUFFIX,
+    ObjectSizes,
+    get_blob_path,
+    save_object,
+    load_object_with_size,
+    decode_object,
+)
+from .backend import StorageBackend
+from .packs import PACK_DIR_NAME, HASH_LENGTH, PackSet
+
+
+class FileSystemStorage(StorageBackend):
+    """
+    Stores every object in its own file below the root directory. Large buffers
+    are stored in separate blob files, which are memory-mapped when loading.
+
+    Objects with sharded hash keys like "stage_results/3f/a8..." can be packed into
+    pack files in the "pack" subdirectory of their prefix, e.g. "stage_results/pack".
+    New objects are written as loose files until the next pack. Packs are searched
+    before loose files, since most objects are packed in large caches.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self._pack_sets: Dict[Path, PackSet] = {}
+        self._pack_sets_lock = threading.Lock()
+
+    def save(
+        self,
+        key: str,
+        data: Any,
+        compression: Optional[str] = None,
+    ) -> ObjectSizes:
+        object_sizes = save_object(self.root / key, data, compression)
+        # Packs are searched first, so the loose object replaces the packed one.
+        # Only the known packs are searched, packs of other processes would have
+        # been written from an earlier version of the object.
+        self._delete_packed(key, refresh=False)
+        return object_sizes
+
+    def load(self, key: str) -> Optional[Tuple[Any, int]]:
+        stored_data = self._read_packed(key, refresh=False)
+        if stored_data is None:
+            loaded_object = load_object_with_size(self.root / key)
+            if loaded_object is not None:
+                return loaded_object
+            # The object may have been packed by another process
+            stored_data = self._read_packed(key, refresh=True)
+            if stored_data is None:
+                return None
+        return decode_object(stored_data, key)
+
+    def exists(self, key: str) -> bool:
+        return (
+            self._read_packed(key, refresh=False) is not None
+            or (self.root / key).is_file()
+            or self._read_packed(key, refresh=True) is not None
+        )
+
+    def delete(self, key: str) -> bool:
+        object_file = self.root / key
+        try:
+            get_blob_path(object_file).unlink()
+        except FileNotFoundError:
+            pass
+        try:
+            object_file.unlink()
+            deleted = True
+        except FileNotFoundError:
+            deleted = False
+        return self._delete_packed(key) or deleted
+
+    def list_objects(self, prefix: str) -> Iterator[Tuple[str, int]]:
+        # The prefix is a directory, e.g. "stage_results/"
+        prefix_dir = self.root / prefix
+        listed_keys: Set[str] = set()
+        packed_dirs: List[Path] = []
+        for dir_path, dir_names, file_names in os.walk(prefix_dir):
+            if PACK_DIR_NAME in dir_names:
+                dir_names.remove(PACK_DIR_NAME)
+                packed_dirs.append(Path(dir_path))
+            for file_name in file_names:
+                if (
+                    file_name.endswith(BLOB_FILE_SUFFIX)
+                    or file_name.endswith(TMP_FILE_SUFFIX)
+                    or file_name.endswith(LOCK_FILE_SUFFIX)
+                ):
+                    continue
+                object_file = Path(dir_path) / file_name
+                try:
+                    stored_size = object_file.stat().st_size
+                    blob_file = get_blob_path(object_file)
+                    if blob_file.exists():
+                        stored_size += blob_file.stat().st_size
+                except FileNotFoundError:
+                    # Deleted concurrently
+                    continue
+                key = object_file.relative_to(self.root).as_posix()
+                listed_keys.add(key)
+                yield key, stored_size
+
+        for packed_dir in packed_dirs:
+            for hash, stored_size in self._get_pack_set(packed_dir).iter_entries():
+                key = _get_packed_key(packed_dir.relative_to(self.root), hash)
+                if key not in listed_keys:
+                    yield key, stored_size
+
+    def pack(self, prefix: str) -> int:
+        prefix_dir = self.root / prefix
+        loose_objects = []
+        for shard_dir in _iter_dirs(prefix_dir):
+            if not _is_shard_name(shard_dir.name):
+                continue
+            for object_file in shard_dir.iterdir():
+                if (
+                    object_file.name.endswith(BLOB_FILE_SUFFIX)
+                    or object_file.name.endswith(TMP_FILE_SUFFIX)
+                    or get_blob_path(object_file).exists()
+                ):
+                    # Objects with blob files stay loose, so that their buffers
+                    # can still be memory-mapped separately
+                    continue
+                try:
+                    hash = bytes.fromhex(shard_dir.name + object_file.name)
+                except ValueError:
+                    continue
+                if len(hash) == HASH_LENGTH:
+                    loose_objects.append((hash, object_file))
+
+        packed_files = self._get_pack_set(prefix_dir).repack(loose_objects)
+        for object_file in packed_files:
+            try:
+                object_file.unlink()
+            except FileNotFoundError:
+                pass
+        return len(packed_files)
+
+    def close(self) -> None:
+        with self._pack_sets_lock:
+            self._pack_sets.clear()
+
+    def _read_packed(self, key: str, refresh: bool) -> Optional[memoryview]:
+        packed_key = _split_packed_key(key)
+        if packed_key is None:
+            return None
+        prefix_dir, hash = packed_key
+        return self._get_pack_set(prefix_dir).read(hash, refresh)
+
+    def _delete_packed(self, key: str, refresh: bool = True) -> bool:
+        packed_key = _split_packed_key(key)
+        if packed_key is None:
+            return False
+        prefix_dir, hash = packed_key
+        return self._get_pack_set(prefix_dir).delete(hash, refresh)
+
+    def _get_pack_set(self, prefix_dir: Union[str, Path]) -> PackSet:
+        pack_dir = self.root / prefix_dir / PACK_DIR_NAME
+        pack_set = self._pack_sets.get(pack_dir, None)
+        if pack_set is None:
+            with self._pack_sets_lock:
+                pack_set = self._pack_sets.setdefault(pack_dir, PackSet(pack_dir))
+        return pack_set
+
+
+SHARD_NAME_LENGTH = 2
+
+
+def _split_packed_key(key: str) -> Optional[Tuple[str, bytes]]:
+    # Splits e.g. "stage_results/3f/a8..." into "stage_results" and the hash
+    key_parts = key.rsplit("/", 2)
+    if len(key_parts) != 3 or not _is_shard_name(key_parts[1]):
+        return None
+    prefix_dir, shard_name, file_name = key_parts
+    if len(shard_name) + len(file_name) != 2 * HASH_LENGTH:
+        return None
+    try:
+        return prefix_dir, bytes.fromhex(shard_name + file_name)
+    except ValueError:
+        return None
+
+
+def _get_packed_key(prefix_dir: Path, hash: bytes) -> str:
+    encoded_hash = hash.hex()
+    return (
+        f"{prefix_dir.as_posix()}/{encoded_hash[:SHARD_NAME_LENGTH]}/"
+        f"{encoded_hash[SHARD_NAME_LENGTH:]}"
+    )
+
+
+def _is_shard_name(name: str) -> bool:
+    return len(name) == SHARD_NAME_LENGTH and all(
+        char in "0123456789abcdef" for char in name
+    )
+
+
+def _iter_dirs(parent_dir: Path) -> Iterator[Path]:
+    try:
+        child_paths = list(parent_dir.iterdir())
+    except FileNotFoundError:
+        return
+    for child_path in child_paths:
+        if child_path.is_dir():
+            yield child_path
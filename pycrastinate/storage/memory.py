@@ -0,0 +1,57 @@
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    Optional,
+    Tuple,
+)
+import threading
+
+from ..utils.encoding import CODEC_NONE
+from ..utils.persistence import ObjectSizes, encode_object, decode_object
+from .backend import StorageBackend
+
+
+class MemoryStorage(StorageBackend):
+    """
+    Keeps all objects in memory, for tests and ephemeral runs. Objects are stored
+    encoded, so that every load returns a new copy like the other backends, but
+    they are never compressed.
+    """
+
+    def __init__(self) -> None:
+        self._objects: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def save(
+        self,
+        key: str,
+        data: Any,
+        compression: Optional[str] = None,
+    ) -> ObjectSizes:
+        stored_data, object_sizes = encode_object(data, CODEC_NONE)
+        with self._lock:
+            self._objects[key] = stored_data
+        return object_sizes
+
+    def load(self, key: str) -> Optional[Tuple[Any, int]]:
+        stored_data = self._objects.get(key, None)
+        if stored_data is None:
+            return None
+        return decode_object(stored_data, key)
+
+    def exists(self, key: str) -> bool:
+        return key in self._objects
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._objects.pop(key, None) is not None
+
+    def list_objects(self, prefix: str) -> Iterator[Tuple[str, int]]:
+        with self._lock:
+            objects = [
+                (key, len(stored_data))
+                for key, stored_data in self._objects.items()
+                if key.startswith(prefix)
+            ]
+        return iter(objects)
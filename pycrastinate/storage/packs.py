@@ -0,0 +1,282 @@
+from pathlib import Path
+from typing import (
+    ContextManager,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+from ..config import (
+    get_fsync_enabled,
+    get_single_flight_timeout,
+    get_stale_lock_age,
+)
+from ..utils.locking import LOCK_FILE_SUFFIX, hold_lock_file
+from ..utils.persistence import get_tmp_path, write_file_atomically
+
+
+# Like Git packfiles, packs consolidate many small objects into a few large files.
+# Objects are addressed by the hashes encoded in their sharded keys, e.g. the key
+# "stage_results/3f/a8..." has the hash "3fa8...". Every pack consists of a pack
+# file with the stored objects and an index file with the sorted hashes and the
+# offsets and sizes of their objects, which is searched with a binary search.
+# Deleted packed objects are recorded as tombstones until the next repack. Repacks
+# and deletions of packed objects hold a lock file next to the pack directory, so
+# that concurrent repacks don't drop each other's packs or tombstones.
+
+PACK_DIR_NAME = "pack"
+PACK_FILE_SUFFIX = ".pack"
+PACK_INDEX_FILE_SUFFIX = ".idx"
+TOMBSTONES_FILE_NAME = "tombstones"
+PACK_FILE_MAGIC = b"PYCRPACK"
+PACK_INDEX_FILE_MAGIC = b"PYCRPIDX"
+
+HASH_LENGTH = 32
+_INDEX_HEADER_FORMAT = struct.Struct("<8sQ")
+# Hash, offset and size of an object
+_INDEX_ENTRY_FORMAT = struct.Struct(f"<{HASH_LENGTH}sQQ")
+
+
+class _Pack:
+    def __init__(self, index_file: Path) -> None:
+        pack_file = index_file.with_suffix(PACK_FILE_SUFFIX)
+        # Packs are never modified, so their mappings stay valid even after they
+        # were replaced by a repack
+        self.index_map = _map_file(index_file)
+        self.pack_map = _map_file(pack_file)
+        magic, self.num_entries = _INDEX_HEADER_FORMAT.unpack_from(self.index_map, 0)
+        if (
+            magic != PACK_INDEX_FILE_MAGIC
+            or self.pack_map[:len(PACK_FILE_MAGIC)] != PACK_FILE_MAGIC
+        ):
+            raise ValueError(f"'{index_file}' is not a valid pack")
+
+    def find(self, hash: bytes) -> Optional[memoryview]:
+        low, high = 0, self.num_entries
+        while low < high:
+            middle = (low + high) // 2
+            entry_hash, offset, size = self._get_entry(middle)
+            if entry_hash < hash:
+                low = middle + 1
+            elif entry_hash > hash:
+                high = middle
+            else:
+                return memoryview(self.pack_map)[offset:offset + size]
+        return None
+
+    def iter_entries(self) -> Iterator[Tuple[bytes, int, int]]:
+        for entry_idx in range(self.num_entries):
+            yield self._get_entry(entry_idx)
+
+    def _get_entry(self, entry_idx: int) -> Tuple[bytes, int, int]:
+        return _INDEX_ENTRY_FORMAT.unpack_from(
+            self.index_map,
+            _INDEX_HEADER_FORMAT.size + entry_idx * _INDEX_ENTRY_FORMAT.size,
+        )
+
+
+class PackSet:
+    """
+    The packs in a pack directory. Packs written by other processes are loaded
+    when an object isn't found.
+    """
+
+    def __init__(self, pack_dir: Path) -> None:
+        self.pack_dir = pack_dir
+        self._packs: Dict[str, _Pack] = {}
+        self._tombstones: Set[bytes] = set()
+        self._state: Optional[Tuple[int, int]] = None
+        self._lock = threading.Lock()
+
+    def read(self, hash: bytes, refresh: bool = True) -> Optional[memoryview]:
+        """
+        Returns the stored data of the object. Unless refresh is False, new packs
+        are loaded if the object isn't found.
+        """
+        stored_data = self._find(hash)
+        if stored_data is None and refresh and self._refresh():
+            stored_data = self._find(hash)
+        return stored_data
+
+    def delete(self, hash: bytes, refresh: bool = True) -> bool:
+        """
+        Records a tombstone for the packed object and returns whether it existed.
+        Unless refresh is False, new packs are loaded if the object isn't found.
+        """
+        # The packs are loaded at least once
+        if self.read(hash, refresh or self._state is None) is None:
+            return False
+        with self._hold_lock(), self._lock:
+            with open(self.pack_dir / TOMBSTONES_FILE_NAME, "ab") as file:
+                file.write(hash)
+            self._tombstones.add(hash)
+        return True
+
+    def iter_entries(self) -> Iterator[Tuple[bytes, int]]:
+        """
+        Lists the hashes of the packed objects and their sizes.
+        """
+        self._refresh()
+        with self._lock:
+            packs = list(self._packs.values())
+            tombstones = set(self._tombstones)
+        listed_hashes: Set[bytes] = set()
+        for pack in packs:
+            for hash, _, size in pack.iter_entries():
+                if hash not in tombstones and hash not in listed_hashes:
+                    listed_hashes.add(hash)
+                    yield hash, size
+
+    def repack(self, loose_objects: Iterable[Tuple[bytes, Path]]) -> List[Path]:
+        """
+        Writes a single pack with the given loose objects and all objects of the
+        existing packs, and removes the existing packs. Loose objects replace packed
+        objects with the same hash. Returns the loose files that were packed, which
+        can be removed afterwards.
+        """
+        with self._hold_lock() as acquired:
+            if not acquired:
+                # Another process is still repacking, the objects stay loose
+                return []
+            return self._repack(loose_objects)
+
+    def _repack(self, loose_objects: Iterable[Tuple[bytes, Path]]) -> List[Path]:
+        self._refresh()
+        self.pack_dir.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            old_packs = dict(self._packs)
+            tombstones = set(self._tombstones)
+
+        tmp_pack_file = get_tmp_path(self.pack_dir / ("pack" + PACK_FILE_SUFFIX))
+        entries: Dict[bytes, Tuple[int, int]] = {}
+        packed_files: List[Path] = []
+        with open(tmp_pack_file, "wb") as pack_file:
+            pack_file.write(PACK_FILE_MAGIC)
+            offset = len(PACK_FILE_MAGIC)
+            for hash, loose_file in loose_objects:
+                try:
+                    stored_data = loose_file.read_bytes()
+                except FileNotFoundError:
+                    continue
+                pack_file.write(stored_data)
+                entries[hash] = (offset, len(stored_data))
+                offset += len(stored_data)
+                packed_files.append(loose_file)
+            for pack in old_packs.values():
+                for hash, packed_offset, size in pack.iter_entries():
+                    if hash in entries or hash in tombstones:
+                        continue
+                    pack_file.write(pack.pack_map[packed_offset:packed_offset + size])
+                    entries[hash] = (offset, size)
+                    offset += size
+            if get_fsync_enabled():
+                pack_file.flush()
+                os.fsync(pack_file.fileno())
+
+        index_data = bytearray(
+            _INDEX_HEADER_FORMAT.pack(PACK_INDEX_FILE_MAGIC, len(entries))
+        )
+        for hash in sorted(entries.keys()):
+            index_data += _INDEX_ENTRY_FORMAT.pack(hash, *entries[hash])
+        pack_name = "pack-" + hashlib.sha256(index_data).hexdigest()
+        os.replace(tmp_pack_file, self.pack_dir / (pack_name + PACK_FILE_SUFFIX))
+        # A pack is only used once its index exists
+        write_file_atomically(
+            self.pack_dir / (pack_name + PACK_INDEX_FILE_SUFFIX), [index_data]
+        )
+        for old_pack_name in old_packs.keys():
+            if old_pack_name != pack_name:
+                for suffix in (PACK_INDEX_FILE_SUFFIX, PACK_FILE_SUFFIX):
+                    _unlink(self.pack_dir / (old_pack_name + suffix))
+        # Only the tombstones of objects that weren't packed again are removed
+        tombstones_file = self.pack_dir / TOMBSTONES_FILE_NAME
+        remaining_tombstones = _read_tombstones(tombstones_file) - tombstones
+        if len(remaining_tombstones) > 0:
+            write_file_atomically(tombstones_file, sorted(remaining_tombstones))
+        else:
+            _unlink(tombstones_file)
+        self._refresh()
+        return packed_files
+
+    def _hold_lock(self) -> ContextManager[bool]:
+        return hold_lock_file(
+            self.pack_dir.with_name(PACK_DIR_NAME + LOCK_FILE_SUFFIX),
+            get_single_flight_timeout(),
+            get_stale_lock_age(),
+        )
+
+    def _find(self, hash: bytes) -> Optional[memoryview]:
+        with self._lock:
+            if hash in self._tombstones:
+                return None
+            for pack in self._packs.values():
+                stored_data = pack.find(hash)
+                if stored_data is not None:
+                    return stored_data
+        return None
+
+    def _refresh(self) -> bool:
+        # The pack directory changes when packs are added or removed
+        try:
+            dir_mtime_ns = os.stat(self.pack_dir).st_mtime_ns
+        except FileNotFoundError:
+            dir_mtime_ns = 0
+        try:
+            tombstones_size = os.stat(self.pack_dir / TOMBSTONES_FILE_NAME).st_size
+        except FileNotFoundError:
+            tombstones_size = 0
+        state = (dir_mtime_ns, tombstones_size)
+
+        with self._lock:
+            if state == self._state:
+                return False
+            packs = {}
+            if dir_mtime_ns != 0:
+                for file_name in os.listdir(self.pack_dir):
+                    if not file_name.endswith(PACK_INDEX_FILE_SUFFIX):
+                        continue
+                    pack_name = file_name[:-len(PACK_INDEX_FILE_SUFFIX)]
+                    pack = self._packs.get(pack_name, None)
+                    if pack is None:
+                        try:
+                            pack = _Pack(self.pack_dir / file_name)
+                        except FileNotFoundError:
+                            # Removed by a concurrent repack
+                            continue
+                    packs[pack_name] = pack
+            self._packs = packs
+            self._tombstones = _read_tombstones(self.pack_dir / TOMBSTONES_FILE_NAME)
+            self._state = state
+            return True
+
+
+def _map_file(file_path: Path) -> mmap.mmap:
+    with open(file_path, "rb") as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _read_tombstones(tombstones_file: Path) -> Set[bytes]:
+    try:
+        tombstones_data = tombstones_file.read_bytes()
+    except FileNotFoundError:
+        return set()
+    return {
+        tombstones_data[offset:offset + HASH_LENGTH]
+        for offset in range(0, len(tombstones_data) - HASH_LENGTH + 1, HASH_LENGTH)
+    }
+
+
+def _unlink(file_path: Path) -> None:
+    try:
+        file_path.unlink()
+    except FileNotFoundError:
+        pass
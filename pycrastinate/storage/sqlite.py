@@ -0,0 +1,93 @@
+from pathlib import Path
+from typing import (
+    Any,
+    Iterator,
+    Optional,
+    Tuple,
+)
+import sqlite3
+import threading
+
+from ..config import get_fsync_enabled
+from ..utils.persistence import ObjectSizes, encode_object, decode_object
+from .backend import StorageBackend
+
+
+SQLITE_STORAGE_FILE_NAME = "storage.sqlite3"
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    Stores all objects in a single SQLite database in the root directory, which
+    avoids creating a file per object.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            root / SQLITE_STORAGE_FILE_NAME,
+            timeout=60,
+            # The connection is guarded by the lock
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute(
+            "PRAGMA synchronous = " + ("FULL" if get_fsync_enabled() else "NORMAL")
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, data BLOB) "
+            "WITHOUT ROWID"
+        )
+
+    def save(
+        self,
+        key: str,
+        data: Any,
+        compression: Optional[str] = None,
+    ) -> ObjectSizes:
+        stored_data, object_sizes = encode_object(data, compression)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?)", (key, stored_data)
+            )
+        return object_sizes
+
+    def load(self, key: str) -> Optional[Tuple[Any, int]]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data FROM objects WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return decode_object(row[0], key)
+
+    def exists(self, key: str) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM objects WHERE key = ?", (key,)
+            ).fetchone()
+        return row is not None
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            cursor = self._connection.execute(
+                "DELETE FROM objects WHERE key = ?", (key,)
+            )
+        return cursor.rowcount > 0
+
+    def list_objects(self, prefix: str) -> Iterator[Tuple[str, int]]:
+        # Keys are compared as text, so all keys with the prefix sort between the
+        # prefix and the prefix followed by the largest code point
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key, length(data) FROM objects WHERE key >= ? AND key < ?",
+                (prefix, prefix + "\U0010ffff"),
+            ).fetchall()
+        return iter(rows)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -4,9 +4,11 @@ from typing import (
     Callable,
     Dict,
     Optional,
+    Tuple,
 )
 
 from ..args import Args
+from .hashing import compute_value_hash
 
 
 class ArgsAggregationResult:
@@ -19,6 +21,8 @@ class ArgsAggregationResult:
         self.data_dependencies: Dict[str, ResultDependency] = {}
         self.data_dependency_args: Dict[str, Args] = {}
         self.func_dependencies: Dict[str, FunctionDependency] = {}
+        # Hashes of non-dependency arguments that are known in advance
+        self.non_dependency_hashes: Dict[str, bytes] = {}
 
     def __eq__(self, other: Any) -> bool:
         if not isinstance(other, ArgsAggregationResult):
@@ -30,73 +34,191 @@ class ArgsAggregationResult:
             and self.func_dependencies == other.func_dependencies
         )
 
-
-def aggregate_args(
-    func: Callable, args: Optional[Args] = None
-) -> ArgsAggregationResult:
-    from ..dependencies import ResultDependency
-    from ..dependencies import FunctionDependency
-
-    aggregation_result = ArgsAggregationResult()
-
-    signature = inspect.signature(func)
-    arg_pos = -1
-    for arg_name, arg_desc in signature.parameters.items():
-        arg_pos += 1
-        if args and arg_pos < len(args.args):
-            # The argument was provided as a positional parameter
-            arg_value = args.args[arg_pos]
-            arg_set = True
-        elif args and arg_name in args.kwargs:
-            # The argument was provided as a named parameter
-            arg_value = args.kwargs[arg_name]
-            arg_set = True
-        else:
-            arg_value = None
-            arg_set = False
-
-        if arg_set and isinstance(arg_value, ResultDependency):
-            raise ValueError(
-                "Argument of result dependency type (UseRes()) passed as value "
-                f"for parameter '{arg_name}' "
-                "but result dependency arguments are only supported as default values "
-                "via 'UseRes()'."
-            )
-        elif arg_set and isinstance(arg_value, FunctionDependency):
-            raise ValueError(
-                "Argument of function dependency type (UseFn()) passed as value "
-                f"for parameter '{arg_name}' "
-                "but function dependency arguments are only supported as default "
-                "values via 'UseFn()'."
-            )
-        elif arg_set and isinstance(arg_value, Args) and (
-            arg_desc.default is inspect.Parameter.empty
-            or not isinstance(arg_desc.default, ResultDependency)
-        ):
-            raise ValueError(
-                f"Passed argument of type 'Args' to parameter '{arg_name}' "
-                f"but '{arg_name}' is not declared as data dependency (UseRes())."
-                f"instead: {type(arg_desc.default)}"
+    def compute_non_dependency_hashes(self) -> Dict[str, bytes]:
+        return {
+            arg_name: (
+                self.non_dependency_hashes[arg_name]
+                if arg_name in self.non_dependency_hashes
+                else compute_value_hash(arg_value)
             )
+            for arg_name, arg_value in self.non_dependency_args.items()
+        }
 
-        if arg_set:
-            if isinstance(arg_value, Args):
-                aggregation_result.data_dependency_args[arg_name] = arg_value
+
+# Kinds of function parameters, distinguished by their default values
+PARAM_NO_DEFAULT = 0
+PARAM_VALUE = 1
+PARAM_RESULT = 2
+PARAM_FUNCTION = 3
+
+
+class ArgumentPlan:
+    """
+    The parameters of a function and their classified default values.
+    Building the plan is expensive, so it should be done once per function.
+    Caller-supplied arguments are then merged into the plan on each call.
+    """
+
+    __slots__ = (
+        "parameters",
+        "default_values",
+        "_default_aggregation",
+        "_default_hashes",
+    )
+
+    def __init__(self, func: Callable) -> None:
+        from ..dependencies import ResultDependency
+        from ..dependencies import FunctionDependency
+
+        parameters = []
+        default_aggregation = ArgsAggregationResult()
+        for arg_name, arg_desc in inspect.signature(func).parameters.items():
+            default_value = arg_desc.default
+            if default_value is inspect.Parameter.empty:
+                param_kind = PARAM_NO_DEFAULT
+            elif isinstance(default_value, ResultDependency):
+                param_kind = PARAM_RESULT
+                default_aggregation.data_dependencies[arg_name] = default_value
+            elif isinstance(default_value, FunctionDependency):
+                param_kind = PARAM_FUNCTION
+                default_aggregation.func_dependencies[arg_name] = default_value
             else:
-                aggregation_result.non_dependency_args[arg_name] = arg_value
+                param_kind = PARAM_VALUE
+                default_aggregation.non_dependency_args[arg_name] = default_value
+            parameters.append((arg_name, param_kind, default_value))
+
+        _set = super().__setattr__
+        _set("parameters", tuple(parameters))
+        _set("default_values", {
+            arg_name: default_value
+            for arg_name, param_kind, default_value in parameters
+            if param_kind != PARAM_NO_DEFAULT
+        })
+        _set("_default_aggregation", default_aggregation)
+        _set("_default_hashes", None)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("Argument plans are immutable")
+
+    @property
+    def data_dependencies(self):
+        return self._default_aggregation.data_dependencies
+
+    @property
+    def func_dependencies(self):
+        return self._default_aggregation.func_dependencies
+
+    @property
+    def default_hashes(self) -> Dict[str, bytes]:
+        """
+        The hashes of the immutable, non-dependency default values. Mutable
+        default values might change between calls and are hashed on every call.
+        """
+        default_hashes = self._default_hashes
+        if default_hashes is None:
+            default_hashes = {
+                arg_name: compute_value_hash(default_value)
+                for arg_name, default_value
+                in self._default_aggregation.non_dependency_args.items()
+                if _is_immutable(default_value)
+            }
+            super().__setattr__("_default_hashes", default_hashes)
+        return default_hashes
+
+    def aggregate(self, args: Optional[Args] = None) -> ArgsAggregationResult:
+        if args is None or (len(args.args) == 0 and len(args.kwargs) == 0):
+            return self._aggregate_defaults()
 
-        if (
-            arg_desc.default is not inspect.Parameter.empty
-            # Don't override the actual with the default arguments
-            and (not arg_set or isinstance(arg_value, Args))
+        from ..dependencies import ResultDependency
+        from ..dependencies import FunctionDependency
+
+        aggregation_result = ArgsAggregationResult()
+        default_hashes = self.default_hashes
+        passed_values = args.args
+        passed_kwargs = args.kwargs
+        num_passed_values = len(passed_values)
+
+        for arg_pos, (arg_name, param_kind, default_value) in enumerate(
+            self.parameters
         ):
-            default_value = arg_desc.default
-            if isinstance(default_value, ResultDependency):
+            if arg_pos < num_passed_values:
+                # The argument was provided as a positional parameter
+                arg_value = passed_values[arg_pos]
+            elif arg_name in passed_kwargs:
+                # The argument was provided as a named parameter
+                arg_value = passed_kwargs[arg_name]
+            else:
+                if param_kind == PARAM_VALUE:
+                    aggregation_result.non_dependency_args[arg_name] = default_value
+                    if arg_name in default_hashes:
+                        aggregation_result.non_dependency_hashes[arg_name] = (
+                            default_hashes[arg_name]
+                        )
+                elif param_kind == PARAM_RESULT:
+                    aggregation_result.data_dependencies[arg_name] = default_value
+                elif param_kind == PARAM_FUNCTION:
+                    aggregation_result.func_dependencies[arg_name] = default_value
+                continue
+
+            if isinstance(arg_value, ResultDependency):
+                raise ValueError(
+                    "Argument of result dependency type (UseRes()) passed as value "
+                    f"for parameter '{arg_name}' "
+                    "but result dependency arguments are only supported as default "
+                    "values via 'UseRes()'."
+                )
+            elif isinstance(arg_value, FunctionDependency):
+                raise ValueError(
+                    "Argument of function dependency type (UseFn()) passed as value "
+                    f"for parameter '{arg_name}' "
+                    "but function dependency arguments are only supported as default "
+                    "values via 'UseFn()'."
+                )
+            elif isinstance(arg_value, Args):
+                if param_kind != PARAM_RESULT:
+                    raise ValueError(
+                        f"Passed argument of type 'Args' to parameter '{arg_name}' "
+                        f"but '{arg_name}' is not declared as data dependency "
+                        f"(UseRes()).instead: {type(default_value)}"
+                    )
+                aggregation_result.data_dependency_args[arg_name] = arg_value
                 aggregation_result.data_dependencies[arg_name] = default_value
-            elif isinstance(default_value, FunctionDependency):
-                aggregation_result.func_dependencies[arg_name] = default_value
-            # TODO: make sure that default Args arguments don't overwrite passed ones
             else:
-                aggregation_result.non_dependency_args[arg_name] = default_value
+                aggregation_result.non_dependency_args[arg_name] = arg_value
+
+        return aggregation_result
+
+    def _aggregate_defaults(self) -> ArgsAggregationResult:
+        default_aggregation = self._default_aggregation
+        aggregation_result = ArgsAggregationResult()
+        aggregation_result.non_dependency_args = dict(
+            default_aggregation.non_dependency_args
+        )
+        aggregation_result.data_dependencies = dict(
+            default_aggregation.data_dependencies
+        )
+        aggregation_result.func_dependencies = dict(
+            default_aggregation.func_dependencies
+        )
+        aggregation_result.non_dependency_hashes = dict(self.default_hashes)
+        return aggregation_result
+
+
+def aggregate_args(
+    func: Callable, args: Optional[Args] = None
+) -> ArgsAggregationResult:
+    return ArgumentPlan(func).aggregate(args)
+
+
+_IMMUTABLE_TYPES: Tuple[type, ...] = (
+    type(None), bool, int, float, complex, str, bytes,
+)
+
 
-    return aggregation_result
+def _is_immutable(value: Any) -> bool:
+    value_type = type(value)
+    if value_type in _IMMUTABLE_TYPES:
+        return True
+    elif value_type is tuple or value_type is frozenset:
+        return all(_is_immutable(element) for element in value)
+    return False
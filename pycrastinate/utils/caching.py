@@ -0,0 +1,148 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import (
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+import threading
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def __post_init__(self) -> None:
+        self._lock = threading.Lock()
+
+    def record_hit(self) -> None:
+        with self._lock:
+            self.hits += 1
+
+    def record_miss(self) -> None:
+        with self._lock:
+            self.misses += 1
+
+    def record_eviction(self) -> None:
+        with self._lock:
+            self.evictions += 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def snapshot(self) -> "CacheStats":
+        with self._lock:
+            return CacheStats(
+                hits=self.hits, misses=self.misses, evictions=self.evictions
+            )
+
+
+class SizedLRUCache(Generic[K, V]):
+    """
+    A thread-safe cache that evicts the least recently used entries once the total
+    size of its entries exceeds a byte budget. Pinned entries are never evicted.
+    """
+
+    def __init__(self, get_max_size: Callable[[], int]) -> None:
+        # The budget is looked up on every insertion, so changes apply immediately
+        self._get_max_size = get_max_size
+        self._entries: "OrderedDict[K, Tuple[V, int]]" = OrderedDict()
+        self._pinned_entries: Dict[K, Tuple[V, int]] = {}
+        self._pinned_keys: Set[K] = set()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.stats = CacheStats()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __contains__(self, key: K) -> bool:
+        with self._lock:
+            return key in self._pinned_entries or key in self._entries
+
+    def get(self, key: K) -> Optional[V]:
+        with self._lock:
+            entry = self._pinned_entries.get(key, None)
+            if entry is None:
+                entry = self._entries.get(key, None)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+        if entry is None:
+            self.stats.record_miss()
+            return None
+        self.stats.record_hit()
+        return entry[0]
+
+    def put(self, key: K, value: V, size: int) -> None:
+        max_size = self._get_max_size()
+        with self._lock:
+            self._discard(key)
+            if key in self._pinned_keys:
+                self._pinned_entries[key] = (value, size)
+            elif size <= max_size:
+                self._entries[key] = (value, size)
+            else:
+                return
+            self._size += size
+            self._evict(max_size)
+
+    def pin(self, key: K) -> None:
+        """
+        Keeps the entry of the key in the cache until it's unpinned, including
+        entries that are only added later.
+        """
+        with self._lock:
+            self._pinned_keys.add(key)
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._pinned_entries[key] = entry
+
+    def unpin(self, key: K) -> None:
+        max_size = self._get_max_size()
+        with self._lock:
+            self._pinned_keys.discard(key)
+            entry = self._pinned_entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self._evict(max_size)
+
+    def discard(self, key: K) -> None:
+        with self._lock:
+            self._discard(key)
+
+    def clear(self) -> None:
+        """
+        Removes all entries. Pinned keys stay pinned.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._pinned_entries.clear()
+            self._size = 0
+
+    def _discard(self, key: K) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            entry = self._pinned_entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def _evict(self, max_size: int) -> None:
+        while self._size > max_size and len(self._entries) > 0:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._size -= size
+            self.stats.record_eviction()
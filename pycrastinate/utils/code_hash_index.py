@@ -0,0 +1,175 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import (
+    Dict,
+    Optional,
+    Tuple,
+)
+from types import CodeType
+import atexit
+import hashlib
+import logging
+import os
+import threading
+
+from ..config import get_cache_dir
+from ..storage import StorageBackend, get_storage
+
+
+# The code hash index persists code hashes across processes, so that new processes
+# don't have to parse the source code of every function again. Entries are grouped
+# by source file and are only valid as long as the file's size and modification
+# time don't change. Code hashes don't depend on where results are stored, so the
+# index is global: it's kept in the globally configured cache dir, also for stages
+# with a cache dir of their own.
+
+CODE_HASH_INDEX_DIR_NAME = "code_hashes"
+
+# (qualified function name, first line number)
+_FunctionKey = Tuple[str, int]
+
+
+@dataclass
+class SourceFileIndex:
+    source_file: str
+    file_size: int
+    file_mtime_ns: int
+    code_hashes: Dict[_FunctionKey, bytes] = field(default_factory=dict)
+
+
+class _LoadedIndex:
+    def __init__(
+        self,
+        storage: StorageBackend,
+        index_key: str,
+        index: Optional[SourceFileIndex],
+    ) -> None:
+        self.storage = storage
+        self.index_key = index_key
+        self.index = index
+        self.dirty = False
+
+
+_loaded_indexes: Dict[Tuple[Path, str], _LoadedIndex] = {}
+_loaded_indexes_lock = threading.Lock()
+
+
+def lookup_code_hash(code: CodeType, qualified_name: str) -> Optional[bytes]:
+    """
+    Returns the persisted code hash of the function with the given code object if
+    its source file didn't change since the hash was recorded.
+    """
+    file_info = _get_source_file_info(code)
+    if file_info is None:
+        return None
+    source_file, file_size, file_mtime_ns = file_info
+
+    with _loaded_indexes_lock:
+        loaded_index = _get_loaded_index(source_file)
+        index = loaded_index.index
+        if (
+            index is None
+            or index.file_size != file_size
+            or index.file_mtime_ns != file_mtime_ns
+        ):
+            return None
+        return index.code_hashes.get((qualified_name, code.co_firstlineno), None)
+
+
+def record_code_hash(code: CodeType, qualified_name: str, code_hash: bytes) -> None:
+    file_info = _get_source_file_info(code)
+    if file_info is None:
+        return
+    source_file, file_size, file_mtime_ns = file_info
+
+    with _loaded_indexes_lock:
+        loaded_index = _get_loaded_index(source_file)
+        index = loaded_index.index
+        if (
+            index is None
+            or index.file_size != file_size
+            or index.file_mtime_ns != file_mtime_ns
+        ):
+            # The source file changed, all previously recorded hashes are stale
+            index = SourceFileIndex(source_file, file_size, file_mtime_ns)
+            loaded_index.index = index
+        index.code_hashes[(qualified_name, code.co_firstlineno)] = code_hash
+        loaded_index.dirty = True
+
+
+def flush_code_hash_index() -> None:
+    """
+    Persists all code hashes recorded by this process. This happens automatically
+    when the interpreter exits.
+    """
+    with _loaded_indexes_lock:
+        for loaded_index in _loaded_indexes.values():
+            if not loaded_index.dirty or loaded_index.index is None:
+                continue
+            index = loaded_index.index
+
+            # Keep the entries other processes recorded in the meantime
+            loaded_object = loaded_index.storage.load(loaded_index.index_key)
+            persisted_index: Optional[SourceFileIndex] = (
+                loaded_object[0] if loaded_object is not None else None
+            )
+            if (
+                persisted_index is not None
+                and persisted_index.file_size == index.file_size
+                and persisted_index.file_mtime_ns == index.file_mtime_ns
+            ):
+                index.code_hashes = {
+                    **persisted_index.code_hashes, **index.code_hashes
+                }
+
+            loaded_index.storage.save(loaded_index.index_key, index)
+            loaded_index.dirty = False
+
+
+def discard_loaded_code_hash_indexes() -> None:
+    with _loaded_indexes_lock:
+        _loaded_indexes.clear()
+
+
+def _get_loaded_index(source_file: str) -> _LoadedIndex:
+    cache_dir = get_cache_dir()
+    loaded_index = _loaded_indexes.get((cache_dir, source_file), None)
+    if loaded_index is None:
+        storage = get_storage(cache_dir)
+        index_key = _get_index_key(source_file)
+        loaded_object = storage.load(index_key)
+        loaded_index = _LoadedIndex(
+            storage,
+            index_key,
+            loaded_object[0] if loaded_object is not None else None,
+        )
+        _loaded_indexes[(cache_dir, source_file)] = loaded_index
+    return loaded_index
+
+
+def _get_index_key(source_file: str) -> str:
+    file_name = hashlib.sha256(bytes(source_file, "utf-8")).hexdigest()
+    return f"{CODE_HASH_INDEX_DIR_NAME}/{file_name}"
+
+
+def _get_source_file_info(code: CodeType) -> Optional[Tuple[str, int, int]]:
+    source_file = code.co_filename
+    if not os.path.isabs(source_file):
+        # Interactively defined functions (e.g. "<stdin>" or notebook cells)
+        return None
+    try:
+        file_stat = os.stat(source_file)
+    except OSError:
+        return None
+    return source_file, file_stat.st_size, file_stat.st_mtime_ns
+
+
+def _flush_at_exit() -> None:
+    # Errors at exit, e.g. of unpicklable or corrupt index entries, are only logged
+    try:
+        flush_code_hash_index()
+    except Exception as error:
+        logging.warning(f"Could not persist the code hash index: {error}")
+
+
+atexit.register(_flush_at_exit)
@@ -1,9 +1,25 @@
 import pickle
 import bz2
-from typing import Any
+import lzma
+import threading
+import zlib
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
 
 
+# Hashes are computed from this protocol, changing it changes all stage hashes
 PICKLE_PROTOCOL_VERSION = 4
+# Persisted objects use protocol 5 where available, which supports out-of-band
+# buffers
+STORAGE_PICKLE_PROTOCOL_VERSION = min(5, pickle.HIGHEST_PROTOCOL)
 
 
 def encode(data: Any) -> bytes:
@@ -11,13 +27,160 @@ def encode(data: Any) -> bytes:
     return pickle.dumps(data, protocol=PICKLE_PROTOCOL_VERSION)
 
 
-def decode(encoded_data: bytes) -> Any:
-    return pickle.loads(encoded_data)
+def encode_with_buffers(data: Any, min_buffer_size: int) -> Tuple[bytes, List[Any]]:
+    """
+    Encodes the data for storage. Contiguous buffers (e.g. of numpy arrays) of at
+    least min_buffer_size bytes are returned separately as pickle buffers instead
+    of being copied into the encoded data.
+    """
+    if STORAGE_PICKLE_PROTOCOL_VERSION < 5:
+        return encode(data), []
 
+    buffers: List[pickle.PickleBuffer] = []
 
-def compress(data: bytes) -> bytes:
-    return bz2.compress(data)
+    def buffer_callback(buffer: pickle.PickleBuffer) -> bool:
+        try:
+            buffer_size = buffer.raw().nbytes
+        except BufferError:
+            # Non-contiguous buffers are serialized in-band
+            return True
+        if buffer_size < min_buffer_size:
+            return True
+        buffers.append(buffer)
+        return False
+
+    encoded_data = pickle.dumps(
+        data, protocol=STORAGE_PICKLE_PROTOCOL_VERSION, buffer_callback=buffer_callback
+    )
+    return encoded_data, buffers
+
+
+def decode(encoded_data: bytes, buffers: Optional[Iterable[Any]] = None) -> Any:
+    """
+    Decodes the data. The out-of-band buffers are only consumed if the encoded
+    data refers to them.
+    """
+    if buffers is None or STORAGE_PICKLE_PROTOCOL_VERSION < 5:
+        return pickle.loads(encoded_data)
+    return pickle.loads(encoded_data, buffers=buffers)
+
+
+# Compressed data starts with a header naming the codec it was compressed with:
+# the magic bytes, the length of the codec name and the codec name.
+# Data without the header was written by older versions, which always used bz2.
+COMPRESSION_HEADER_MAGIC = b"PYCR"
+
+CODEC_NONE = "none"
+CODEC_ZLIB = "zlib"
+CODEC_LZMA = "lzma"
+CODEC_BZ2 = "bz2"
+
+LEGACY_CODEC = CODEC_BZ2
+
+
+@dataclass(frozen=True)
+class Codec:
+    name: str
+    # Takes the data and the compression level, which is None for the default level
+    compress: Callable[[bytes, Optional[int]], bytes]
+    decompress: Callable[[bytes], bytes]
+
+
+_codecs: Dict[str, Codec] = {}
+_codecs_lock = threading.Lock()
+
+
+def register_codec(
+    name: str,
+    compress: Callable[[bytes, Optional[int]], bytes],
+    decompress: Callable[[bytes], bytes],
+) -> None:
+    """
+    Registers a compression codec. The name is persisted with the compressed data,
+    so data compressed with a codec can only be loaded while it's registered.
+    """
+    encoded_name = bytes(name, "utf-8")
+    if len(encoded_name) == 0 or len(encoded_name) > 255 or ":" in name:
+        raise ValueError(f"Invalid codec name '{name}'")
+    with _codecs_lock:
+        _codecs[name] = Codec(name, compress, decompress)
+
+
+def get_codec(name: str) -> Codec:
+    codec = _codecs.get(name, None)
+    if codec is None:
+        raise ValueError(f"Unknown compression codec '{name}'")
+    return codec
+
+
+def parse_compression(compression: str) -> Tuple[Codec, Optional[int]]:
+    """
+    Parses a compression setting of the form "<codec>" or "<codec>:<level>",
+    e.g. "lzma" or "zlib:6".
+    """
+    codec_name, separator, level = compression.partition(":")
+    codec = get_codec(codec_name)
+    if separator == "":
+        return codec, None
+    try:
+        return codec, int(level)
+    except ValueError:
+        raise ValueError(
+            f"Invalid compression level '{level}' in '{compression}'"
+        ) from None
+
+
+def compress(data: bytes, compression: str) -> bytes:
+    header, compressed_data = compress_with_header(data, compression)
+    return header + compressed_data
+
+
+def compress_with_header(data: bytes, compression: str) -> Tuple[bytes, bytes]:
+    """
+    Returns the header and the compressed data separately, so that they can be
+    written without concatenating them.
+    """
+    codec, level = parse_compression(compression)
+    return _make_header(codec.name), codec.compress(data, level)
 
 
 def decompress(compressed_data: bytes) -> bytes:
-    return bz2.decompress(compressed_data)
+    data_view = memoryview(compressed_data)
+    if data_view[:len(COMPRESSION_HEADER_MAGIC)] != COMPRESSION_HEADER_MAGIC:
+        return get_codec(LEGACY_CODEC).decompress(compressed_data)
+
+    name_start = len(COMPRESSION_HEADER_MAGIC) + 1
+    name_end = name_start + data_view[name_start - 1]
+    codec_name = str(data_view[name_start:name_end], "utf-8")
+    return get_codec(codec_name).decompress(data_view[name_end:])
+
+
+def _make_header(codec_name: str) -> bytes:
+    encoded_name = bytes(codec_name, "utf-8")
+    return COMPRESSION_HEADER_MAGIC + bytes([len(encoded_name)]) + encoded_name
+
+
+def _compress_none(data: bytes, level: Optional[int]) -> bytes:
+    return data
+
+
+def _decompress_none(compressed_data: bytes) -> bytes:
+    return compressed_data
+
+
+def _compress_zlib(data: bytes, level: Optional[int]) -> bytes:
+    return zlib.compress(data, -1 if level is None else level)
+
+
+def _compress_lzma(data: bytes, level: Optional[int]) -> bytes:
+    return lzma.compress(data, preset=level)
+
+
+def _compress_bz2(data: bytes, level: Optional[int]) -> bytes:
+    return bz2.compress(data, 9 if level is None else level)
+
+
+register_codec(CODEC_NONE, _compress_none, _decompress_none)
+register_codec(CODEC_ZLIB, _compress_zlib, zlib.decompress)
+register_codec(CODEC_LZMA, _compress_lzma, lzma.decompress)
+register_codec(CODEC_BZ2, _compress_bz2, bz2.decompress)
@@ -1,26 +1,190 @@
 import ast
+import functools
 import hashlib
 from typing import (
     Any,
     Callable,
     Dict,
+    Optional,
+    Tuple,
     TYPE_CHECKING,
 )
+from types import CodeType
 import inspect
 import os
+import pickle
+import threading
+import weakref
 
-from .encoding import encode
+from ..config import get_code_hash_index_enabled
+from .encoding import PICKLE_PROTOCOL_VERSION
+from .caching import CacheStats
+from . import code_hash_index
 
 if TYPE_CHECKING:
+    from ..args import Args
     from ..dependencies import FunctionDependency
 
 
+class _HashingSink:
+    """
+    A write-only file that feeds everything written to it into a hash object.
+    """
+
+    __slots__ = ("hash",)
+
+    def __init__(self, hash: "hashlib._Hash") -> None:
+        self.hash = hash
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        return len(data)
+
+
 def compute_value_hash(value: Any) -> bytes:
-    serialized_value = encode(value)
-    hash = hashlib.sha256(serialized_value)
+    # Stream the serialized value into the hash to avoid holding the complete
+    # serialization in memory. Values with a specialized hasher are replaced by
+    # their hash in the serialization. The pickler serializes exact instances of
+    # built-in types like bytes and bytearray without asking for a replacement, so
+    # the value itself is replaced up front. Such instances nested in other values
+    # are serialized.
+    hashed_value = _get_hashed_value(value)
+    hash = hashlib.sha256()
+    _HashingPickler(_HashingSink(hash), protocol=PICKLE_PROTOCOL_VERSION).dump(
+        hashed_value if hashed_value is not None else value
+    )
+    return hash.digest()
+
+
+def compute_args_hash(args: "Args") -> bytes:
+    """
+    Hashes the positional and keyword arguments, independent of the order in which
+    keyword arguments were passed.
+    """
+    return compute_value_hash((args.args, sorted(args.kwargs.items())))
+
+
+# Specialized hashers compute the hash of a value directly from its content. This
+# is faster than serializing the value, and avoids copying its memory.
+ValueHasher = Callable[[Any], Optional[bytes]]
+
+_value_hashers: Dict[type, ValueHasher] = {}
+# Hashers resolved for concrete types, including subclasses of registered types and
+# types supporting the buffer protocol
+_resolved_value_hashers: Dict[type, Optional[ValueHasher]] = {}
+_value_hashers_lock = threading.Lock()
+
+
+def register_value_hasher(value_type: type, hasher: ValueHasher) -> None:
+    """
+    Registers a function that computes the hash of values of the given type and its
+    subclasses. The hash must only depend on the content of the value to keep stage
+    hashes stable across runs. If the hasher returns None, the value is serialized
+    and hashed instead.
+    """
+    with _value_hashers_lock:
+        _value_hashers[value_type] = hasher
+        _resolved_value_hashers.clear()
+
+
+def unregister_value_hasher(value_type: type) -> None:
+    with _value_hashers_lock:
+        _value_hashers.pop(value_type, None)
+        _resolved_value_hashers.clear()
+
+
+def compute_buffer_hash(value: Any) -> Optional[bytes]:
+    """
+    Hashes the memory of objects that support the buffer protocol without copying
+    it, together with the memory layout.
+    """
+    try:
+        buffer = memoryview(value)
+    except (TypeError, ValueError, BufferError):
+        return None
+    if "O" in buffer.format:
+        # The buffer holds references to Python objects instead of values
+        return None
+
+    hash = hashlib.sha256()
+    layout = (buffer.format, buffer.itemsize, buffer.shape, buffer.strides)
+    hash.update(bytes(repr(layout), "utf-8"))
+    hash.update(buffer if buffer.c_contiguous else buffer.tobytes())
     return hash.digest()
 
 
+def _hashed_value(type_name: str, value_hash: bytes) -> None:
+    """
+    Stands in for values with a specialized hasher in the serialization used for
+    hashing. It is never called.
+    """
+
+
+class _HashedValue:
+    """
+    Stands in for a value with a specialized hasher, it's serialized like the value
+    would be by the hashing pickler.
+    """
+
+    __slots__ = ("type_name", "value_hash")
+
+    def __init__(self, type_name: str, value_hash: bytes) -> None:
+        self.type_name = type_name
+        self.value_hash = value_hash
+
+    def __reduce__(self) -> Tuple[Callable, Tuple[str, bytes]]:
+        return _hashed_value, (self.type_name, self.value_hash)
+
+
+def _get_hashed_value(value: Any) -> Optional[_HashedValue]:
+    value_type = type(value)
+    hasher = _resolved_value_hashers.get(value_type, _UNRESOLVED)
+    if hasher is _UNRESOLVED:
+        hasher = _resolve_value_hasher(value_type, value)
+    if hasher is None:
+        return None
+
+    value_hash = hasher(value)
+    if value_hash is None:
+        return None
+    type_name = f"{value_type.__module__}.{value_type.__qualname__}"
+    return _HashedValue(type_name, value_hash)
+
+
+class _HashingPickler(pickle.Pickler):
+    def reducer_override(self, obj: Any) -> Any:
+        # For performance reasons this is not called for exact instances of some
+        # built-in types like bytes, str, list or dict.
+        hashed_value = _get_hashed_value(obj)
+        if hashed_value is None:
+            return NotImplemented
+        return hashed_value.__reduce__()
+
+
+_UNRESOLVED = object()
+
+
+def _resolve_value_hasher(value_type: type, value: Any) -> Optional[ValueHasher]:
+    hasher: Optional[ValueHasher] = None
+    for base_type in value_type.__mro__:
+        if base_type in _value_hashers:
+            hasher = _value_hashers[base_type]
+            break
+    else:
+        try:
+            memoryview(value)
+            hasher = compute_buffer_hash
+        except TypeError:
+            pass
+        except (ValueError, BufferError):
+            # The type supports the buffer protocol, but not for this value
+            hasher = compute_buffer_hash
+
+    with _value_hashers_lock:
+        _resolved_value_hashers[value_type] = hasher
+    return hasher
+
+
 def _strip_whitespace_prefixes(func_code: str) -> str:
     """
     Strips the longest share whitespace prefix among multiple lines of code.
@@ -45,7 +209,87 @@ def _strip_whitespace_prefixes(func_code: str) -> str:
 OVERRIDE_FUNCTION_NAME = "_fn_"
 
 
+# Code hashes are cached per code object. A redefinition of a function (e.g. after
+# importlib.reload() or in a notebook) creates a new code object and therefore a
+# cache miss, while the entry of the old code object is dropped once it is
+# garbage collected.
+_code_hashes: Dict[int, Tuple["weakref.ref[CodeType]", bytes]] = {}
+_code_hashes_lock = threading.Lock()
+_code_hash_stats = CacheStats()
+
+
 def compute_code_hash(func: Callable) -> bytes:
+    code = get_source_code_object(func)
+    if code is None:
+        _code_hash_stats.record_miss()
+        return _compute_code_hash(func)
+
+    code_id = id(code)
+    cached_entry = _code_hashes.get(code_id, None)
+    if cached_entry is not None and cached_entry[0]() is code:
+        _code_hash_stats.record_hit()
+        return cached_entry[1]
+
+    _code_hash_stats.record_miss()
+    code_hash = _compute_indexed_code_hash(func, code)
+    with _code_hashes_lock:
+        _code_hashes[code_id] = (
+            weakref.ref(code, functools.partial(_evict_code_hash, code_id)),
+            code_hash,
+        )
+    return code_hash
+
+
+def get_code_hash_cache_stats() -> CacheStats:
+    return _code_hash_stats.snapshot()
+
+
+def clear_code_hash_cache() -> None:
+    """
+    Clears the in-process code hash cache, including the loaded parts of the
+    persistent code hash index. Recorded hashes are persisted before.
+    """
+    code_hash_index.flush_code_hash_index()
+    code_hash_index.discard_loaded_code_hash_indexes()
+    with _code_hashes_lock:
+        _code_hashes.clear()
+    _code_hash_stats.reset()
+
+
+def _evict_code_hash(code_id: int, code_ref: "weakref.ref[CodeType]") -> None:
+    with _code_hashes_lock:
+        cached_entry = _code_hashes.get(code_id, None)
+        if cached_entry is not None and cached_entry[0] is code_ref:
+            del _code_hashes[code_id]
+
+
+def get_source_code_object(func: Callable) -> Optional[CodeType]:
+    """
+    Returns the code object whose source is hashed for `func`.
+    inspect.getsource() follows `__wrapped__` attributes, so we have to do the same
+    to not share cache entries between different functions behind the same wrapper.
+    """
+    try:
+        unwrapped_func = inspect.unwrap(func)
+    except ValueError:
+        return None
+    code = getattr(unwrapped_func, "__code__", None)
+    return code if isinstance(code, CodeType) else None
+
+
+def _compute_indexed_code_hash(func: Callable, code: CodeType) -> bytes:
+    if not get_code_hash_index_enabled():
+        return _compute_code_hash(func)
+
+    qualified_name = inspect.unwrap(func).__qualname__
+    code_hash = code_hash_index.lookup_code_hash(code, qualified_name)
+    if code_hash is None:
+        code_hash = _compute_code_hash(func)
+        code_hash_index.record_code_hash(code, qualified_name, code_hash)
+    return code_hash
+
+
+def _compute_code_hash(func: Callable) -> bytes:
     # Parse the function code to obtain a normalized representation
     # that is not dependent on comments, whitespace, etc.
     func_code = inspect.getsource(func)
@@ -55,7 +299,9 @@ def compute_code_hash(func: Callable) -> bytes:
     # Set the function name to a generic one to avoid invalidating the cache when
     # the function is renamed.
     func_def = code_ast.body[0] if len(code_ast.body) == 1 else None
-    if func_def is None or not isinstance(func_def, ast.FunctionDef):
+    if func_def is None or not isinstance(
+        func_def, (ast.FunctionDef, ast.AsyncFunctionDef)
+    ):
         raise ValueError("Invalid function passed for code hashing")
 
     func_def.name = OVERRIDE_FUNCTION_NAME
@@ -0,0 +1,180 @@
+from pathlib import Path
+from typing import (
+    Iterator,
+    Optional,
+    Set,
+)
+from contextlib import contextmanager
+import logging
+import os
+import socket
+import threading
+import time
+
+
+# A lock file contains the host name and the process id of its owner, and is
+# refreshed by a heartbeat thread while it's held. A lock is stale if it wasn't
+# refreshed for a while, e.g. because its owner was killed, or if its owner on the
+# same host doesn't run anymore. The age also catches owners whose process id was
+# reused, e.g. after a container restart.
+
+LOCK_FILE_SUFFIX = ".lock"
+MIN_POLL_INTERVAL = 0.01
+MAX_POLL_INTERVAL = 0.5
+
+_held_lock_files: Set[Path] = set()
+_held_lock_files_lock = threading.Lock()
+_heartbeat_thread: Optional[threading.Thread] = None
+
+
+@contextmanager
+def hold_lock_file(
+    lock_file: Path, timeout: float, stale_age: float
+) -> Iterator[bool]:
+    """
+    Waits until the lock file can be created and holds it in the block. Yields
+    whether the lock was acquired, which isn't the case if it's still held by
+    another process after the timeout.
+    """
+    acquired = _acquire(lock_file, timeout, stale_age)
+    if not acquired:
+        logging.warning(
+            f"Timed out after {timeout} s waiting for '{lock_file}', continuing "
+            "without the lock"
+        )
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            _release(lock_file)
+
+
+def _acquire(lock_file: Path, timeout: float, stale_age: float) -> bool:
+    # The random part distinguishes the locks of the same process
+    owner = f"{socket.gethostname()}\n{os.getpid()}\n{os.urandom(8).hex()}\n"
+    deadline = time.monotonic() + timeout
+    poll_interval = MIN_POLL_INTERVAL
+    while True:
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileNotFoundError:
+            lock_file.parent.mkdir(parents=True, exist_ok=True)
+            continue
+        except FileExistsError:
+            pass
+        else:
+            try:
+                os.write(fd, owner.encode())
+            finally:
+                os.close(fd)
+            with _held_lock_files_lock:
+                _held_lock_files.add(lock_file)
+            _start_heartbeat(stale_age)
+            return True
+
+        if _remove_if_stale(lock_file, stale_age):
+            continue
+        remaining_time = deadline - time.monotonic()
+        if remaining_time <= 0:
+            return False
+        time.sleep(min(poll_interval, remaining_time))
+        poll_interval = min(2 * poll_interval, MAX_POLL_INTERVAL)
+
+
+def _release(lock_file: Path) -> None:
+    with _held_lock_files_lock:
+        _held_lock_files.discard(lock_file)
+    try:
+        lock_file.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _remove_if_stale(lock_file: Path, stale_age: float) -> bool:
+    try:
+        owner = lock_file.read_text()
+        modification_time = lock_file.stat().st_mtime
+    except FileNotFoundError:
+        # Released in the meantime
+        return True
+    if not _is_stale(owner, modification_time, stale_age):
+        return False
+
+    # The lock is moved away before it's removed, so that only one waiter removes
+    # it. Another process may have replaced the stale lock with its own lock in
+    # the meantime, which is checked on the moved file.
+    moved_lock_file = lock_file.with_name(
+        f"{lock_file.name}.{os.urandom(8).hex()}.stale"
+    )
+    try:
+        os.rename(lock_file, moved_lock_file)
+    except FileNotFoundError:
+        return True
+    try:
+        if moved_lock_file.read_text() == owner:
+            logging.warning(f"Removing stale lock '{lock_file}'")
+        else:
+            # Put the lock back, unless yet another process holds it by now
+            try:
+                os.link(moved_lock_file, lock_file)
+            except FileExistsError:
+                pass
+            except OSError:
+                # Hard links aren't supported, e.g. by some network file systems
+                os.replace(moved_lock_file, lock_file)
+    finally:
+        moved_lock_file.unlink(missing_ok=True)
+    return True
+
+
+def _is_stale(owner: str, modification_time: float, stale_age: float) -> bool:
+    # Locks that are held are refreshed by the heartbeat, also on other hosts
+    if time.time() - modification_time > stale_age:
+        return True
+    owner_parts = owner.split("\n")
+    return (
+        len(owner_parts) >= 2
+        and owner_parts[0] == socket.gethostname()
+        and owner_parts[1].isdigit()
+        and not _is_process_alive(int(owner_parts[1]))
+    )
+
+
+def _is_process_alive(pid: int) -> bool:
+    if os.name == "nt":
+        # Signals can't be used for checking, so only the age of the lock is used
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Owned by another user
+        return True
+    return True
+
+
+def _start_heartbeat(stale_age: float) -> None:
+    global _heartbeat_thread
+    with _held_lock_files_lock:
+        if _heartbeat_thread is not None and _heartbeat_thread.is_alive():
+            return
+        _heartbeat_thread = threading.Thread(
+            target=_refresh_lock_files,
+            args=(stale_age / 4,),
+            name="pycrastinate-lock-heartbeat",
+            daemon=True,
+        )
+        _heartbeat_thread.start()
+
+
+def _refresh_lock_files(interval: float) -> None:
+    while True:
+        time.sleep(interval)
+        with _held_lock_files_lock:
+            lock_files = list(_held_lock_files)
+        for lock_file in lock_files:
+            try:
+                os.utime(lock_file)
+            except FileNotFoundError:
+                pass
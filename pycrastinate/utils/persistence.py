@@ -1,31 +1,291 @@
+from dataclasses import dataclass
 from pathlib import Path
 from typing import (
     Any,
+    Iterator,
+    List,
     Optional,
+    Tuple,
 )
+import logging
+import mmap
+import os
+import pickle
+import struct
+import sys
+import threading
+import zlib
 
+from ..config import (
+    get_compression,
+    get_compression_min_size,
+    get_out_of_band_min_size,
+    get_fsync_enabled,
+)
 from .encoding import (
-    encode,
+    CODEC_NONE,
+    encode_with_buffers,
     decode,
-    compress,
+    compress_with_header,
     decompress,
 )
 
 
-def save_object(results_file: Path, data: Any) -> None:
+# Large buffers of an object are stored uncompressed in a blob file next to the
+# object's file. The blob file starts with the magic bytes, the CRC-32 of the
+# object's file, the number of buffers and the offset and size of each buffer. The
+# buffers are aligned to pages. The checksum detects when the object's file was
+# replaced by a concurrent write of the same object.
+BLOB_FILE_SUFFIX = ".blobs"
+TMP_FILE_SUFFIX = ".tmp"
+BLOB_FILE_MAGIC = b"PYCRBLB2"
+_BLOB_CHECKSUM_FORMAT = struct.Struct("<Q")
+_BLOB_COUNT_FORMAT = struct.Struct("<Q")
+_BLOB_ENTRY_FORMAT = struct.Struct("<QQ")
+
+# Errors of unpickling truncated or corrupt data
+_DECODE_ERRORS = (pickle.UnpicklingError, EOFError, ValueError)
+
+
+class CorruptObjectError(ValueError):
+    pass
+
+
+@dataclass
+class ObjectSizes:
+    # The size of the object's encoding, including its out-of-band buffers
+    encoded_size: int
+    # The size of the object's files
+    stored_size: int
+
+
+def save_object(
+    results_file: Path,
+    data: Any,
+    compression: Optional[str] = None,
+) -> ObjectSizes:
+    """
+    Saves an object compressed with the given codec, or the globally configured
+    codec if no codec is given.
+    """
     results_file.parent.mkdir(parents=True, exist_ok=True)
 
-    encoded_data = encode(data)
-    compressed_data = compress(encoded_data)
-    
-    results_file.write_bytes(compressed_data)
+    encoded_data, buffers = encode_with_buffers(data, get_out_of_band_min_size())
+    header, compressed_data = _compress(encoded_data, compression)
+
+    # Files are written to temporary files first and then replace the existing
+    # files, so that a killed process never leaves a truncated file behind and
+    # concurrent writers of the same object don't interleave
+    blob_file = get_blob_path(results_file)
+    blob_file_size = 0
+    if len(buffers) > 0:
+        # The blobs have to exist before the object refers to them
+        blob_file_size = _save_blobs(
+            blob_file, buffers, zlib.crc32(compressed_data, zlib.crc32(header))
+        )
+    else:
+        try:
+            blob_file.unlink()
+        except FileNotFoundError:
+            pass
+
+    write_file_atomically(results_file, [header, compressed_data])
+
+    return ObjectSizes(
+        encoded_size=(
+            len(encoded_data) + sum(buffer.raw().nbytes for buffer in buffers)
+        ),
+        stored_size=len(header) + len(compressed_data) + blob_file_size,
+    )
+
+
+def encode_object(
+    data: Any, compression: Optional[str] = None
+) -> Tuple[bytes, ObjectSizes]:
+    """
+    Encodes and compresses an object with all its buffers in-band, for storage
+    that doesn't support out-of-band buffers.
+    """
+    encoded_data, _ = encode_with_buffers(data, min_buffer_size=sys.maxsize)
+    header, compressed_data = _compress(encoded_data, compression)
+    stored_data = header + compressed_data
+    return stored_data, ObjectSizes(
+        encoded_size=len(encoded_data), stored_size=len(stored_data)
+    )
+
+
+def decode_object(stored_data: bytes, name: str) -> Optional[Tuple[Any, int]]:
+    """
+    Returns the object encoded by encode_object and the size of its encoding, or
+    None if the data is corrupt.
+    """
+    try:
+        encoded_data = _decompress(stored_data)
+        return decode(encoded_data), len(encoded_data)
+    except _DECODE_ERRORS as error:
+        _warn_corrupt(name, error)
+        return None
 
 
 def load_object(results_file: Path) -> Optional[Any]:
+    loaded_object = load_object_with_size(results_file)
+    return loaded_object[0] if loaded_object is not None else None
+
+
+def load_object_with_size(results_file: Path) -> Optional[Tuple[Any, int]]:
+    """
+    Returns the loaded object and the size of its encoding, including its
+    out-of-band buffers.
+    """
     try:
         compressed_data = results_file.read_bytes()
     except FileNotFoundError:
         return None
 
-    encoded_data = decompress(compressed_data)
-    return decode(encoded_data)
+    blob_sizes: List[int] = []
+    try:
+        encoded_data = _decompress(compressed_data)
+        data = decode(
+            encoded_data,
+            _iter_blobs(get_blob_path(results_file), blob_sizes, compressed_data),
+        )
+    except FileNotFoundError:
+        logging.warning(f"The blob file of '{results_file}' is missing")
+        return None
+    except _DECODE_ERRORS as error:
+        _warn_corrupt(results_file, error)
+        return None
+    return data, len(encoded_data) + sum(blob_sizes)
+
+
+def write_file_atomically(file_path: Path, chunks: List[bytes]) -> None:
+    """
+    Writes the file by replacing it with a temporary file. Processes that opened
+    or mapped the previous file keep reading the previous version.
+    """
+    tmp_file = get_tmp_path(file_path)
+    try:
+        with open(tmp_file, "wb") as file:
+            for chunk in chunks:
+                file.write(chunk)
+            if get_fsync_enabled():
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(tmp_file, file_path)
+    except BaseException:
+        try:
+            tmp_file.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+    if get_fsync_enabled():
+        fsync_dir(file_path.parent)
+
+
+def get_tmp_path(file_path: Path) -> Path:
+    # Unique per process and thread
+    return file_path.with_name(
+        f"{file_path.name}.{os.getpid()}.{threading.get_ident()}{TMP_FILE_SUFFIX}"
+    )
+
+
+def fsync_dir(dir_path: Path) -> None:
+    """
+    Flushes the directory entries, e.g. of renamed files, on platforms that
+    support it.
+    """
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    dir_fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def _decompress(compressed_data: bytes) -> bytes:
+    try:
+        return decompress(compressed_data)
+    except Exception as error:
+        # The codecs raise different errors for corrupt data
+        raise CorruptObjectError(f"Decompression failed: {error}") from error
+
+
+def _warn_corrupt(name: Any, error: Exception) -> None:
+    logging.warning(f"Ignoring corrupt object '{name}': {error}")
+
+
+def _compress(
+    encoded_data: bytes, compression: Optional[str]
+) -> Tuple[bytes, bytes]:
+    if len(encoded_data) < get_compression_min_size():
+        compression = CODEC_NONE
+    elif compression is None:
+        compression = get_compression()
+    return compress_with_header(encoded_data, compression)
+
+
+def get_blob_path(results_file: Path) -> Path:
+    return results_file.with_name(results_file.name + BLOB_FILE_SUFFIX)
+
+
+def _save_blobs(blob_file: Path, buffers: List[Any], object_checksum: int) -> int:
+    blob_offsets = []
+    offset = _align_to_page(
+        len(BLOB_FILE_MAGIC)
+        + _BLOB_CHECKSUM_FORMAT.size
+        + _BLOB_COUNT_FORMAT.size
+        + len(buffers) * _BLOB_ENTRY_FORMAT.size
+    )
+    for buffer in buffers:
+        blob_offsets.append(offset)
+        blob_file_size = offset + buffer.raw().nbytes
+        offset = _align_to_page(blob_file_size)
+
+    blob_header = bytearray(BLOB_FILE_MAGIC)
+    blob_header += _BLOB_CHECKSUM_FORMAT.pack(object_checksum)
+    blob_header += _BLOB_COUNT_FORMAT.pack(len(buffers))
+    for blob_offset, buffer in zip(blob_offsets, buffers):
+        blob_header += _BLOB_ENTRY_FORMAT.pack(blob_offset, buffer.raw().nbytes)
+
+    chunks = [blob_header]
+    written_size = len(blob_header)
+    for blob_offset, buffer in zip(blob_offsets, buffers):
+        # Padding up to the page-aligned offset
+        chunks.append(bytes(blob_offset - written_size))
+        chunks.append(buffer.raw())
+        written_size = blob_offset + buffer.raw().nbytes
+    write_file_atomically(blob_file, chunks)
+    return blob_file_size
+
+
+def _iter_blobs(
+    blob_file: Path, blob_sizes: List[int], object_data: bytes
+) -> Iterator[memoryview]:
+    # Only called when the object refers to out-of-band buffers
+    with open(blob_file, "rb") as file:
+        # Copy-on-write, so that the loaded buffers are writable but modifying them
+        # doesn't change the file. Unmodified pages are shared with other processes.
+        blob_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    blob_view = memoryview(blob_map)
+    if blob_view[:len(BLOB_FILE_MAGIC)] != BLOB_FILE_MAGIC:
+        raise CorruptObjectError(f"'{blob_file}' is not a blob file")
+    offset = len(BLOB_FILE_MAGIC)
+    (blob_checksum,) = _BLOB_CHECKSUM_FORMAT.unpack_from(blob_view, offset)
+    offset += _BLOB_CHECKSUM_FORMAT.size
+    if blob_checksum != zlib.crc32(object_data):
+        raise CorruptObjectError(f"'{blob_file}' belongs to a different object")
+
+    (num_blobs,) = _BLOB_COUNT_FORMAT.unpack_from(blob_view, offset)
+    offset += _BLOB_COUNT_FORMAT.size
+    for _ in range(num_blobs):
+        blob_offset, blob_size = _BLOB_ENTRY_FORMAT.unpack_from(blob_view, offset)
+        offset += _BLOB_ENTRY_FORMAT.size
+        if blob_offset + blob_size > len(blob_view):
+            raise CorruptObjectError(f"'{blob_file}' is truncated")
+        blob_sizes.append(blob_size)
+        yield blob_view[blob_offset:blob_offset + blob_size]
+
+
+def _align_to_page(offset: int) -> int:
+    return -(-offset // mmap.PAGESIZE) * mmap.PAGESIZE
@@ -0,0 +1,28 @@
+import pytest
+
+from pycrastinate import set_cache_dir
+from pycrastinate.stages.persistence import STAGE_RESULTS_DIR_NAME
+from pycrastinate.storage import FileSystemStorage
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache_dir(tmp_path):
+    # Make sure no test writes to the default cache dir in the working directory
+    set_cache_dir(tmp_path)
+
+
+@pytest.fixture
+def disk_loads(monkeypatch):
+    """
+    Records the keys of the stage results loaded from the file system storage.
+    """
+    loaded_keys = []
+    load = FileSystemStorage.load
+
+    def recording_load(storage, key):
+        if key.startswith(STAGE_RESULTS_DIR_NAME):
+            loaded_keys.append(key)
+        return load(storage, key)
+
+    monkeypatch.setattr(FileSystemStorage, "load", recording_load)
+    return loaded_keys
@@ -1,6 +1,7 @@
 import pytest
 
 from pycrastinate import stage, Result, Use, Args, set_cache_dir
+from pycrastinate.utils.hashing import get_code_hash_cache_stats
 
 from tests.utils.call_counter import CallCounter
 
@@ -131,3 +132,98 @@ def test_func_dep_executed_with_different_args(fun_with_dinosaurs):
 
 def test_func_dep_with_indirect_data_dependencies_rejected():
     pass
+
+
+def test_recursive_hash_memoized():
+    def cut(vegetable: str):
+        return f"sliced {vegetable}"
+
+    def cook(vegetable: str, prepare=Use(cut)):
+        return f"cooked {prepare(vegetable)}"
+
+    cooking_dependency = Use(cook)
+    hash_1 = cooking_dependency.get_recursive_hash()
+    stats_1 = get_code_hash_cache_stats()
+    hash_2 = cooking_dependency.get_recursive_hash()
+    stats_2 = get_code_hash_cache_stats()
+
+    assert hash_1 == hash_2
+    assert stats_1.hits == stats_2.hits
+    assert stats_1.misses == stats_2.misses
+
+
+def test_recursive_hash_invalidated_on_nested_redefinition():
+    def peel(vegetable: str):
+        return f"peeled {vegetable}"
+
+    def cut(vegetable: str, prepare=Use(peel)):
+        return f"sliced {prepare(vegetable)}"
+
+    def cook(vegetable: str, prepare=Use(cut)):
+        return f"cooked {prepare(vegetable)}"
+
+    cooking_dependency = Use(cook)
+    hash_1 = cooking_dependency.get_recursive_hash()
+
+    def peel_carefully(vegetable: str):
+        return f"carefully peeled {vegetable}"
+    peel.__code__ = peel_carefully.__code__
+    hash_2 = cooking_dependency.get_recursive_hash()
+
+    def peel(vegetable: str):
+        return f"peeled {vegetable}"
+    cut.__defaults__[0].func = peel
+    hash_3 = cooking_dependency.get_recursive_hash()
+
+    assert hash_1 != hash_2
+    assert hash_1 == hash_3
+
+
+def test_data_dependencies_detected_after_nested_redefinition():
+    @stage
+    def harvest(vegetable: str = "carrot"):
+        return vegetable
+
+    def peel(vegetable: str):
+        return f"peeled {vegetable}"
+
+    def cut(vegetable: str, prepare=Use(peel)):
+        return f"sliced {prepare(vegetable)}"
+
+    cutting_dependency = Use(cut)
+    assert cutting_dependency.has_no_data_dependencies()
+
+    def peel_harvested(vegetable: str, harvested=Result(harvest)):
+        return f"peeled {harvested}"
+    cut.__defaults__[0].func = peel_harvested
+    assert not cutting_dependency.has_no_data_dependencies()
+
+
+def test_stage_rerun_on_nested_helper_redefinition(fun_with_dinosaurs):
+    _, call_counts, (call_counter, find_fossilized_dna_sample, _) = fun_with_dinosaurs
+
+    def extract_dna(sample: str):
+        return sample[11:-4]
+
+    @stage
+    @call_counter
+    def clone_dinosaur(species: str, extract=Use(extract_dna)):
+        return f"cloned {extract(find_fossilized_dna_sample(species))}"
+
+    @stage
+    @call_counter
+    def shoot_movie(dinosaur=Use(clone_dinosaur)):
+        return f"Look at that {dinosaur('T-Rex')}"
+
+    movie_1 = shoot_movie()
+    movie_2 = shoot_movie()
+
+    def extract_dna_carefully(sample: str):
+        return sample[11:-4].upper()
+    extract_dna.__code__ = extract_dna_carefully.__code__
+    movie_3 = shoot_movie()
+
+    assert movie_1 == movie_2
+    assert movie_1 == "Look at that cloned T-Rex"
+    assert movie_3 == "Look at that cloned T-REX"
+    assert call_counts["shoot_movie"] == 2
@@ -0,0 +1,64 @@
+import pytest
+
+from pycrastinate import stage, hook, Subscription, Result
+from pycrastinate.stages import LazyArgs
+
+
+CHAIN_LENGTH = 10
+
+
+@pytest.fixture
+def relay_race():
+    @stage
+    def run_leg_0():
+        return 0
+
+    legs = [run_leg_0]
+    for leg_idx in range(1, CHAIN_LENGTH):
+        def run_leg(previous_leg=Result(legs[-1])):
+            return previous_leg + 1
+        legs.append(stage(run_leg))
+
+    @stage
+    def fire_starting_gun(volume: int):
+        return f"bang at {volume} dB"
+
+    invocations = []
+
+    @hook
+    def report_race(
+        start=Subscription(fire_starting_gun),
+        finish=Subscription(legs[-1], with_metadata=True),
+    ):
+        invocations.append(finish)
+
+    return legs, fire_starting_gun, invocations
+
+
+def test_hook_reads_only_subscribed_result(disk_loads, relay_race):
+    legs, fire_starting_gun, invocations = relay_race
+    assert legs[-1]() == CHAIN_LENGTH - 1
+    disk_loads.clear()
+
+    fire_starting_gun(120)
+    finish = invocations[-1]
+    assert finish.result == CHAIN_LENGTH - 1
+    assert finish.execution_duration is not None
+    assert isinstance(finish.args, LazyArgs)
+    assert not finish.args.is_loaded("previous_leg")
+    assert len(disk_loads) == 1
+
+    # Upstream results are loaded on first access and then stay loaded
+    assert finish.args["previous_leg"] == CHAIN_LENGTH - 2
+    assert finish.args["previous_leg"] == CHAIN_LENGTH - 2
+    assert len(disk_loads) == 2
+
+
+def test_materialize_invocation(disk_loads, relay_race):
+    legs, fire_starting_gun, invocations = relay_race
+    legs[-1]()
+    fire_starting_gun(90)
+
+    finish = invocations[-1].materialize()
+    assert finish.args == {"previous_leg": CHAIN_LENGTH - 2}
+    assert not isinstance(finish.args, LazyArgs)
@@ -1,4 +1,8 @@
-from pycrastinate.utils.arg_aggregation import aggregate_args
+import pytest
+
+from pycrastinate import stage
+from pycrastinate.utils.arg_aggregation import aggregate_args, ArgumentPlan
+from pycrastinate.utils.hashing import compute_value_hash
 from pycrastinate.args import Args
 
 
@@ -65,3 +69,47 @@ def test_equal_aggregated_args():
     assert aggregation_result_1.data_dependencies == {}
     assert aggregation_result_1.data_dependency_args == {}
     assert aggregation_result_1.func_dependencies == {}
+
+
+def test_argument_plan_matches_aggregation():
+    plan = ArgumentPlan(greet)
+    for args in (None, Args(), Args("Hi", name="Donald"), Args("Hola", age=23)):
+        assert plan.aggregate(args) == aggregate_args(greet, args)
+    assert plan.default_values == {"age": 25, "name": "Janine"}
+
+
+def test_argument_plan_immutable():
+    plan = ArgumentPlan(greet)
+    with pytest.raises(AttributeError):
+        plan.parameters = ()
+
+
+def test_argument_plan_default_hashes():
+    def greet_all(names=["Janine"], greeting="Hi"):
+        pass
+
+    plan = ArgumentPlan(greet_all)
+    assert plan.default_hashes == {"greeting": compute_value_hash("Hi")}
+
+    aggregation_result = plan.aggregate(Args(greeting="Hello"))
+    assert aggregation_result.compute_non_dependency_hashes() == {
+        "names": compute_value_hash(["Janine"]),
+        "greeting": compute_value_hash("Hello"),
+    }
+    greet_all.__defaults__[0].append("Donald")
+    assert plan.aggregate().compute_non_dependency_hashes() == {
+        "names": compute_value_hash(["Janine", "Donald"]),
+        "greeting": compute_value_hash("Hi"),
+    }
+
+
+def test_stage_argument_plan_rebuilt_on_func_change():
+    greet_stage = stage(greet)
+    plan = greet_stage.argument_plan
+    assert greet_stage.argument_plan is plan
+
+    def greet_twice(greeting: str, name: str = "Janine"):
+        pass
+    greet_stage.stage_func = greet_twice
+    assert greet_stage.argument_plan is not plan
+    assert greet_stage.argument_plan.default_values == {"name": "Janine"}
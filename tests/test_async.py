@@ -0,0 +1,213 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from pycrastinate import stage, hook, Subscription, Result, Args, config
+from pycrastinate.utils.hashing import register_value_hasher, unregister_value_hasher
+
+from .utils.call_counter import CallCounter
+
+
+DELAY = 0.2
+NUM_ORDERS = 10
+
+
+@pytest.fixture
+def bakery():
+    call_counter = CallCounter()
+    loops = []
+
+    @stage
+    @call_counter
+    async def bake(bread: str, minutes: int = 1):
+        loops.append(asyncio.get_running_loop())
+        await asyncio.sleep(DELAY)
+        if minutes < 0:
+            raise ValueError(f"Can't bake {bread} for negative minutes")
+        return f"{bread} baked for {minutes} min"
+
+    @stage
+    @call_counter
+    def slice_bread(bread=Result(bake, Args("rye"))):
+        time.sleep(DELAY)
+        return f"sliced {bread}"
+
+    @stage
+    @call_counter
+    async def fill_basket(
+        rye=Result(bake, Args("rye")),
+        spelt=Result(bake, Args("spelt")),
+        wheat=Result(bake, Args("wheat")),
+    ):
+        return [rye, spelt, wheat]
+
+    return bake, slice_bread, fill_basket, call_counter, loops
+
+
+def test_async_stage(bakery):
+    bake, _, _, call_counter, loops = bakery
+
+    async def order():
+        return await bake.acall("rye", minutes=40), asyncio.get_running_loop()
+
+    result, loop = asyncio.run(order())
+    assert result == "rye baked for 40 min"
+    assert loops == [loop]
+
+    # Loaded by the synchronous API, which can also execute coroutine functions
+    assert bake("rye", minutes=40) == result
+    assert bake("spelt") == "spelt baked for 1 min"
+    assert call_counter.counter["bake"] == 2
+    assert asyncio.run(bake.acall("spelt")) == "spelt baked for 1 min"
+    assert call_counter.counter["bake"] == 2
+
+
+@pytest.mark.parametrize("keying_mode", [
+    config.KEYING_BY_VALUE, config.KEYING_BY_REFERENCE
+])
+def test_dependencies_gathered(bakery, keying_mode):
+    _, _, fill_basket, call_counter, _ = bakery
+    config.set_keying_mode(keying_mode)
+    try:
+        start = time.perf_counter()
+        basket = asyncio.run(fill_basket.acall())
+        duration = time.perf_counter() - start
+    finally:
+        config.set_keying_mode(config.Config.keying_mode)
+    assert duration < 2 * DELAY
+    assert basket == [
+        "rye baked for 1 min", "spelt baked for 1 min", "wheat baked for 1 min"
+    ]
+    assert call_counter.counter == {"bake": 3, "slice_bread": 0, "fill_basket": 1}
+
+
+def test_first_error_propagates(bakery):
+    bake, _, _, call_counter, _ = bakery
+
+    async def order():
+        return await asyncio.gather(
+            bake.acall("rye", minutes=-1), bake.acall("spelt", minutes=10),
+            return_exceptions=True,
+        )
+
+    error, result = asyncio.run(order())
+    assert isinstance(error, ValueError)
+    assert result == "spelt baked for 10 min"
+    assert call_counter.counter["bake"] == 2
+
+
+def test_event_loop_not_blocked(bakery):
+    _, slice_bread, _, _, _ = bakery
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(DELAY / 10)
+
+    async def order():
+        ticker = asyncio.create_task(tick())
+        try:
+            return await slice_bread.acall()
+        finally:
+            ticker.cancel()
+
+    # Synchronous stage functions are executed in threads
+    assert asyncio.run(order()) == "sliced rye baked for 1 min"
+    assert len(ticks) > 10
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < DELAY
+
+
+class Dough:
+    def __init__(self, weight: int) -> None:
+        self.weight = weight
+
+
+def test_event_loop_not_blocked_by_hashing():
+    def hash_dough(dough: Dough):
+        # Like hashing a large argument
+        time.sleep(DELAY)
+        return dough.weight.to_bytes(8, "little")
+
+    @stage
+    async def knead(dough: Dough):
+        return dough.weight * 2
+
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(DELAY / 10)
+
+    async def order():
+        ticker = asyncio.create_task(tick())
+        try:
+            return await knead.acall(Dough(500))
+        finally:
+            ticker.cancel()
+
+    register_value_hasher(Dough, hash_dough)
+    try:
+        assert asyncio.run(order()) == 1000
+    finally:
+        unregister_value_hasher(Dough)
+    assert len(ticks) > 2
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < DELAY
+
+
+def test_concurrent_calls_execute_once(bakery):
+    bake, _, _, call_counter, _ = bakery
+    thread_results = []
+
+    async def order():
+        thread = threading.Thread(
+            target=lambda: thread_results.append(bake("rye", minutes=30))
+        )
+        thread.start()
+        results = await asyncio.gather(*[
+            bake.acall("rye", minutes=30) for _ in range(NUM_ORDERS)
+        ])
+        await asyncio.to_thread(thread.join)
+        return results
+
+    results = asyncio.run(order())
+    assert results + thread_results == ["rye baked for 30 min"] * (NUM_ORDERS + 1)
+    assert call_counter.counter["bake"] == 1
+
+
+def test_sync_call_in_event_loop(bakery):
+    bake, _, _, _, _ = bakery
+
+    async def order():
+        return bake("rye")
+
+    with pytest.raises(ValueError, match="await 'acall\\(\\)'"):
+        asyncio.run(order())
+
+
+def test_async_hook(bakery):
+    bake, _, _, _, _ = bakery
+    tastings = []
+
+    @hook
+    async def taste(bread=Subscription(bake, when="different_from_all")):
+        await asyncio.sleep(0)
+        tastings.append((bread, threading.get_ident()))
+
+    async def order():
+        await bake.acall("rye")
+        await bake.acall("spelt")
+        await bake.acall("rye")
+
+    asyncio.run(order())
+    assert tastings == [
+        ("rye baked for 1 min", threading.get_ident()),
+        ("spelt baked for 1 min", threading.get_ident()),
+    ]
+
+    # Also run by the synchronous API
+    bake("wheat")
+    assert tastings[-1][0] == "wheat baked for 1 min"
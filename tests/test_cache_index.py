@@ -0,0 +1,159 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from pycrastinate import stage, Result, Args, config
+from pycrastinate.stages.index import (
+    ARG_KIND_DATA,
+    ARG_KIND_RESULT,
+    UNINDEXED_RESULTS_KEY,
+    CacheIndex,
+    close_cache_indexes,
+    get_cache_index,
+)
+from pycrastinate.stages.persistence import STAGE_RESULTS_DIR_NAME, has_stage_result
+from pycrastinate.stages.result import PersistedInvocation
+from pycrastinate.storage import FileSystemStorage
+from pycrastinate.utils.hashing import compute_code_hash, compute_value_hash
+
+from .utils.call_counter import CallCounter
+
+
+@pytest.fixture
+def cache_index_disabled():
+    config.set_cache_index_enabled(False)
+    yield
+    config.set_cache_index_enabled(True)
+
+
+@pytest.fixture
+def garden():
+    call_counter = CallCounter()
+
+    @stage
+    @call_counter
+    def plant_seeds(num_seeds: int = 12):
+        return ["tomato"] * num_seeds
+
+    @stage
+    @call_counter
+    def harvest(plants=Result(plant_seeds)):
+        return len(plants) * 3
+
+    return plant_seeds, harvest, call_counter
+
+
+def test_invocations_listed_without_loading(disk_loads, garden):
+    plant_seeds, harvest, _ = garden
+    harvest()
+    plant_seeds(num_seeds=5)
+    disk_loads.clear()
+
+    invocations = plant_seeds.list_invocations()
+    assert len(invocations) == 2
+    assert [
+        invocation.args["num_seeds"].kind for invocation in invocations
+    ] == [ARG_KIND_DATA, ARG_KIND_DATA]
+    assert all(
+        invocation.code_hash == compute_code_hash(plant_seeds.stage_func)
+        for invocation in invocations
+    )
+
+    (harvest_invocation,) = harvest.list_invocations()
+    assert harvest_invocation.args["plants"].kind == ARG_KIND_RESULT
+    assert harvest_invocation.args["plants"].hash in {
+        invocation.stage_hash for invocation in invocations
+    }
+    assert harvest_invocation.payload_size > 0
+    assert harvest_invocation.start_time <= datetime.now()
+    assert harvest_invocation.execution_duration >= timedelta(0)
+    assert disk_loads == []
+
+
+def test_negative_lookups_skip_file_system(
+    tmp_path, monkeypatch, disk_loads, garden
+):
+    plant_seeds, _, call_counter = garden
+    probed_keys = []
+    exists = FileSystemStorage.exists
+
+    def recording_exists(storage, key):
+        if key.startswith(STAGE_RESULTS_DIR_NAME):
+            probed_keys.append(key)
+        return exists(storage, key)
+    monkeypatch.setattr(FileSystemStorage, "exists", recording_exists)
+
+    plant_seeds(3)
+    plant_seeds(4)
+    plant_seeds(3)
+    assert call_counter.counter["plant_seeds"] == 2
+    # Only the cached invocation was loaded, the misses weren't probed
+    assert len(disk_loads) == 1
+    assert probed_keys == []
+
+    # The loaded invocation was accessed last
+    invocation = max(
+        plant_seeds.list_invocations(),
+        key=lambda invocation: invocation.last_access_time,
+    )
+    assert invocation.args["num_seeds"].hash == compute_value_hash(3)
+    assert has_stage_result(tmp_path, invocation.stage_hash)
+    assert not has_stage_result(tmp_path, bytes(32))
+    assert probed_keys == []
+
+
+def test_existing_results_indexed(tmp_path, cache_index_disabled, garden):
+    plant_seeds, harvest, call_counter = garden
+    harvest()
+    assert not (tmp_path / "index.sqlite3").exists()
+
+    config.set_cache_index_enabled(True)
+    harvest()
+    assert call_counter.counter["harvest"] == 1
+    assert call_counter.counter["plant_seeds"] == 1
+    assert len(get_cache_index(tmp_path).list_invocations()) == 2
+
+
+def test_results_saved_while_disabled_indexed(tmp_path, garden):
+    plant_seeds, harvest, call_counter = garden
+    harvest()
+    config.set_cache_index_enabled(False)
+    try:
+        harvest(plants=Args(num_seeds=4))
+    finally:
+        config.set_cache_index_enabled(True)
+    assert (tmp_path / UNINDEXED_RESULTS_KEY).exists()
+
+    # Like opening the index in a new process
+    close_cache_indexes()
+    assert len(get_cache_index(tmp_path).list_invocations()) == 4
+    assert not (tmp_path / UNINDEXED_RESULTS_KEY).exists()
+    assert harvest(plants=Args(num_seeds=4)) == 12
+    assert call_counter.counter == {"plant_seeds": 2, "harvest": 2}
+    assert len(get_cache_index(tmp_path).list_invocations()) == 4
+
+
+def test_results_of_other_processes_visible(tmp_path):
+    index = CacheIndex(tmp_path)
+    other_index = CacheIndex(tmp_path)
+    stage_hash = bytes(range(32))
+    assert not index.contains(stage_hash)
+
+    other_index.record_invocation(
+        stage_hash,
+        "tests.garden.water_plants",
+        PersistedInvocation(
+            result="wet soil",
+            start_time=datetime.now(),
+            execution_duration=timedelta(seconds=1),
+            args={},
+            code_hash=bytes(32),
+        ),
+        arg_hashes={},
+        payload_size=100,
+    )
+    assert index.contains(stage_hash)
+    (invocation,) = index.list_invocations(stage_name="tests.garden.water_plants")
+    assert invocation.payload_size == 100
+    index.close()
+    other_index.close()
@@ -0,0 +1,84 @@
+import importlib.util
+import os
+
+import pytest
+
+from pycrastinate.utils import code_hash_index, hashing
+from pycrastinate.utils.hashing import compute_code_hash, clear_code_hash_cache
+from pycrastinate.config import set_code_hash_index_enabled
+
+
+MODULE_SOURCE = """
+def greet(name):
+    return f"Hi {name}"
+"""
+
+
+def import_module(path):
+    spec = importlib.util.spec_from_file_location("code_hash_index_module", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def module_file(tmp_path):
+    module_path = tmp_path / "code_hash_index_module.py"
+    module_path.write_text(MODULE_SOURCE)
+    set_code_hash_index_enabled(True)
+    yield module_path
+    clear_code_hash_cache()
+
+
+def fail_on_parsing(monkeypatch):
+    def compute_code_hash_failing(func):
+        raise AssertionError("Source code parsed despite index entry")
+    monkeypatch.setattr(hashing, "_compute_code_hash", compute_code_hash_failing)
+
+
+def test_code_hash_loaded_from_index(module_file, monkeypatch):
+    hash_1 = compute_code_hash(import_module(module_file).greet)
+    # Simulate a new process
+    clear_code_hash_cache()
+
+    fail_on_parsing(monkeypatch)
+    hash_2 = compute_code_hash(import_module(module_file).greet)
+    assert hash_1 == hash_2
+
+
+def test_index_invalidated_on_file_change(module_file, monkeypatch):
+    hash_1 = compute_code_hash(import_module(module_file).greet)
+    clear_code_hash_cache()
+
+    module_file.write_text(MODULE_SOURCE.replace("Hi", "Hello"))
+    file_stat = os.stat(module_file)
+    os.utime(module_file, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 1000))
+    hash_2 = compute_code_hash(import_module(module_file).greet)
+    assert hash_1 != hash_2
+
+    clear_code_hash_cache()
+    fail_on_parsing(monkeypatch)
+    hash_3 = compute_code_hash(import_module(module_file).greet)
+    assert hash_2 == hash_3
+
+
+def test_index_disabled(module_file, monkeypatch):
+    compute_code_hash(import_module(module_file).greet)
+    clear_code_hash_cache()
+
+    set_code_hash_index_enabled(False)
+    fail_on_parsing(monkeypatch)
+    try:
+        with pytest.raises(AssertionError):
+            compute_code_hash(import_module(module_file).greet)
+    finally:
+        set_code_hash_index_enabled(True)
+
+
+def test_flush_errors_at_exit_logged(monkeypatch, caplog):
+    def flush_failing():
+        raise ValueError("Corrupt index")
+    monkeypatch.setattr(code_hash_index, "flush_code_hash_index", flush_failing)
+
+    code_hash_index._flush_at_exit()
+    assert "Corrupt index" in caplog.text
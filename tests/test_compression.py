@@ -0,0 +1,103 @@
+import bz2
+
+import pytest
+
+from pycrastinate import stage, set_cache_dir
+from pycrastinate import config
+from pycrastinate.stages.persistence import STAGE_RESULTS_DIR_NAME
+from pycrastinate.utils.encoding import (
+    COMPRESSION_HEADER_MAGIC,
+    compress,
+    decompress,
+    encode,
+)
+from pycrastinate.utils.persistence import save_object, load_object
+
+from .utils.call_counter import CallCounter
+
+
+@pytest.fixture
+def compression_config():
+    yield
+    config.set_compression(config.Config.compression)
+    config.set_compression_min_size(config.Config.compression_min_size)
+
+
+def _get_codec_name(results_file) -> str:
+    data = results_file.read_bytes()
+    assert data.startswith(COMPRESSION_HEADER_MAGIC)
+    name_length = data[len(COMPRESSION_HEADER_MAGIC)]
+    name_start = len(COMPRESSION_HEADER_MAGIC) + 1
+    return str(data[name_start:name_start + name_length], "utf-8")
+
+
+@pytest.mark.parametrize(
+    "compression", ["none", "zlib", "zlib:1", "zlib:9", "lzma", "lzma:1", "bz2"]
+)
+def test_codec_roundtrip(compression):
+    data = encode(list(range(1000)))
+    assert decompress(compress(data, compression)) == data
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        config.set_compression("snappy")
+    with pytest.raises(ValueError):
+        config.set_compression("zlib:fast")
+    with pytest.raises(ValueError):
+        stage(compression="snappy")(lambda: None)
+
+
+def test_legacy_files_load(tmp_path):
+    value = {"beans": list(range(1000))}
+    results_file = tmp_path / "legacy_result"
+    results_file.write_bytes(bz2.compress(encode(value)))
+    assert load_object(results_file) == value
+
+
+def test_small_payloads_not_compressed(tmp_path, compression_config):
+    config.set_compression("lzma")
+    small_file = tmp_path / "small"
+    large_file = tmp_path / "large"
+    save_object(small_file, "espresso")
+    save_object(large_file, "espresso" * 1000)
+    assert _get_codec_name(small_file) == "none"
+    assert _get_codec_name(large_file) == "lzma"
+
+    config.set_compression_min_size(0)
+    save_object(small_file, "espresso")
+    assert _get_codec_name(small_file) == "lzma"
+    assert load_object(small_file) == "espresso"
+
+
+def test_mixed_codecs_in_cache(tmp_path, compression_config):
+    set_cache_dir(tmp_path)
+    config.set_compression_min_size(0)
+    call_counter = CallCounter()
+
+    @stage(compression="bz2")
+    @call_counter
+    def grind_beans():
+        return "ground beans"
+
+    @stage
+    @call_counter
+    def brew_coffee(amount_ml: int):
+        return f"{amount_ml} ml of coffee from " + grind_beans()
+
+    config.set_compression("lzma")
+    brew_coffee(200)
+    config.set_compression("none")
+    brew_coffee(300)
+
+    codec_names = sorted(
+        _get_codec_name(results_file)
+        for results_file in (tmp_path / STAGE_RESULTS_DIR_NAME).glob("*/*")
+    )
+    assert codec_names == ["bz2", "lzma", "none"]
+
+    config.set_compression("zlib")
+    assert brew_coffee(200) == "200 ml of coffee from ground beans"
+    assert brew_coffee(300) == "300 ml of coffee from ground beans"
+    assert call_counter.counter["grind_beans"] == 1
+    assert call_counter.counter["brew_coffee"] == 2
@@ -0,0 +1,168 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import multiprocessing
+import os
+import random
+import time
+
+import pytest
+
+from pycrastinate import stage, Result, Args, config
+from pycrastinate.stages.persistence import STAGE_RESULTS_DIR_NAME
+from pycrastinate.utils.persistence import (
+    TMP_FILE_SUFFIX,
+    save_object,
+    load_object,
+)
+
+from .utils.call_counter import CallCounter
+from .test_out_of_band_buffers import Samples, out_of_band_min_size  # noqa: F401
+
+
+NUM_PROCESSES = 8
+NUM_KEYS = 12
+
+
+@stage
+def steep_tea(minutes: int):
+    time.sleep(0.001 * random.random())
+    return f"tea steeped for {minutes} min"
+
+
+@stage
+def pour_cup(tea=Result(steep_tea, Args(minutes=4)), sugar: int = 0):
+    return f"{tea} with {sugar} sugar"
+
+
+@stage
+def weigh_leaves(batch: int):
+    # Every process writes a different result for the same stage hash
+    pid = os.getpid()
+    return pid, Samples(bytearray([pid % 256]) * 4096)
+
+
+def brew_concurrently(cache_dir, start_time, seed):
+    config.set_cache_dir(cache_dir)
+    config.set_out_of_band_min_size(1024)
+    rng = random.Random(seed)
+    calls = [(kind, idx) for kind in range(3) for idx in range(NUM_KEYS)] * 3
+    rng.shuffle(calls)
+    time.sleep(max(0.0, start_time - time.time()))
+
+    for kind, idx in calls:
+        if kind == 0:
+            assert steep_tea(idx) == f"tea steeped for {idx} min"
+        elif kind == 1:
+            assert pour_cup(sugar=idx) == f"tea steeped for 4 min with {idx} sugar"
+        else:
+            # The result and its buffers must be from the same write
+            pid, samples = weigh_leaves(idx)
+            assert bytes(samples.data) == bytes([pid % 256]) * 4096
+    return True
+
+
+def corrupt_files(cache_dir, modify):
+    result_files = [
+        path
+        for path in (cache_dir / STAGE_RESULTS_DIR_NAME).rglob("*")
+        if path.is_file()
+    ]
+    for result_file in result_files:
+        result_file.write_bytes(modify(result_file.read_bytes()))
+    return len(result_files)
+
+
+@pytest.mark.parametrize("modify", [
+    lambda data: data[:len(data) // 2],
+    lambda data: data[:8] + bytes(len(data) - 8),
+    lambda data: b"",
+])
+def test_corrupt_results_are_misses(tmp_path, caplog, modify):
+    call_counter = CallCounter()
+
+    @stage
+    @call_counter
+    def brew_kettle(liters: float):
+        return {"liters": liters, "notes": ["whistling"] * 500}
+
+    brew_kettle(1.5)
+    assert corrupt_files(tmp_path, modify) == 1
+    config.set_cache_index_enabled(False)
+    try:
+        with caplog.at_level(logging.WARNING):
+            assert brew_kettle(1.5)["liters"] == 1.5
+    finally:
+        config.set_cache_index_enabled(config.Config.cache_index)
+    assert call_counter.counter == {"brew_kettle": 2}
+    assert "corrupt" in caplog.text
+
+    # The recomputed result replaced the corrupt file
+    assert brew_kettle(1.5)["liters"] == 1.5
+    assert call_counter.counter == {"brew_kettle": 2}
+
+
+def test_mismatched_blob_file(tmp_path, caplog, out_of_band_min_size):
+    results_file = tmp_path / "samples"
+    save_object(results_file, ("first", Samples(bytearray(2048))))
+    first_object_data = results_file.read_bytes()
+    save_object(results_file, ("second", Samples(bytearray(4096))))
+
+    # E.g. a concurrent writer replaced only the blob file
+    results_file.write_bytes(first_object_data)
+    with caplog.at_level(logging.WARNING):
+        assert load_object(results_file) is None
+    assert "belongs to a different object" in caplog.text
+
+
+def test_interrupted_write_keeps_previous_file(tmp_path, monkeypatch):
+    results_file = tmp_path / "kettle"
+    save_object(results_file, "full kettle")
+
+    def interrupted_replace(source, destination):
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(os, "replace", interrupted_replace)
+    with pytest.raises(KeyboardInterrupt):
+        save_object(results_file, "empty kettle")
+    monkeypatch.undo()
+
+    assert load_object(results_file) == "full kettle"
+    assert not any(path.name.endswith(TMP_FILE_SUFFIX) for path in tmp_path.iterdir())
+
+
+def test_fsync(tmp_path, monkeypatch):
+    synced_fds = []
+    fsync = os.fsync
+
+    def recording_fsync(fd):
+        synced_fds.append(fd)
+        fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", recording_fsync)
+    config.set_fsync_enabled(True)
+    try:
+        save_object(tmp_path / "kettle", "full kettle")
+    finally:
+        config.set_fsync_enabled(config.Config.fsync)
+    assert len(synced_fds) > 0
+    assert load_object(tmp_path / "kettle") == "full kettle"
+
+
+def test_concurrent_processes(tmp_path):
+    start_time = time.time() + 1
+    with ProcessPoolExecutor(
+        NUM_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(brew_concurrently, tmp_path, start_time, seed)
+            for seed in range(NUM_PROCESSES)
+        ]
+        assert all(future.result() for future in futures)
+
+    assert not any(
+        path.name.endswith(TMP_FILE_SUFFIX) for path in tmp_path.rglob("*")
+    )
+    for idx in range(NUM_KEYS):
+        assert steep_tea(idx) == f"tea steeped for {idx} min"
+        pid, samples = weigh_leaves(idx)
+        assert bytes(samples.data) == bytes([pid % 256]) * 4096
@@ -0,0 +1,199 @@
+from datetime import timedelta
+from typing import Optional
+import time
+
+import pytest
+
+from pycrastinate import (
+    stage,
+    hook,
+    Subscription,
+    RetentionPolicy,
+    collect_garbage,
+)
+from pycrastinate.__main__ import main, parse_duration, parse_size
+from pycrastinate.garbage_collection import (
+    EVICTED_BY_AGE,
+    EVICTED_BY_CODE_HASH,
+    EVICTED_BY_IDLE_TIME,
+    EVICTED_BY_SIZE,
+)
+
+from .utils.call_counter import CallCounter
+
+
+DELAY = 0.1
+
+
+@pytest.fixture
+def workshop():
+    call_counter = CallCounter()
+
+    @stage
+    @call_counter
+    def cut_planks(num_planks: int = 10):
+        # Cheap to recompute, but large
+        return b"plank" * 1000 * num_planks
+
+    @stage
+    @call_counter
+    def carve_figure(detail: int = 3):
+        # Expensive to recompute, but small
+        time.sleep(DELAY)
+        return "figure" * detail
+
+    return cut_planks, carve_figure, call_counter
+
+
+def get_sizes(*stages):
+    return {
+        stage: sum(invocation.payload_size for invocation in stage.list_invocations())
+        for stage in stages
+    }
+
+
+def test_cost_aware_size_limit(workshop):
+    cut_planks, carve_figure, call_counter = workshop
+    carve_figure()
+    cut_planks()
+    sizes = get_sizes(cut_planks, carve_figure)
+
+    report = collect_garbage(RetentionPolicy(max_total_size=sizes[carve_figure]))
+    assert [evicted.reason for evicted in report.evicted] == [EVICTED_BY_SIZE]
+    assert report.evicted[0].invocation.stage_name.endswith("cut_planks")
+    assert report.freed_size == sizes[cut_planks]
+    assert report.remaining_size == sizes[carve_figure]
+
+    # The evicted result is recomputed, the other one loaded
+    carve_figure()
+    cut_planks()
+    assert call_counter.counter == {"cut_planks": 2, "carve_figure": 1}
+
+
+def test_lru_size_limit(workshop):
+    cut_planks, carve_figure, call_counter = workshop
+    carve_figure()
+    cut_planks()
+    time.sleep(DELAY)
+    # Accessed last
+    carve_figure()
+    sizes = get_sizes(cut_planks, carve_figure)
+
+    report = collect_garbage(RetentionPolicy(
+        max_total_size=sizes[cut_planks], cost_aware=False
+    ))
+    assert report.freed_size == sizes[cut_planks]
+    carve_figure()
+    assert call_counter.counter["carve_figure"] == 1
+
+
+def test_age_and_idle_time(workshop):
+    cut_planks, carve_figure, call_counter = workshop
+    cut_planks()
+    carve_figure()
+    time.sleep(2 * DELAY)
+    cut_planks(num_planks=2)
+
+    report = collect_garbage(
+        RetentionPolicy(max_age=timedelta(seconds=DELAY)), dry_run=True
+    )
+    assert report.dry_run
+    assert [evicted.reason for evicted in report.evicted] == [EVICTED_BY_AGE] * 2
+    assert len(cut_planks.list_invocations()) == 2
+
+    time.sleep(2 * DELAY)
+    cut_planks()
+    report = collect_garbage(RetentionPolicy(max_idle_time=timedelta(seconds=DELAY)))
+    assert [evicted.reason for evicted in report.evicted] == [
+        EVICTED_BY_IDLE_TIME
+    ] * 2
+    assert len(cut_planks.list_invocations()) == 1
+    assert carve_figure.list_invocations() == []
+
+
+def test_keep_latest_code_hashes(workshop):
+    cut_planks, carve_figure, call_counter = workshop
+    cut_planks()
+    cut_planks(num_planks=2)
+    carve_figure()
+
+    def cut_boards(num_planks: int = 10):
+        return b"board" * 1000 * num_planks
+
+    # The same stage with changed code
+    previous_stage_func = cut_planks.stage_func
+    cut_boards.__qualname__ = previous_stage_func.__qualname__
+    cut_planks.stage_func = cut_boards
+    try:
+        cut_planks()
+        report = collect_garbage(RetentionPolicy(keep_code_hashes=1))
+        assert len(cut_planks.list_invocations()) == 1
+    finally:
+        cut_planks.stage_func = previous_stage_func
+
+    assert [evicted.reason for evicted in report.evicted] == [
+        EVICTED_BY_CODE_HASH
+    ] * 2
+    assert len(carve_figure.list_invocations()) == 1
+    cut_planks()
+    assert call_counter.counter["cut_planks"] == 3
+
+
+def test_hook_states_forget_evicted_results(workshop):
+    cut_planks, carve_figure, _ = workshop
+    hook_calls = CallCounter()
+    outputs = []
+
+    @hook
+    @hook_calls
+    def build_chair(
+        planks: bytes = Subscription(cut_planks),
+        figure: Optional[str] = Subscription(carve_figure, optional=True),
+    ) -> None:
+        outputs.append((len(planks), figure))
+
+    carve_figure()
+    cut_planks()
+    assert outputs == [(50000, "figurefigurefigure")]
+
+    collect_garbage(RetentionPolicy(max_total_size=0))
+    # The evicted figure is treated as missing instead of failing to load it
+    cut_planks(num_planks=1)
+    assert outputs[-1] == (5000, None)
+    assert hook_calls.counter["build_chair"] == 2
+
+
+def test_invalid_policies():
+    with pytest.raises(ValueError, match="At least one code hash"):
+        RetentionPolicy(keep_code_hashes=0)
+    with pytest.raises(ValueError, match="must not be negative"):
+        RetentionPolicy(max_total_size=-1)
+
+
+def test_command(workshop, tmp_path, capsys):
+    cut_planks, carve_figure, _ = workshop
+    cut_planks()
+    carve_figure()
+
+    max_size = str(get_sizes(carve_figure)[carve_figure])
+    main(["gc", "--cache-dir", str(tmp_path), "--max-size", max_size, "--dry-run"])
+    assert capsys.readouterr().out.startswith("Would evict 1 results")
+
+    main(["gc", "--cache-dir", str(tmp_path), "--max-size", "0", "--verbose"])
+    output = capsys.readouterr().out
+    assert "cut_planks" in output and "carve_figure" in output
+    assert "Evicted 2 results" in output
+    assert cut_planks.list_invocations() == []
+
+    with pytest.raises(SystemExit):
+        main(["gc", "--max-age", "soon"])
+
+
+def test_parsing():
+    assert parse_size("1024") == 1024
+    assert parse_size("1.5K") == 1536
+    assert parse_size("10GB") == 10 * 1024 ** 3
+    assert parse_duration("12h") == timedelta(hours=12)
+    assert parse_duration("2w") == timedelta(days=14)
+    with pytest.raises(ValueError, match="Invalid size"):
+        parse_size("lots")
@@ -1,4 +1,17 @@
-from pycrastinate.utils.hashing import compute_code_hash, compute_value_hash
+import array
+import functools
+import hashlib
+
+from pycrastinate.utils.hashing import (
+    compute_buffer_hash,
+    compute_code_hash,
+    compute_value_hash,
+    clear_code_hash_cache,
+    get_code_hash_cache_stats,
+    register_value_hasher,
+    unregister_value_hasher,
+)
+from pycrastinate.utils.encoding import encode
 
 
 def test_empty_funcs_equal():
@@ -100,6 +113,157 @@ def test_different_comments_and_whitespaces_same():
     assert hash_1 == hash_2
 
 
+def test_code_hash_cached_per_code_object():
+    def func_generator():
+        def foo(a: int):
+            return a + 1
+        return foo
+
+    clear_code_hash_cache()
+    hash_1 = compute_code_hash(func_generator())
+    hash_2 = compute_code_hash(func_generator())
+    stats = get_code_hash_cache_stats()
+    assert hash_1 == hash_2
+    assert stats.misses == 1
+    assert stats.hits == 1
+
+
+def test_code_hash_cache_invalidated_on_redefinition():
+    def foo(a: int):
+        return a + 1
+    hash_1 = compute_code_hash(foo)
+
+    def foo(a: int):
+        return a + 2
+    clear_code_hash_cache()
+    hash_2 = compute_code_hash(foo)
+    assert hash_1 != hash_2
+
+    def bar(a: int):
+        return a * 2
+    foo.__code__ = bar.__code__
+    hash_3 = compute_code_hash(foo)
+    assert hash_3 == compute_code_hash(bar)
+    assert hash_3 != hash_2
+    assert get_code_hash_cache_stats().misses == 2
+
+
+def test_code_hash_cache_distinguishes_wrapped_funcs():
+    def wrap(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return func(*args, **kwargs)
+        return wrapper
+
+    @wrap
+    def foo():
+        return "foo"
+
+    @wrap
+    def bar():
+        return "bar"
+
+    assert foo.__code__ is bar.__code__
+    assert compute_code_hash(foo) != compute_code_hash(bar)
+
+
+def test_value_hash_matches_serialized_hash():
+    values = [
+        None,
+        ("abc", {"x": 1}),
+        [b"x" * 200_000, "y" * 300_000, list(range(50_000))],
+        {"chunks": [bytes([idx]) * 70_000 for idx in range(5)]},
+    ]
+    for value in values:
+        assert compute_value_hash(value) == hashlib.sha256(encode(value)).digest()
+
+
+def test_buffer_values_hashed_by_content():
+    data = bytes(range(256)) * 1000
+    assert compute_value_hash(bytearray(data)) == compute_value_hash(bytearray(data))
+    assert compute_value_hash(memoryview(data)) == compute_value_hash(
+        memoryview(bytearray(data))
+    )
+    # The type is part of the hash, equal buffers of different types don't collide
+    assert compute_value_hash(memoryview(data)) != compute_value_hash(bytearray(data))
+    assert compute_value_hash(bytearray(data)) != compute_value_hash(
+        bytearray(data[:-1])
+    )
+    assert compute_value_hash({"samples": array.array("d", [1.0, 2.0])}) == (
+        compute_value_hash({"samples": array.array("d", [1.0, 2.0])})
+    )
+    assert compute_value_hash(array.array("d", [1.0, 2.0])) != compute_value_hash(
+        array.array("f", [1.0, 2.0])
+    )
+
+
+def test_buffer_layout_part_of_hash():
+    data = bytearray(range(24))
+    matrix_2_by_12 = memoryview(data).cast("B", (2, 12))
+    matrix_4_by_6 = memoryview(data).cast("B", (4, 6))
+    assert compute_value_hash(matrix_2_by_12) != compute_value_hash(matrix_4_by_6)
+
+    every_second = memoryview(data)[::2]
+    assert compute_value_hash(every_second) != compute_value_hash(
+        memoryview(bytes(every_second))
+    )
+
+
+def test_buffer_hash_stable():
+    # Changing these hashes changes the stage hashes of existing caches
+    assert compute_value_hash(bytearray(b"pycrastinate")).hex() == (
+        "170ed2efb0419ec36ac27fcde60fb9b007eb45a347457b6077c0189ab1dc5cb6"
+    )
+    assert compute_value_hash(b"pycrastinate").hex() == (
+        "61bbcc125d6dfcf280a748170ef8b170f1dcb3c719cf77e4c7d5c4b90f952352"
+    )
+
+
+def test_bytes_hashed_by_buffer_hasher():
+    hashed_values = []
+
+    def spy_hasher(value):
+        hashed_values.append(value)
+        return compute_buffer_hash(value)
+
+    register_value_hasher(bytes, spy_hasher)
+    register_value_hasher(bytearray, spy_hasher)
+    try:
+        bytes_hash = compute_value_hash(b"pycrastinate")
+        bytearray_hash = compute_value_hash(bytearray(b"pycrastinate"))
+    finally:
+        unregister_value_hasher(bytes)
+        unregister_value_hasher(bytearray)
+
+    assert hashed_values == [b"pycrastinate", bytearray(b"pycrastinate")]
+    # The buffer hasher is the default for both
+    assert compute_value_hash(b"pycrastinate") == bytes_hash
+    assert compute_value_hash(bytearray(b"pycrastinate")) == bytearray_hash
+
+
+class Point:
+    def __init__(self, x: int, y: int) -> None:
+        self.x = x
+        self.y = y
+        self.cached_norm = None
+
+
+def test_registered_value_hasher():
+    register_value_hasher(Point, lambda point: bytes([point.x, point.y]))
+    try:
+        point = Point(1, 2)
+        hash_1 = compute_value_hash([point])
+        point.cached_norm = 5
+        hash_2 = compute_value_hash([point])
+        hash_3 = compute_value_hash([Point(2, 1)])
+    finally:
+        unregister_value_hasher(Point)
+
+    assert hash_1 == hash_2
+    assert hash_1 != hash_3
+    assert compute_value_hash([point]) != hash_1
+
+
 # Test:
 # different names, same code -> same hash
 # different names, different args, same code -> different hash
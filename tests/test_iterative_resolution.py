@@ -0,0 +1,93 @@
+import sys
+
+import pytest
+
+from pycrastinate import stage, Result, Args, config
+
+from .utils.call_counter import CallCounter
+
+
+@pytest.fixture
+def river():
+    call_counter = CallCounter()
+
+    @stage
+    @call_counter
+    def measure_rain(millimeters: int = 10):
+        return millimeters
+
+    @stage
+    @call_counter
+    def fill_lake(rain=Result(measure_rain)):
+        return rain * 100
+
+    @stage
+    @call_counter
+    def fill_river(rain=Result(measure_rain, Args(millimeters=10)), width: int = 5):
+        return rain * width
+
+    @stage
+    @call_counter
+    def flood_delta(lake=Result(fill_lake), river=Result(fill_river)):
+        return lake + river
+
+    return measure_rain, flood_delta, call_counter
+
+
+@pytest.fixture(params=[config.KEYING_BY_VALUE, config.KEYING_BY_REFERENCE])
+def iterative_resolution(request):
+    config.set_keying_mode(request.param)
+    config.set_iterative_resolution_enabled(True)
+    yield
+    config.set_iterative_resolution_enabled(config.Config.iterative_resolution)
+    config.set_keying_mode(config.Config.keying_mode)
+
+
+def test_same_hashes(river, iterative_resolution):
+    _, flood_delta, call_counter = river
+    stage_hash, result = flood_delta.compute_or_load_result(Args(river=Args(width=7)))
+    assert result.result == 1070
+    # The diamond is resolved once
+    assert call_counter.counter == {
+        "measure_rain": 1, "fill_lake": 1, "fill_river": 1, "flood_delta": 1
+    }
+
+    config.set_iterative_resolution_enabled(False)
+    recursive_hash, _ = flood_delta.compute_or_load_result(Args(river=Args(width=7)))
+    assert recursive_hash == stage_hash
+    assert call_counter.counter["flood_delta"] == 1
+
+
+def test_missing_nodes(river, iterative_resolution):
+    measure_rain, flood_delta, call_counter = river
+    measure_rain()
+    flood_delta()
+    # Only the missing part of the graph is executed
+    assert flood_delta(river=Args(width=1)) == 1010
+    assert call_counter.counter == {
+        "measure_rain": 1, "fill_lake": 1, "fill_river": 2, "flood_delta": 2
+    }
+    _, result = flood_delta.compute_or_load_result(Args(lake=Args(rain=Args(2))))
+    assert result.result == 250
+    assert result.args["lake"] == 200
+
+
+def test_deep_chain(iterative_resolution):
+    call_counter = CallCounter()
+    layers = []
+
+    @stage
+    def source(depth: int = 0):
+        return depth
+
+    layers.append(source)
+    for _ in range(sys.getrecursionlimit()):
+        @call_counter
+        def pipe(upstream=Result(layers[-1])):
+            return upstream + 1
+        layers.append(stage(pipe))
+
+    # Executed and loaded in constant stack depth
+    assert layers[-1]() == sys.getrecursionlimit()
+    assert layers[-1]() == sys.getrecursionlimit()
+    assert call_counter.counter["pipe"] == sys.getrecursionlimit()
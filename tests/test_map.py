@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+from pycrastinate import stage, Result, Args, config
+from pycrastinate.stages import execution
+
+from .utils.call_counter import CallCounter
+
+
+DELAY = 0.2
+NUM_WORKERS = 5
+
+
+@pytest.fixture
+def orchard():
+    call_counter = CallCounter()
+
+    @stage
+    @call_counter
+    def plant_orchard(num_trees: int = 10):
+        return [f"tree {idx}" for idx in range(num_trees)]
+
+    @stage
+    @call_counter
+    def harvest(
+        tree_idx: int,
+        kilograms: int = 1,
+        trees=Result(plant_orchard),
+    ):
+        time.sleep(DELAY)
+        if kilograms < 0:
+            raise ValueError("Can't harvest negative apples")
+        return f"{kilograms} kg from {trees[tree_idx]}"
+
+    return harvest, call_counter
+
+
+@pytest.mark.parametrize("keying_mode", [
+    config.KEYING_BY_VALUE, config.KEYING_BY_REFERENCE
+])
+def test_results_in_order(orchard, keying_mode):
+    harvest, call_counter = orchard
+    config.set_keying_mode(keying_mode)
+    try:
+        assert harvest(3) == "1 kg from tree 3"
+        args_list = [Args(idx % 5, kilograms=2) for idx in range(10)] + [Args(3)]
+        start = time.perf_counter()
+        results = harvest.map(args_list, max_workers=NUM_WORKERS)
+        duration = time.perf_counter() - start
+    finally:
+        config.set_keying_mode(config.Config.keying_mode)
+
+    assert results == [
+        f"2 kg from tree {idx % 5}" for idx in range(10)
+    ] + ["1 kg from tree 3"]
+    # Each missing result was executed once and in parallel, the shared dependency
+    # wasn't executed again
+    assert call_counter.counter == {"plant_orchard": 1, "harvest": 6}
+    assert duration < 2 * DELAY
+
+
+def test_shared_dependencies_resolved_once(orchard):
+    harvest, call_counter = orchard
+    assert harvest.map(
+        [Args(idx, trees=Args(num_trees=20)) for idx in range(12, 16)]
+    ) == [f"1 kg from tree {idx}" for idx in range(12, 16)]
+    assert call_counter.counter == {"plant_orchard": 1, "harvest": 4}
+
+
+def test_as_completed(orchard):
+    harvest, call_counter = orchard
+    harvest(0)
+    results = harvest.map(
+        [Args(idx) for idx in range(NUM_WORKERS)],
+        max_workers=NUM_WORKERS,
+        as_completed=True,
+    )
+    # Cached results are available first
+    assert next(results) == (0, "1 kg from tree 0")
+    assert sorted(results) == [
+        (idx, f"1 kg from tree {idx}") for idx in range(1, NUM_WORKERS)
+    ]
+    assert call_counter.counter["harvest"] == NUM_WORKERS
+
+
+def test_cached_results_loaded_in_parallel(orchard, monkeypatch):
+    harvest, _ = orchard
+    harvest.map([Args(idx) for idx in range(NUM_WORKERS)])
+    loading_threads = []
+    load_stage_result = execution.load_stage_result
+
+    def load_stage_result_recording(results_dir, stage_hash):
+        loading_threads.append(threading.current_thread().name)
+        return load_stage_result(results_dir, stage_hash)
+    monkeypatch.setattr(execution, "load_stage_result", load_stage_result_recording)
+
+    harvest.map([Args(idx) for idx in range(NUM_WORKERS)])
+    # Including the shared dependency
+    assert len(loading_threads) == NUM_WORKERS + 1
+    assert all(name.startswith("pycrastinate-map") for name in loading_threads)
+
+
+def test_errors_propagate(orchard):
+    harvest, _ = orchard
+    with pytest.raises(ValueError, match="negative apples"):
+        harvest.map([Args(1), Args(2, kilograms=-1)], max_workers=2)
+    with pytest.raises(ValueError, match="must be positive"):
+        harvest.map([Args(1)], max_workers=0)
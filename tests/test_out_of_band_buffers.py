@@ -0,0 +1,103 @@
+import mmap
+import pickle
+
+import pytest
+
+from pycrastinate import stage, config
+from pycrastinate.stages.persistence import migrate_stage_results
+from pycrastinate.utils.persistence import (
+    BLOB_FILE_SUFFIX,
+    save_object,
+    load_object,
+)
+
+from .utils.call_counter import CallCounter
+
+
+pytestmark = pytest.mark.skipif(
+    pickle.HIGHEST_PROTOCOL < 5, reason="Requires pickle protocol 5"
+)
+
+
+class Samples:
+    # Pickles its data as an out-of-band buffer, like numpy arrays do
+    def __init__(self, data) -> None:
+        self.data = memoryview(data)
+
+    def __reduce_ex__(self, protocol):
+        if protocol < 5:
+            return Samples, (bytes(self.data),)
+        return Samples, (pickle.PickleBuffer(self.data),)
+
+
+@pytest.fixture
+def out_of_band_min_size():
+    config.set_out_of_band_min_size(1024)
+    yield
+    config.set_out_of_band_min_size(config.Config.out_of_band_min_size)
+
+
+def test_large_buffers_memory_mapped(tmp_path, out_of_band_min_size):
+    results_file = tmp_path / "samples"
+    data = bytes(range(256)) * 64
+    save_object(results_file, {"samples": Samples(bytearray(data))})
+
+    assert (tmp_path / ("samples" + BLOB_FILE_SUFFIX)).exists()
+    samples = load_object(results_file)["samples"]
+    assert isinstance(samples.data.obj, mmap.mmap)
+    assert bytes(samples.data) == data
+
+    # Loaded buffers are copy-on-write
+    samples.data[0] = 255
+    assert bytes(load_object(results_file)["samples"].data) == data
+
+
+def test_small_buffers_in_band(tmp_path, out_of_band_min_size):
+    results_file = tmp_path / "samples"
+    save_object(results_file, [Samples(bytearray(1000)), Samples(bytearray(2000))])
+    assert (tmp_path / ("samples" + BLOB_FILE_SUFFIX)).exists()
+
+    save_object(results_file, [Samples(bytearray(1000))])
+    assert not (tmp_path / ("samples" + BLOB_FILE_SUFFIX)).exists()
+    samples = load_object(results_file)
+    assert not isinstance(samples[0].data.obj, mmap.mmap)
+    assert bytes(samples[0].data) == bytes(1000)
+
+
+def test_multiple_buffers(tmp_path, out_of_band_min_size):
+    results_file = tmp_path / "samples"
+    buffers = [bytearray([idx]) * (5000 + idx) for idx in range(5)]
+    save_object(results_file, [Samples(buffer) for buffer in buffers])
+    loaded = load_object(results_file)
+    assert [bytes(samples.data) for samples in loaded] == buffers
+
+
+def test_missing_blob_file(tmp_path, out_of_band_min_size):
+    results_file = tmp_path / "samples"
+    save_object(results_file, Samples(bytearray(5000)))
+    (tmp_path / ("samples" + BLOB_FILE_SUFFIX)).unlink()
+    assert load_object(results_file) is None
+
+
+def test_stage_result_memory_mapped(out_of_band_min_size):
+    call_counter = CallCounter()
+
+    @stage
+    @call_counter
+    def record_espresso_shots(num_shots: int):
+        return Samples(bytearray(range(256)) * num_shots)
+
+    first_result = record_espresso_shots(100)
+    cached_result = record_espresso_shots(100)
+    assert call_counter.counter["record_espresso_shots"] == 1
+    assert isinstance(cached_result.data.obj, mmap.mmap)
+    assert bytes(cached_result.data) == bytes(first_result.data)
+
+
+def test_migration_skips_blob_files(tmp_path, out_of_band_min_size):
+    @stage
+    def record_espresso_shots(num_shots: int):
+        return Samples(bytearray(range(256)) * num_shots)
+
+    record_espresso_shots(100)
+    assert migrate_stage_results(tmp_path) == 0
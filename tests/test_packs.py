@@ -0,0 +1,127 @@
+import hashlib
+
+from pycrastinate import stage, config
+from pycrastinate.storage import FileSystemStorage
+from pycrastinate.storage.packs import PACK_DIR_NAME
+from pycrastinate.utils.locking import LOCK_FILE_SUFFIX, hold_lock_file
+from pycrastinate.stages.persistence import (
+    STAGE_RESULTS_DIR_NAME,
+    pack_stage_results,
+    clear_result_cache,
+)
+
+from .utils.call_counter import CallCounter
+from .test_out_of_band_buffers import Samples, out_of_band_min_size  # noqa: F401
+
+
+def make_key(idx: int) -> str:
+    encoded_hash = hashlib.sha256(idx.to_bytes(8, "little")).hexdigest()
+    return f"pantry/{encoded_hash[:2]}/{encoded_hash[2:]}"
+
+
+def count_loose_files(tmp_path):
+    return sum(
+        1
+        for path in (tmp_path / STAGE_RESULTS_DIR_NAME).rglob("*")
+        if path.is_file() and PACK_DIR_NAME not in path.parts
+    )
+
+
+def test_pack_storage(tmp_path):
+    storage = FileSystemStorage(tmp_path)
+    for idx in range(20):
+        storage.save(make_key(idx), {"jar": idx})
+    storage.save("pantry/notes", "not packed")
+
+    assert storage.pack("pantry/") == 20
+    assert not (tmp_path / make_key(0)).exists()
+    assert (tmp_path / "pantry/notes").exists()
+    for idx in range(20):
+        assert storage.load(make_key(idx))[0] == {"jar": idx}
+        assert storage.exists(make_key(idx))
+    assert storage.load(make_key(20)) is None
+    assert len(list(storage.list_objects("pantry/"))) == 21
+
+    # Loose objects take precedence over packed objects
+    storage.save(make_key(3), {"jar": "refilled"})
+    storage.save(make_key(20), {"jar": 20})
+    assert storage.load(make_key(3))[0] == {"jar": "refilled"}
+    assert len(list(storage.list_objects("pantry/"))) == 22
+
+    assert storage.delete(make_key(5))
+    assert not storage.exists(make_key(5))
+    assert not storage.delete(make_key(5))
+
+    # Repacking merges the existing pack with the new loose objects
+    assert storage.pack("pantry/") == 2
+    pack_files = list((tmp_path / "pantry" / PACK_DIR_NAME).iterdir())
+    assert sorted(path.suffix for path in pack_files) == [".idx", ".pack"]
+    assert storage.load(make_key(3))[0] == {"jar": "refilled"}
+    assert storage.load(make_key(20))[0] == {"jar": 20}
+    assert storage.load(make_key(5)) is None
+    assert len(list(storage.list_objects("pantry/"))) == 21
+
+    # Packs written by other instances are picked up
+    assert FileSystemStorage(tmp_path).load(make_key(7))[0] == {"jar": 7}
+
+
+def test_load_packed_stage_results(tmp_path, out_of_band_min_size):
+    call_counter = CallCounter()
+
+    @stage
+    @call_counter
+    def knead_dough(minutes: int):
+        return f"dough kneaded for {minutes} min"
+
+    @stage
+    @call_counter
+    def slice_loaf(thickness_mm: int):
+        return Samples(bytearray([thickness_mm]) * 4096)
+
+    for minutes in range(10):
+        knead_dough(minutes)
+    slice_loaf(12)
+
+    # The large result has a blob file and stays loose
+    assert pack_stage_results(tmp_path) == 10
+    assert count_loose_files(tmp_path) == 2
+
+    for cache_index_enabled in [True, False]:
+        clear_result_cache()
+        config.set_cache_index_enabled(cache_index_enabled)
+        for minutes in range(10):
+            assert knead_dough(minutes) == f"dough kneaded for {minutes} min"
+        assert bytes(slice_loaf(12).data[:1]) == bytes([12])
+    config.set_cache_index_enabled(config.Config.cache_index)
+
+    knead_dough(10)
+    assert call_counter.counter == {"knead_dough": 11, "slice_loaf": 1}
+    assert count_loose_files(tmp_path) == 3
+    assert len(knead_dough.list_invocations()) == 11
+
+
+def test_concurrent_repack_skipped(tmp_path):
+    storage = FileSystemStorage(tmp_path)
+    for idx in range(5):
+        storage.save(make_key(idx), {"jar": idx})
+    assert storage.pack("pantry/") == 5
+    assert storage.delete(make_key(0))
+    storage.save(make_key(5), {"jar": 5})
+
+    config.set_single_flight_timeout(0.1)
+    try:
+        # Held by another process that is repacking
+        lock_file = tmp_path / "pantry" / (PACK_DIR_NAME + LOCK_FILE_SUFFIX)
+        with hold_lock_file(lock_file, timeout=1, stale_age=60):
+            assert storage.pack("pantry/") == 0
+    finally:
+        config.set_single_flight_timeout(config.Config.single_flight_timeout)
+    assert (tmp_path / make_key(5)).exists()
+    assert storage.load(make_key(0)) is None
+
+    assert storage.pack("pantry/") == 1
+    assert not lock_file.exists()
+    assert storage.load(make_key(0)) is None
+    assert [storage.load(make_key(idx))[0] for idx in range(1, 6)] == [
+        {"jar": idx} for idx in range(1, 6)
+    ]
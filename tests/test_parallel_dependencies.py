@@ -0,0 +1,176 @@
+import os
+import threading
+import time
+
+import pytest
+
+from pycrastinate import stage, hook, Subscription, Result, Args, config
+
+from .utils.call_counter import CallCounter
+
+
+NUM_INGREDIENTS = 5
+DELAY = 0.3
+
+
+@stage
+def chop_vegetable(name: str):
+    time.sleep(DELAY)
+    return f"chopped {name}", os.getpid()
+
+
+@stage
+def cook_soup(
+    carrot=Result(chop_vegetable, Args("carrot")),
+    leek=Result(chop_vegetable, Args("leek")),
+    onion=Result(chop_vegetable, Args("onion")),
+):
+    return [carrot, leek, onion]
+
+
+@pytest.fixture
+def max_parallelism():
+    config.set_max_parallelism(NUM_INGREDIENTS)
+    yield
+    config.set_max_parallelism(config.Config.max_parallelism)
+
+
+@pytest.fixture
+def process_executor(max_parallelism):
+    config.set_executor(config.EXECUTOR_PROCESS)
+    yield
+    config.set_executor(config.Config.executor)
+
+
+@pytest.fixture
+def kitchen():
+    call_counter = CallCounter()
+    threads = set()
+
+    def make_ingredient(ingredient_idx):
+        @stage
+        @call_counter
+        def prepare_ingredient(amount: int = 1, idx: int = ingredient_idx):
+            threads.add(threading.get_ident())
+            time.sleep(DELAY)
+            if amount < 0:
+                raise ValueError(f"Negative amount of ingredient {idx}")
+            return f"{amount}x ingredient {idx}"
+        return prepare_ingredient
+
+    ingredients = [make_ingredient(idx) for idx in range(NUM_INGREDIENTS)]
+
+    @stage
+    @call_counter
+    def cook(
+        ingredient_0=Result(ingredients[0]),
+        ingredient_1=Result(ingredients[1]),
+        ingredient_2=Result(ingredients[2]),
+        ingredient_3=Result(ingredients[3]),
+        ingredient_4=Result(ingredients[4]),
+    ):
+        return [ingredient_0, ingredient_1, ingredient_2, ingredient_3, ingredient_4]
+
+    return cook, call_counter, threads
+
+
+@pytest.mark.parametrize("keying_mode", [
+    config.KEYING_BY_VALUE, config.KEYING_BY_REFERENCE
+])
+def test_siblings_resolved_concurrently(
+    tmp_path, kitchen, max_parallelism, keying_mode
+):
+    cook, call_counter, threads = kitchen
+    config.set_keying_mode(keying_mode)
+    try:
+        start = time.perf_counter()
+        stage_hash, invocation = cook.compute_or_load_result(Args())
+        duration = time.perf_counter() - start
+
+        assert duration < DELAY * NUM_INGREDIENTS / 2
+        assert len(threads) > 1
+        assert invocation.result == [
+            f"1x ingredient {idx}" for idx in range(NUM_INGREDIENTS)
+        ]
+
+        # The same hash as when resolving the dependencies one after another
+        config.set_cache_dir(tmp_path / "serial")
+        config.set_max_parallelism(1)
+        serial_stage_hash, serial_invocation = cook.compute_or_load_result(Args())
+    finally:
+        config.set_keying_mode(config.Config.keying_mode)
+    assert serial_stage_hash == stage_hash
+    assert serial_invocation.result == invocation.result
+    assert call_counter.counter["cook"] == 2
+
+
+def test_first_error_propagates(kitchen, max_parallelism):
+    cook, call_counter, _ = kitchen
+    with pytest.raises(ValueError, match="ingredient 1"):
+        cook(
+            ingredient_1=Args(amount=-1),
+            ingredient_3=Args(amount=-3),
+        )
+    # The other dependencies still finished and were persisted
+    assert call_counter.counter == {"prepare_ingredient": NUM_INGREDIENTS, "cook": 0}
+    cook(ingredient_1=Args(amount=1), ingredient_3=Args(amount=3))
+    assert call_counter.counter == {
+        "prepare_ingredient": NUM_INGREDIENTS + 2, "cook": 1
+    }
+
+
+def test_nested_dependencies_dont_exhaust_pool():
+    config.set_max_parallelism(2)
+    try:
+        layers = []
+
+        @stage
+        def grow(seed: int = 0):
+            return seed
+
+        layers.append(grow)
+        for _ in range(3):
+            def combine(
+                first=Result(layers[-1], Args(seed=1)),
+                second=Result(layers[-1], Args(seed=2)),
+                third=Result(layers[-1], Args(seed=3)),
+                seed: int = 0,
+            ):
+                return first + second + third + seed
+            layers.append(stage(combine))
+        assert layers[-1]() == 78
+    finally:
+        config.set_max_parallelism(config.Config.max_parallelism)
+
+
+def test_concurrent_hook_triggers(max_parallelism):
+    tastings = []
+
+    @hook
+    def taste(
+        carrot=Subscription(chop_vegetable, when="different_from_all"),
+    ):
+        tastings.append(carrot)
+
+    cook_soup()
+    # All triggers were recorded in the hook state
+    cook_soup()
+    assert sorted(name for name, _ in tastings) == [
+        "chopped carrot", "chopped leek", "chopped onion"
+    ]
+
+
+def test_process_executor(process_executor):
+    soup = cook_soup()
+    assert [name for name, _ in soup] == [
+        "chopped carrot", "chopped leek", "chopped onion"
+    ]
+    pids = {pid for _, pid in soup}
+    assert os.getpid() not in pids
+
+    @stage
+    def season(pinches: int):
+        return pinches
+
+    with pytest.raises(ValueError, match="must be defined at module level"):
+        season(2)
@@ -0,0 +1,136 @@
+from datetime import timedelta
+import time
+
+import pytest
+
+from pycrastinate import stage, Result, Args, config
+
+from .utils.call_counter import CallCounter
+
+
+DELAY = 0.2
+
+
+@pytest.fixture
+def expedition():
+    call_counter = CallCounter()
+
+    @stage
+    @call_counter
+    def count_hikers(group: str = "alpine club"):
+        return len(group)
+
+    @stage
+    @call_counter
+    def pack_food(num_hikers=Result(count_hikers), days: int = 3):
+        time.sleep(DELAY)
+        if days < 0:
+            raise ValueError("Can't pack food for negative days")
+        return num_hikers * days
+
+    @stage
+    @call_counter
+    def pitch_tents(num_hikers=Result(count_hikers)):
+        time.sleep(DELAY)
+        return (num_hikers + 1) // 2
+
+    @stage
+    @call_counter
+    def start_hike(
+        meals=Result(pack_food),
+        tents=Result(pitch_tents),
+        route: str = "ridge",
+    ):
+        return f"{route}: {meals} meals, {tents} tents"
+
+    return count_hikers, pack_food, pitch_tents, start_hike, call_counter
+
+
+@pytest.mark.parametrize("keying_mode", [
+    config.KEYING_BY_VALUE, config.KEYING_BY_REFERENCE
+])
+def test_dry_run_and_execute(expedition, keying_mode):
+    count_hikers, pack_food, pitch_tents, start_hike, call_counter = expedition
+    config.set_keying_mode(keying_mode)
+    try:
+        plan = start_hike.plan()
+        # Nothing was executed
+        assert call_counter.counter == {
+            "count_hikers": 0, "pack_food": 0, "pitch_tents": 0, "start_hike": 0
+        }
+        nodes = list(plan.nodes.values())
+        assert [node.stage for node in nodes[:1]] == [count_hikers]
+        assert {node.stage for node in nodes[1:3]} == {pack_food, pitch_tents}
+        assert nodes[-1].stage is start_hike
+        assert nodes[-1].reference_hash == plan.root
+        assert len(nodes[-1].dependencies) == 2
+        assert plan.cached_nodes == []
+        assert plan.estimated_duration == timedelta()
+        assert "missing" in str(plan)
+
+        # Independent nodes are executed in parallel
+        start = time.perf_counter()
+        result = plan.execute(max_parallelism=2)
+        assert time.perf_counter() - start < 2 * DELAY
+        assert result.result == "ridge: 33 meals, 6 tents"
+        assert call_counter.counter == {
+            "count_hikers": 1, "pack_food": 1, "pitch_tents": 1, "start_hike": 1
+        }
+
+        plan = start_hike.plan(meals=Args(days=5))
+        assert [node.stage for node in plan.missing_nodes] == [
+            pack_food, start_hike
+        ]
+        assert plan.missing_nodes[0].estimated_duration.total_seconds() >= DELAY
+        assert plan.estimated_duration.total_seconds() >= DELAY
+        assert plan.execute().result == "ridge: 55 meals, 6 tents"
+        assert call_counter.counter["pack_food"] == 2
+        assert call_counter.counter["count_hikers"] == 1
+        assert start_hike.plan(meals=Args(days=5)).missing_nodes == []
+    finally:
+        config.set_keying_mode(config.Config.keying_mode)
+
+
+def test_unknown_hashes_by_value(expedition):
+    count_hikers, _, pitch_tents, start_hike, _ = expedition
+    count_hikers()
+    nodes = list(start_hike.plan().nodes.values())
+    assert nodes[0].cached
+    # Hashed with the loaded result of the cached dependency
+    assert all(node.stage_hash is not None for node in nodes[1:3])
+    assert nodes[-1].stage_hash is None
+    assert not nodes[-1].cached
+
+    tents_node = next(node for node in nodes if node.stage is pitch_tents)
+    pitch_tents()
+    assert start_hike.plan().nodes[tents_node.reference_hash].cached
+
+
+def test_errors_propagate(expedition):
+    _, _, _, start_hike, call_counter = expedition
+    plan = start_hike.plan(meals=Args(days=-1))
+    with pytest.raises(ValueError, match="negative days"):
+        plan.execute(max_parallelism=2)
+    assert call_counter.counter["start_hike"] == 0
+    assert call_counter.counter["pitch_tents"] == 1
+    with pytest.raises(ValueError, match="must be positive"):
+        plan.execute(max_parallelism=0)
+
+
+def test_deep_chain():
+    layers = []
+
+    @stage
+    def spring(altitude: int = 0):
+        return altitude
+
+    layers.append(spring)
+    for _ in range(1500):
+        def stream(upstream=Result(layers[-1])):
+            return upstream + 1
+        layers.append(stage(stream))
+
+    # Planned without recursion
+    plan = layers[-1].plan()
+    assert len(plan.nodes) == 1501
+    assert len(plan.missing_nodes) == 1501
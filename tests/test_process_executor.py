@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+from multiprocessing.shared_memory import SharedMemory
+import mmap
+import os
+import time
+
+import pytest
+
+from pycrastinate import stage, Result, Args, config
+from pycrastinate.stages import concurrency
+
+from .test_out_of_band_buffers import Samples
+
+
+DELAY = 0.2
+SAMPLE_SIZE = 1 << 20
+
+
+@stage(executor="process")
+def ferment(days: int):
+    time.sleep(DELAY)
+    return f"fermented for {days} days", os.getpid()
+
+
+@stage(executor="process")
+def press_juice(liters: int):
+    return Samples(
+        bytearray(range(256)) * (SAMPLE_SIZE // 256) + bytes([liters])
+    )
+
+
+@stage(executor="thread")
+def bottle(juice=Result(press_juice, Args(liters=3))):
+    return len(juice.data), os.getpid()
+
+
+@stage
+def label(vintage: int):
+    return vintage, os.getpid()
+
+
+@pytest.fixture
+def process_executor():
+    config.set_executor(config.EXECUTOR_PROCESS)
+    yield
+    config.set_executor(config.Config.executor)
+
+
+def test_stage_executor():
+    start_time = datetime.now()
+    invocation = ferment.compute_or_load_result(Args(3))[1]
+    result, pid = invocation.result
+    assert result == "fermented for 3 days"
+    assert pid != os.getpid()
+    # Timed in the worker
+    assert start_time <= invocation.start_time <= datetime.now()
+    assert timedelta(seconds=DELAY) <= invocation.execution_duration
+    assert invocation.execution_duration < datetime.now() - start_time
+
+    # The workers are reused
+    worker_pids = {
+        process.pid
+        for pool in concurrency._process_pools.values()
+        for process in pool._processes.values()
+    }
+    assert pid in worker_pids
+    assert ferment(4)[1] in worker_pids
+    assert ferment(3) == (result, pid)
+
+    # The global executor doesn't apply to stages with their own executor
+    assert label(2024)[1] == os.getpid()
+
+
+def test_global_executor(process_executor):
+    assert label(2024)[1] != os.getpid()
+    assert bottle()[1] == os.getpid()
+
+
+def test_large_results_in_shared_memory(monkeypatch):
+    shared_buffers = []
+    receive_buffers = concurrency._receive_buffers
+
+    def record_buffers(buffers):
+        shared_buffers.extend(buffers)
+        return receive_buffers(buffers)
+
+    monkeypatch.setattr(concurrency, "_receive_buffers", record_buffers)
+    juice = press_juice(7).data
+    if concurrency.SHARED_MEMORY_DIR.is_dir():
+        # Mapped instead of copied
+        assert isinstance(juice.obj, mmap.mmap)
+    assert len(juice) == SAMPLE_SIZE + 1
+    assert juice[:256] == bytes(range(256))
+    assert juice[-1] == 7
+    assert bottle()[0] == SAMPLE_SIZE + 1
+
+    assert [size for _, size in shared_buffers] == [SAMPLE_SIZE + 1] * 2
+    # Received shared memory is removed
+    for name, _ in shared_buffers:
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name=name)
+
+
+def test_shared_memory_removed_on_errors(monkeypatch):
+    shared_buffers = []
+    receive_buffers = concurrency._receive_buffers
+
+    def record_buffers(buffers):
+        shared_buffers.extend(buffers)
+        return receive_buffers(buffers)
+
+    def decode_failing(encoded_data, buffers):
+        raise ValueError("Spilled juice")
+
+    monkeypatch.setattr(concurrency, "_receive_buffers", record_buffers)
+    monkeypatch.setattr(concurrency, "decode", decode_failing)
+    with pytest.raises(ValueError, match="Spilled juice"):
+        press_juice(8)
+    assert len(shared_buffers) == 1
+    for name, _ in shared_buffers:
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name=name)
+
+
+def test_unsupported_executor():
+    with pytest.raises(ValueError, match="Unsupported executor"):
+        stage(executor="fiber")(lambda: None)
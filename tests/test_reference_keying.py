@@ -0,0 +1,161 @@
+import pytest
+
+from pycrastinate import stage, hook, Subscription, Result, Args
+from pycrastinate.config import (
+    set_keying_mode,
+    KEYING_BY_REFERENCE,
+    KEYING_BY_VALUE,
+)
+from pycrastinate.stages import execution, LazyArgs
+
+from .utils.call_counter import CallCounter
+
+
+@pytest.fixture
+def loaded_hashes(monkeypatch):
+    set_keying_mode(KEYING_BY_REFERENCE)
+    loaded_hashes = []
+    load_stage_result = execution.load_stage_result
+
+    def load_stage_result_counting(results_dir, stage_hash):
+        loaded_hashes.append(stage_hash)
+        return load_stage_result(results_dir, stage_hash)
+    monkeypatch.setattr(execution, "load_stage_result", load_stage_result_counting)
+
+    yield loaded_hashes
+    set_keying_mode(KEYING_BY_VALUE)
+
+
+@pytest.fixture
+def brewery(loaded_hashes):
+    call_counter = CallCounter()
+
+    @stage
+    @call_counter
+    def malt_barley(kilos: int = 5):
+        return f"{kilos}kg malt"
+
+    @stage
+    @call_counter
+    def mash(malt=Result(malt_barley)):
+        return f"wort from {malt}"
+
+    @stage
+    @call_counter
+    def ferment(wort=Result(mash), days: int = 7):
+        return f"beer ({wort}, {days} days)"
+
+    return (malt_barley, mash, ferment), call_counter
+
+
+def test_cached_stage_loads_only_its_own_result(brewery, loaded_hashes):
+    (_, _, ferment), call_counter = brewery
+    beer_1 = ferment()
+    loaded_hashes.clear()
+    beer_2 = ferment()
+
+    assert beer_1 == beer_2
+    assert beer_1 == "beer (wort from 5kg malt, 7 days)"
+    assert len(loaded_hashes) == 1
+    assert call_counter.counter == {"malt_barley": 1, "mash": 1, "ferment": 1}
+
+
+def test_changed_args_only_execute_misses(brewery, loaded_hashes):
+    (_, _, ferment), call_counter = brewery
+    ferment()
+    beer = ferment(wort=Args(malt=Args(kilos=7)))
+
+    assert beer == "beer (wort from 7kg malt, 7 days)"
+    assert call_counter.counter == {"malt_barley": 2, "mash": 2, "ferment": 2}
+
+    loaded_hashes.clear()
+    ferment(wort=Args(malt=Args(kilos=7)), days=8)
+    # The new stage loads the result of its direct dependency only. Its own miss is
+    # checked again before it's executed.
+    assert len(set(loaded_hashes)) == 2
+    assert call_counter.counter == {"malt_barley": 2, "mash": 2, "ferment": 3}
+
+
+def test_upstream_code_change_invalidates_downstream(brewery):
+    (malt_barley_stage, _, ferment), call_counter = brewery
+    ferment()
+
+    @call_counter
+    def malt_barley(kilos: int = 5):
+        # Same result, but different code
+        return f"{kilos}kg " + "malt"
+    malt_barley_stage.stage_func = malt_barley
+    beer = ferment()
+
+    assert beer == "beer (wort from 5kg malt, 7 days)"
+    assert call_counter.counter == {"malt_barley": 2, "mash": 2, "ferment": 2}
+
+
+def test_dependency_args_loaded_lazily(brewery, loaded_hashes):
+    (_, mash, ferment), _ = brewery
+    ferment()
+    loaded_hashes.clear()
+    _, invocation = ferment.compute_or_load_result(Args())
+
+    assert isinstance(invocation.args, LazyArgs)
+    assert not invocation.args.is_loaded("wort")
+    assert invocation.args["days"] == 7
+    assert len(loaded_hashes) == 1
+    assert invocation.args["wort"] == "wort from 5kg malt"
+    assert len(loaded_hashes) == 2
+    assert invocation.args.materialize() == {
+        "days": 7, "wort": "wort from 5kg malt"
+    }
+    assert len(loaded_hashes) == 2
+
+
+def test_upstream_hooks_skipped_on_cache_hits(brewery):
+    (malt_barley, _, ferment), _ = brewery
+    hook_calls = CallCounter()
+
+    @hook
+    @hook_calls
+    def weigh_malt(malt: str = Subscription(malt_barley)) -> None:
+        pass
+
+    ferment()
+    assert hook_calls.counter["weigh_malt"] == 1
+    # The malt is neither loaded nor executed
+    ferment()
+    assert hook_calls.counter["weigh_malt"] == 1
+    ferment(days=8)
+    assert hook_calls.counter["weigh_malt"] == 1
+
+
+def test_shared_dependencies_prepared_once(monkeypatch, loaded_hashes):
+    @stage
+    def grow_hops(grams: int = 50):
+        return f"{grams}g hops"
+
+    @stage
+    def brew_lager(hops=Result(grow_hops)):
+        return f"lager with {hops}"
+
+    @stage
+    def brew_ale(hops=Result(grow_hops, Args(grams=50))):
+        return f"ale with {hops}"
+
+    @stage
+    def fill_crate(lager=Result(brew_lager), ale=Result(brew_ale)):
+        return [lager, ale]
+
+    hashed_funcs = []
+    compute_stage_hash = execution.compute_stage_hash
+
+    def compute_stage_hash_recording(func, exec_data):
+        hashed_funcs.append(func.__name__)
+        return compute_stage_hash(func, exec_data)
+    monkeypatch.setattr(execution, "compute_stage_hash", compute_stage_hash_recording)
+
+    execution.prepare_reference_execution(fill_crate.argument_plan.aggregate(Args()))
+    assert sorted(hashed_funcs) == ["brew_ale", "brew_lager", "grow_hops"]
+
+
+def test_invalid_keying_mode():
+    with pytest.raises(ValueError):
+        set_keying_mode("by_magic")
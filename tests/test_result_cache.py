@@ -0,0 +1,141 @@
+import pytest
+
+from pycrastinate import stage, Result, config
+from pycrastinate.stages.persistence import (
+    clear_result_cache,
+    get_result_cache_stats,
+)
+from pycrastinate.utils.caching import SizedLRUCache
+
+from .utils.call_counter import CallCounter
+
+
+@pytest.fixture
+def result_cache():
+    config.set_result_cache_size(2**20)
+    clear_result_cache()
+    yield
+    config.set_result_cache_size(config.Config.result_cache_size)
+    clear_result_cache()
+
+
+@pytest.fixture
+def bakery():
+    call_counter = CallCounter()
+
+    @stage
+    @call_counter
+    def bake_bread(flour_g: int = 500):
+        return f"bread from {flour_g} g flour"
+
+    @stage
+    @call_counter
+    def make_sandwich(bread=Result(bake_bread)):
+        return f"sandwich on {bread}"
+
+    return bake_bread, make_sandwich, call_counter
+
+
+def test_lru_eviction():
+    cache = SizedLRUCache(lambda: 10)
+    cache.put("a", "apple", 4)
+    cache.put("b", "banana", 4)
+    assert cache.get("a") == "apple"
+    cache.put("c", "cherry", 4)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "apple"
+    assert cache.get("c") == "cherry"
+    assert cache.size == 8
+    stats = cache.stats.snapshot()
+    assert (stats.hits, stats.misses, stats.evictions) == (3, 1, 1)
+
+
+def test_oversized_entries_not_cached():
+    cache = SizedLRUCache(lambda: 10)
+    cache.put("a", "apple", 4)
+    cache.put("w", "watermelon", 11)
+    assert cache.get("w") is None
+    assert cache.get("a") == "apple"
+
+
+def test_pinned_entries_not_evicted():
+    cache = SizedLRUCache(lambda: 10)
+    cache.pin("a")
+    cache.put("a", "apple", 8)
+    cache.put("b", "banana", 8)
+    cache.put("c", "cherry", 8)
+    assert cache.get("a") == "apple"
+    assert cache.get("b") is None
+    assert cache.get("c") is None
+
+    cache.clear()
+    cache.put("a", "apple", 8)
+    cache.put("b", "banana", 1)
+    cache.unpin("a")
+    cache.put("c", "cherry", 4)
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert cache.get("c") == "cherry"
+
+
+def test_cached_results_not_loaded_again(result_cache, disk_loads, bakery):
+    bake_bread, make_sandwich, call_counter = bakery
+    make_sandwich()
+    make_sandwich()
+    bake_bread(flour_g=500)
+    assert disk_loads == []
+    assert call_counter.counter["make_sandwich"] == 1
+
+    clear_result_cache()
+    make_sandwich()
+    make_sandwich()
+    assert len(disk_loads) == 2
+    assert get_result_cache_stats().hits == 2
+
+
+def test_cache_disabled_by_default(disk_loads, bakery):
+    _, make_sandwich, _ = bakery
+    make_sandwich()
+    make_sandwich()
+    assert len(disk_loads) == 2
+
+
+def test_pinned_stage_result(disk_loads, bakery):
+    bake_bread, _, call_counter = bakery
+    assert bake_bread.pin(1000) == "bread from 1000 g flour"
+    try:
+        for _ in range(3):
+            bake_bread(1000)
+        bake_bread(500)
+        bake_bread(500)
+    finally:
+        bake_bread.unpin(1000)
+
+    # The pinned result is only loaded from disk when it's pinned
+    assert len(disk_loads) == 2
+    assert call_counter.counter["bake_bread"] == 2
+
+    disk_loads.clear()
+    bake_bread(1000)
+    assert len(disk_loads) == 1
+
+
+def test_pinned_result_kept_with_cache_disabled(disk_loads, bakery):
+    bake_bread, _, call_counter = bakery
+    assert config.get_result_cache_size() == 0
+    bake_bread.pin(1000)
+    try:
+        disk_loads.clear()
+        assert bake_bread(1000) == "bread from 1000 g flour"
+        assert disk_loads == []
+        assert call_counter.counter["bake_bread"] == 1
+    finally:
+        bake_bread.unpin(1000)
+
+
+def test_unpin_does_not_compute(bakery):
+    bake_bread, make_sandwich, call_counter = bakery
+    make_sandwich.unpin()
+    bake_bread.unpin(1000)
+    assert call_counter.counter == {"bake_bread": 0, "make_sandwich": 0}
@@ -0,0 +1,90 @@
+from pycrastinate import stage, Result, Args
+from pycrastinate.config import get_cache_dir
+from pycrastinate.stages import execution
+from pycrastinate.stages.persistence import (
+    load_stage_result,
+    save_stage_result,
+    migrate_stage_results,
+)
+from pycrastinate.utils.hashing import compute_value_hash
+
+
+class Telescope:
+    def __init__(self, aperture: int) -> None:
+        self.aperture = aperture
+
+
+def build_observatory():
+    @stage
+    def build_telescope(aperture: int = 8):
+        return Telescope(aperture)
+
+    @stage
+    def observe(telescope=Result(build_telescope), target: str = "Andromeda"):
+        return f"{target} through a {telescope.aperture} inch telescope"
+
+    return build_telescope, observe
+
+
+def record_hashed_values(monkeypatch):
+    hashed_values = []
+    def compute_value_hash_recording(value):
+        hashed_values.append(value)
+        return compute_value_hash(value)
+    monkeypatch.setattr(execution, "compute_value_hash", compute_value_hash_recording)
+    return hashed_values
+
+
+def test_result_hash_persisted():
+    build_telescope, _ = build_observatory()
+    stage_hash, invocation = build_telescope.compute_or_load_result(Args())
+    persisted_result = load_stage_result(get_cache_dir(), stage_hash)
+
+    assert invocation.result_hash is not None
+    assert persisted_result.result_hash == invocation.result_hash
+    assert persisted_result.result_hash == compute_value_hash(persisted_result.result)
+
+
+def test_cached_dependency_not_rehashed(monkeypatch):
+    _, observe = build_observatory()
+    observation_1 = observe()
+    hashed_values = record_hashed_values(monkeypatch)
+    observation_2 = observe(target="Orion")
+
+    assert observation_1 == "Andromeda through a 8 inch telescope"
+    assert observation_2 == "Orion through a 8 inch telescope"
+    assert not any(isinstance(value, Telescope) for value in hashed_values)
+
+
+def test_legacy_result_migrated_on_load(monkeypatch):
+    build_telescope, observe = build_observatory()
+    stage_hash, _ = build_telescope.compute_or_load_result(Args())
+    persisted_result = load_stage_result(get_cache_dir(), stage_hash)
+    persisted_result.result_hash = None
+    save_stage_result(get_cache_dir(), stage_hash, persisted_result)
+
+    observe()
+    migrated_result = load_stage_result(get_cache_dir(), stage_hash)
+    assert migrated_result.result_hash == compute_value_hash(migrated_result.result)
+    # The migrated result keeps its metadata in the cache index
+    (invocation,) = build_telescope.list_invocations()
+    assert invocation.stage_name.endswith("build_telescope")
+    assert set(invocation.args.keys()) == {"aperture"}
+
+    hashed_values = record_hashed_values(monkeypatch)
+    observe(target="Orion")
+    assert not any(isinstance(value, Telescope) for value in hashed_values)
+
+
+def test_migrate_stage_results():
+    build_telescope, observe = build_observatory()
+    observe()
+    stage_hash, _ = build_telescope.compute_or_load_result(Args())
+    persisted_result = load_stage_result(get_cache_dir(), stage_hash)
+    persisted_result.result_hash = None
+    save_stage_result(get_cache_dir(), stage_hash, persisted_result)
+
+    assert migrate_stage_results(get_cache_dir()) == 1
+    assert migrate_stage_results(get_cache_dir()) == 0
+    migrated_result = load_stage_result(get_cache_dir(), stage_hash)
+    assert migrated_result.result_hash == compute_value_hash(migrated_result.result)
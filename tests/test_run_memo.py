@@ -0,0 +1,134 @@
+import asyncio
+from collections import Counter
+
+import pytest
+
+from pycrastinate import stage, Result, Args, config
+from pycrastinate.stages import execution
+from pycrastinate.stages.memo import get_run_memo
+
+from .utils.call_counter import CallCounter
+
+
+@pytest.fixture
+def kitchen():
+    call_counter = CallCounter()
+
+    @stage
+    @call_counter
+    def buy_flour(kilograms: int = 2):
+        return kilograms * 1000
+
+    @stage
+    @call_counter
+    def bake_bread(flour=Result(buy_flour)):
+        return flour // 500
+
+    @stage
+    @call_counter
+    def bake_cake(flour=Result(buy_flour, Args(kilograms=2))):
+        return flour // 250
+
+    @stage
+    @call_counter
+    def serve_dinner(bread=Result(bake_bread), cake=Result(bake_cake)):
+        return f"{bread} loaves, {cake} cakes"
+
+    return buy_flour, serve_dinner, call_counter
+
+
+@pytest.fixture
+def load_counter(monkeypatch):
+    loads = Counter()
+    load_stage_result = execution.load_stage_result
+
+    def counting_load_stage_result(results_dir, stage_hash):
+        result = load_stage_result(results_dir, stage_hash)
+        # Missing results are probed twice around their single flight
+        if result is not None:
+            loads[stage_hash] += 1
+        return result
+
+    monkeypatch.setattr(execution, "load_stage_result", counting_load_stage_result)
+    return loads
+
+
+@pytest.mark.parametrize("keying_mode", [
+    config.KEYING_BY_VALUE, config.KEYING_BY_REFERENCE
+])
+def test_diamond_resolved_once(kitchen, load_counter, keying_mode):
+    _, serve_dinner, call_counter = kitchen
+    config.set_keying_mode(keying_mode)
+    try:
+        assert serve_dinner() == "4 loaves, 8 cakes"
+        # Defaulted and passed arguments are the same node, it's neither executed
+        # nor loaded again
+        assert call_counter.counter["buy_flour"] == 1
+        assert len(load_counter) == 0
+
+        serve_dinner.compute_or_load_result(
+            Args(cake=Args(flour=Args(kilograms=2)))
+        )
+        assert max(load_counter.values()) == 1
+    finally:
+        config.set_keying_mode(config.Config.keying_mode)
+    assert call_counter.counter["serve_dinner"] == 1
+    # Released at the end of the run
+    assert get_run_memo() is None
+
+
+def test_disabled(kitchen, load_counter):
+    _, serve_dinner, _ = kitchen
+    serve_dinner()
+    config.set_run_memo_enabled(False)
+    try:
+        load_counter.clear()
+        serve_dinner()
+        # Loaded on both paths of the diamond
+        assert max(load_counter.values()) == 2
+    finally:
+        config.set_run_memo_enabled(config.Config.run_memo)
+
+
+def test_concurrent_resolution(kitchen, load_counter):
+    buy_flour, serve_dinner, call_counter = kitchen
+    buy_flour()
+    config.set_max_parallelism(2)
+    try:
+        load_counter.clear()
+        assert serve_dinner() == "4 loaves, 8 cakes"
+    finally:
+        config.set_max_parallelism(config.Config.max_parallelism)
+    assert call_counter.counter["buy_flour"] == 1
+    assert max(load_counter.values()) == 1
+
+
+def test_errors_shared(kitchen):
+    buy_flour, serve_dinner, call_counter = kitchen
+
+    @stage
+    @call_counter
+    def buy_sugar(kilograms: int = -1):
+        if kilograms < 0:
+            raise ValueError("Can't buy negative sugar")
+        return kilograms
+
+    @stage
+    def bake_cookies(
+        sugar=Result(buy_sugar), icing=Result(buy_sugar, Args(kilograms=-1))
+    ):
+        return sugar + icing
+
+    with pytest.raises(ValueError, match="negative sugar"):
+        bake_cookies()
+    assert call_counter.counter["buy_sugar"] == 1
+    assert get_run_memo() is None
+
+
+def test_async_diamond(kitchen, load_counter):
+    buy_flour, serve_dinner, call_counter = kitchen
+    buy_flour()
+    load_counter.clear()
+    assert asyncio.run(serve_dinner.acall()) == "4 loaves, 8 cakes"
+    assert call_counter.counter["buy_flour"] == 1
+    assert max(load_counter.values()) == 1
@@ -0,0 +1,175 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from pycrastinate import stage, Args, config
+from pycrastinate.stages.execution import prepare_execution, compute_stage_hash
+from pycrastinate.stages.single_flight import LOCKS_DIR_NAME
+from pycrastinate.utils import locking
+from pycrastinate.utils.locking import LOCK_FILE_SUFFIX
+
+from .utils.call_counter import CallCounter
+
+
+NUM_THREADS = 30
+NUM_PROCESSES = 4
+
+
+@stage
+def roast_beans(minutes: int, log_file: str):
+    with open(log_file, "a") as file:
+        file.write(f"{os.getpid()}\n")
+    time.sleep(0.5)
+    return f"beans roasted for {minutes} min"
+
+
+def roast_in_process(cache_dir, log_file):
+    config.set_cache_dir(cache_dir)
+    return roast_beans(12, log_file)
+
+
+def get_lock_file(tmp_path, stage, **kwargs):
+    exec_data = prepare_execution(stage.argument_plan.aggregate(Args(**kwargs)))
+    stage_hash = compute_stage_hash(stage.stage_func, exec_data)
+    return tmp_path / LOCKS_DIR_NAME / (stage_hash.hex() + LOCK_FILE_SUFFIX)
+
+
+@pytest.fixture
+def grind_beans():
+    call_counter = CallCounter()
+    started = threading.Event()
+
+    @stage
+    @call_counter
+    def grind_beans(grams: int):
+        started.set()
+        time.sleep(0.2)
+        if grams < 0:
+            raise ValueError("Can't grind negative beans")
+        return f"{grams} g ground coffee"
+
+    return grind_beans, call_counter, started
+
+
+def test_concurrent_threads_execute_once(grind_beans):
+    grind_beans, call_counter, _ = grind_beans
+    with ThreadPoolExecutor(NUM_THREADS) as executor:
+        results = list(
+            executor.map(lambda _: grind_beans(18), range(NUM_THREADS))
+        )
+    assert results == ["18 g ground coffee"] * NUM_THREADS
+    assert call_counter.counter == {"grind_beans": 1}
+
+    # Different stage hashes are executed concurrently
+    with ThreadPoolExecutor(NUM_THREADS) as executor:
+        start = time.perf_counter()
+        list(executor.map(grind_beans, range(100, 100 + NUM_THREADS)))
+    assert time.perf_counter() - start < 0.2 * NUM_THREADS / 2
+    assert call_counter.counter == {"grind_beans": NUM_THREADS + 1}
+
+
+def test_waiting_threads_get_error(grind_beans):
+    grind_beans, call_counter, started = grind_beans
+    with ThreadPoolExecutor(NUM_THREADS) as executor:
+        first_future = executor.submit(grind_beans, -1)
+        started.wait()
+        futures = [
+            executor.submit(grind_beans, -1) for _ in range(NUM_THREADS - 1)
+        ]
+        for future in [first_future, *futures]:
+            with pytest.raises(ValueError, match="negative beans"):
+                future.result()
+    assert call_counter.counter == {"grind_beans": 1}
+
+
+def test_concurrent_processes_execute_once(tmp_path):
+    log_file = tmp_path / "roasts.log"
+    with ProcessPoolExecutor(
+        NUM_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(roast_in_process, tmp_path, str(log_file))
+            for _ in range(NUM_PROCESSES)
+        ]
+        assert [future.result() for future in futures] == (
+            ["beans roasted for 12 min"] * NUM_PROCESSES
+        )
+    assert len(log_file.read_text().splitlines()) == 1
+    assert list((tmp_path / LOCKS_DIR_NAME).iterdir()) == []
+
+
+def test_stale_lock_files_are_removed(tmp_path, caplog, grind_beans):
+    grind_beans, call_counter, _ = grind_beans
+    lock_file = get_lock_file(tmp_path, grind_beans, grams=18)
+    lock_file.parent.mkdir()
+
+    # The owner process doesn't run anymore, no pid is larger than 2 ** 22
+    lock_file.write_text(f"{socket.gethostname()}\n{2 ** 22 + 1}\nowner\n")
+    with caplog.at_level(logging.WARNING):
+        assert grind_beans(18) == "18 g ground coffee"
+    assert "stale lock" in caplog.text
+
+    # The owner on another host didn't refresh the lock
+    lock_file = get_lock_file(tmp_path, grind_beans, grams=20)
+    lock_file.write_text("other-host\n1\nowner\n")
+    os.utime(lock_file, (time.time() - 120, time.time() - 120))
+    assert grind_beans(20) == "20 g ground coffee"
+    assert call_counter.counter == {"grind_beans": 2}
+    assert list(lock_file.parent.iterdir()) == []
+
+
+def test_reused_pids_become_stale(tmp_path, grind_beans):
+    grind_beans, call_counter, _ = grind_beans
+    lock_file = get_lock_file(tmp_path, grind_beans, grams=18)
+    lock_file.parent.mkdir()
+    # The pid of the dead owner was reused by a running process
+    lock_file.write_text(f"{socket.gethostname()}\n{os.getpid()}\nowner\n")
+    os.utime(lock_file, (time.time() - 120, time.time() - 120))
+    start = time.perf_counter()
+    assert grind_beans(18) == "18 g ground coffee"
+    assert time.perf_counter() - start < 5
+    assert call_counter.counter == {"grind_beans": 1}
+
+
+def test_replaced_stale_locks_are_kept(tmp_path, monkeypatch):
+    lock_file = tmp_path / ("stale" + LOCK_FILE_SUFFIX)
+    lock_file.write_text("other-host\n1\nowner\n")
+    os.utime(lock_file, (time.time() - 120, time.time() - 120))
+
+    is_stale = locking._is_stale
+
+    def take_over_after_check(*args):
+        stale = is_stale(*args)
+        # Another waiter removed the stale lock and a third process took it
+        lock_file.unlink()
+        lock_file.write_text("other-host\n2\nnew owner\n")
+        return stale
+
+    monkeypatch.setattr(locking, "_is_stale", take_over_after_check)
+    assert locking._remove_if_stale(lock_file, stale_age=60)
+    assert lock_file.read_text() == "other-host\n2\nnew owner\n"
+    assert list(tmp_path.iterdir()) == [lock_file]
+
+
+def test_lock_timeout(tmp_path, caplog, grind_beans):
+    grind_beans, call_counter, _ = grind_beans
+    lock_file = get_lock_file(tmp_path, grind_beans, grams=18)
+    lock_file.parent.mkdir()
+    # Held by a live process
+    lock_file.write_text(f"{socket.gethostname()}\n{os.getpid()}\nowner\n")
+
+    config.set_single_flight_timeout(0.1)
+    try:
+        with caplog.at_level(logging.WARNING):
+            assert grind_beans(18) == "18 g ground coffee"
+    finally:
+        config.set_single_flight_timeout(config.Config.single_flight_timeout)
+    assert "Timed out" in caplog.text
+    assert call_counter.counter == {"grind_beans": 1}
+    assert lock_file.exists()
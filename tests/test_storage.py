@@ -0,0 +1,97 @@
+import pytest
+
+from pycrastinate import stage, hook, Subscription, Result, Args, config
+from pycrastinate.storage import (
+    FileSystemStorage,
+    MemoryStorage,
+    SQLiteStorage,
+    close_storages,
+)
+from pycrastinate.stages.persistence import migrate_stage_results
+
+from .utils.call_counter import CallCounter
+
+
+STORAGE_BACKENDS = [
+    config.STORAGE_FILESYSTEM,
+    config.STORAGE_SQLITE,
+    config.STORAGE_MEMORY,
+]
+
+
+@pytest.fixture(params=STORAGE_BACKENDS)
+def storage_backend(request):
+    config.set_storage_backend(request.param)
+    yield request.param
+    close_storages()
+    config.set_storage_backend(config.Config.storage_backend)
+
+
+@pytest.fixture(params=[FileSystemStorage, SQLiteStorage, MemoryStorage])
+def storage(request, tmp_path):
+    if request.param is MemoryStorage:
+        storage = MemoryStorage()
+    else:
+        storage = request.param(tmp_path)
+    yield storage
+    storage.close()
+
+
+def test_storage_roundtrip(storage):
+    pantry = {"flour": 2.5, "sugar": [1] * 1000}
+    object_sizes = storage.save("pantry/shelves/top", pantry)
+    loaded_pantry, encoded_size = storage.load("pantry/shelves/top")
+    assert loaded_pantry == pantry
+    assert loaded_pantry is not pantry
+    assert encoded_size == object_sizes.encoded_size
+
+    assert storage.exists("pantry/shelves/top")
+    assert not storage.exists("pantry/shelves")
+    assert storage.load("pantry/shelves/bottom") is None
+
+
+def test_storage_list_and_delete(storage):
+    storage.save("pantry/a1/flour", "flour")
+    storage.save("pantry/b2/sugar", "sugar")
+    storage.save("fridge/c3/milk", "milk")
+    assert sorted(key for key, _ in storage.list_objects("pantry/")) == [
+        "pantry/a1/flour", "pantry/b2/sugar",
+    ]
+    assert all(size > 0 for _, size in storage.list_objects("fridge/"))
+
+    assert storage.delete("pantry/a1/flour")
+    assert not storage.delete("pantry/a1/flour")
+    assert [key for key, _ in storage.list_objects("pantry/")] == ["pantry/b2/sugar"]
+
+
+def test_stages_and_hooks_with_backend(tmp_path, storage_backend):
+    call_counter = CallCounter()
+    measurements = []
+
+    @stage
+    @call_counter
+    def weigh_flour(cups: int):
+        return cups * 120
+
+    @stage
+    @call_counter
+    def bake_cake(flour_g=Result(weigh_flour, Args(cups=3))):
+        return f"cake with {flour_g} g flour"
+
+    @hook
+    def record_weight(weight=Subscription(weigh_flour)):
+        measurements.append(weight)
+
+    assert bake_cake() == "cake with 360 g flour"
+    assert bake_cake() == "cake with 360 g flour"
+    weigh_flour(2)
+    weigh_flour(2)
+    assert call_counter.counter == {"weigh_flour": 2, "bake_cake": 1}
+    assert measurements == [360, 240]
+    assert len(bake_cake.list_invocations()) == 1
+    assert migrate_stage_results(tmp_path) == 0
+
+    if storage_backend == config.STORAGE_MEMORY:
+        assert list(tmp_path.iterdir()) == []
+    elif storage_backend == config.STORAGE_SQLITE:
+        assert not (tmp_path / "stage_results").exists()